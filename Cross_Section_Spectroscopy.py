@@ -1,13 +1,36 @@
-import os, glob
+import os
 import sys
+from itertools import islice, chain
 import json
 import customtkinter
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from scipy.optimize import curve_fit as cf
-from scipy.signal import savgol_filter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait as wait_futures
+from collections import OrderedDict
+import threading
+from tkinter import messagebox
+import hashlib
+import gc
+import copy
+import tracemalloc
+import functools
+import platform
+import time
+from datetime import datetime
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+import scipy
+import matplotlib
+from scipy.signal import savgol_coeffs, oaconvolve
+from scipy.ndimage import correlate1d
+from scipy.fft import next_fast_len
 import scipy.integrate as integrate
+from scipy import sparse
+from scipy.special import wrightomega
 from PIL import Image
 import darkdetect
 
@@ -19,6 +42,25 @@ hc = 1.24e-4   # planck constant * speed of light per 1cm in [eV]
 kbT = 0.025266 # Energy of room temperature
 kb = 8.617333e-5 # Boltzmann constant in eV/K
 c = 3e10       # speed of light in cm/s
+planck = 6.626e-34 # planck constant in Js
+
+# dtype of the bulk signal data (read spectrum files, stacks, the Fuchtbauer-Ladenburg family over all depths),
+# np.float32 with the start option --float32. Wavelengths and the returned (n,2) spectra are always float64.
+# Compared to np.float64 the cross sections deviate by less than float32_tolerance relative to their maximum
+# (at most 1e-5 for the golden materials).
+compute_dtype = np.float64
+float32_tolerance = 1e-4
+
+# moving average windows (min. wavelength [nm], max. wavelength [nm], window [nm]) applied to the fluorescence,
+# can be changed per material with the key "smoothing_windows" in basedata.json
+default_smoothing_windows = [[990, 1150, 0.8], [1000, 1060, 1.2]]
+
+# reabsorption depths [mm] of the "absorption depth" slider, sigma_e is precomputed for all of them
+FL_depth_grid = np.linspace(0, 3, 101)
+
+# legend labels of the run_pipeline results in the cross section plot
+cross_section_labels = {"sigma_a": "$\\sigma_a$ {name}", "sigma_e": "$\\sigma_e$ Füchtbauer", "sigma_e_McCumber": "$\\sigma_e$ McCumber",
+                        "sigma_e_average": "$\\sigma_e$ average", "sigma_a_average": "$\\sigma_a$ average"}
 
 def set_plot_params():
     plt.rcParams["figure.figsize"] = (8,4)
@@ -36,6 +78,22 @@ def set_plot_params():
     plt.rcParams['mathtext.it'] = 'Times New Roman:italic'
     plt.rcParams['mathtext.bf'] = 'Times New Roman:bold'
 
+# MemoryProfiler of the memory profiling mode (--profile-memory), None if disabled
+memory_profiler = None
+
+def profiled_action(method):
+    # interactive plot action: stops the background prefetch and records the allocations if the memory profiling mode is active
+    # (only then it waits for a running prefetch step, otherwise the Tk main loop is not blocked)
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.prefetcher.cancel(wait=memory_profiler is not None)
+        try:
+            with memory_profiler.track(method.__name__) if memory_profiler is not None else nullcontext():
+                return method(self, *args, **kwargs)
+        finally:
+            self.schedule_prefetch()
+    return wrapper
+
 class App(customtkinter.CTk):
     def __init__(self):
         super().__init__()
@@ -51,7 +109,8 @@ class App(customtkinter.CTk):
         self.initialize_ui()
 
         self.toplevel_window = {'Plot Settings': None,
-                                'Legend Settings': None}
+                                'Legend Settings': None,
+                                'Figure of Merit': None}
 
         self.load_settings_frame()
 
@@ -61,10 +120,13 @@ class App(customtkinter.CTk):
         self.save_attributes = ["material_list", "use_McCumber", "use_Fuchtbauer", "average_sigma"]
 
         self.save_attributes.extend(["doping", "thickness", "tau_f", "refractive_index", "temperature"])
-        self.save_attributes.extend(["zero_bandwidth", "FF_absorption", "FF_fluorescence", "savgol_filter", "lower_zero_index", "higher_zero_index"])
-        self.save_attributes.extend(["MC_central", "MC_width", "FL_absorption"])
+        self.save_attributes.extend(["zero_bandwidth", "FF_absorption", "FF_fluorescence", "savgol_filter_nm", "lower_zero_index", "higher_zero_index"])
+        self.save_attributes.extend(["MC_central", "MC_width", "FL_absorption", "FL_excitation"])
         self.save_attributes.extend(self.settings_widgets)
 
+        self.bind("<Control-z>", lambda event: self.undo_snapshot())
+        self.bind("<Control-y>", lambda event: self.redo_snapshot())
+
     def initialize_ui_images(self):
         self.img_settings = customtkinter.CTkImage(dark_image=Image.open(os.path.join(Standard_path,"ui_images","options.png")), size=(15, 15))
         self.img_save = customtkinter.CTkImage(dark_image=Image.open(os.path.join(Standard_path,"ui_images","save_white.png")), size=(15, 15))
@@ -73,7 +135,20 @@ class App(customtkinter.CTk):
         self.img_absorption = customtkinter.CTkImage(dark_image=Image.open(os.path.join(Standard_path,"ui_images","absorption.png")), size=(15, 15))
 
     def initialize_variables(self):
-        self.materials = [f for f in os.listdir(os.path.join(Standard_path, "measurements"))]
+        self.catalog = MaterialCatalog(os.path.join(Standard_path, "measurements"))
+        self.catalog.update()
+        self.materials = self.catalog.query()
+
+        # analysis sessions (one per material) sharing one compute backend
+        self.backend = ComputeBackend()
+        self.sessions = {}
+        # background warming of the materials opened next: neighbours in the list, recently used and project materials
+        self.prefetcher = Prefetcher(usage=lambda: self.backend.bytes + spectrum_cache.bytes)
+        self.prefetch_job = None
+        self.recent_materials = []
+        self.project_materials = []
+        self.current_session = None
+        self.suspend_updates = False
 
         self.ax = None
         self.plot_index = 0
@@ -99,10 +174,15 @@ class App(customtkinter.CTk):
         App.create_label(frame, row=0, column=0, text="CSS v."+version_number, font=customtkinter.CTkFont(size=20, weight="bold"), padx=20, pady=(10,15), sticky=None)
 
         #buttons
-        self.material_list             = App.create_Menu(frame, values=self.materials, column=0, row=1, command=self.load_material, init_val=self.materials[0])
+        self.material_list             = App.create_Menu(frame, values=self.materials, column=0, row=1, command=self.open_session, init_val=self.materials[0])
+        self.material_search           = App.create_entry(frame, column=0, row=2, placeholder_text="search, e.g. Yb CaF2 T<300", sticky=None)
+        self.material_search.bind("<KeyRelease>", lambda val: self.filter_material_list())
         self.plot_fluorescence_button  = App.create_button(frame, text="Plot fluorescence", command=self.fluorescence_plot, column=0, row=4, image=self.img_fluorescence, sticky="w")
         self.plot_absorption_button    = App.create_button(frame, text="Plot absorption", command=self.absorption_plot, column=0, row=5, image=self.img_absorption, sticky="w")
         self.plot_cross_section_button = App.create_button(frame, text="Plot cross section", command=self.cross_sections_plot, column=0, row=6, sticky="w")
+        self.plot_stack_button         = App.create_button(frame, text="Plot absorption stack", command=self.stack_plot, column=0, row=7, sticky="w")
+        self.merit_button              = App.create_button(frame, text="Figure of merit table", command=self.figure_of_merit_window, column=0, row=8, sticky="w")
+        self.plot_gain_button          = App.create_button(frame, text="Plot gain", command=self.gain_plot, column=0, row=9, sticky="w")
 
         # bottom settings
         self.save_button    = App.create_button(frame, text="Save figure/data", command=self.save_figure,     column=0, row=23,  image=self.img_save, pady=(5,15))
@@ -154,7 +234,7 @@ class App(customtkinter.CTk):
         self.load_fluorescence_sidebar()
         self.load_absorption_sidebar()
         self.load_cross_section_sidebar()
-        self.load_material(self.materials[0])
+        self.open_session(self.materials[0])
 
 
     def create_label(self, row, column, width=20, text=None, anchor='e', sticky='e', textvariable=None, padx=(5,5), image=None, pady=None, columnspan=1, fg_color=None, **kwargs):
@@ -334,7 +414,7 @@ class App(customtkinter.CTk):
         before_widgets = set(self.settings_frame.winfo_children())
         App.create_label(self.settings_frame, text="Absorption Settings", font=customtkinter.CTkFont(size=16, weight="bold"), row=row, column=0, columnspan=4, padx=20, pady=(20, 5),sticky=None)
         self.FF_absorption, self.FF_absorption_var        = App.create_slider(self.settings_frame, from_=0, to=1, column=1, row=row+1, width=150, text="fourier filter (raw data)", init_val=0, number_of_steps=100, SliderValueLabel=True, command= self.update_abs_slider_value)
-        self.savgol_filter, self.savgol_filter_var          = App.create_slider(self.settings_frame, from_=0, to=50, column=1, row=row+2, width=150, text="Savitzky Golay filter (σ)", init_val=0, number_of_steps=50, SliderValueLabel=True, command= self.update_abs_slider_value)
+        self.savgol_filter_nm, self.savgol_filter_nm_var         = App.create_slider(self.settings_frame, from_=0, to=10, column=1, row=row+2, width=150, text="Savitzky Golay filter [nm]", init_val=0, number_of_steps=50, SliderValueLabel=True, command= self.update_abs_slider_value)
         self.zero_bandwidth, self.zero_bandwidth_var        = App.create_slider(self.settings_frame, from_=0, to=100, column=1, row=row+3, width=150, text="zero abs. bandwidth [nm]", init_val=0, number_of_steps=100, SliderValueEntry=True, command= self.update_abs_slider_value)
         self.lower_zero_index, self.lower_zero_index_var    = App.create_slider(self.settings_frame, from_=0, to=1, column=1, row=row+4, width=150, text="zero wavelength 1 [nm]", init_val=1, number_of_steps=100, SliderValueEntry=True, command= self.update_abs_slider_value)
         self.higher_zero_index, self.higher_zero_index_var  = App.create_slider(self.settings_frame, from_=0, to=1, column=1, row=row+5, width=150, text="zero wavelength 2 [nm]", init_val=1, number_of_steps=100, SliderValueEntry=True, command= self.update_abs_slider_value)
@@ -350,8 +430,18 @@ class App(customtkinter.CTk):
         self.MC_central, self.MC_central_var = App.create_slider(self.settings_frame, from_=0, to=1, column=1, row=row+2, width=150, text="MC central WL", init_val=0, number_of_steps=100, SliderValueEntry=True, command=lambda value: self.update_cross_sections_plot())
         self.MC_width, self.MC_width_var = App.create_slider(self.settings_frame, from_=0, to=50, column=1, row=row+3, width=150, text="average bandwidth", init_val=0, number_of_steps=100, SliderValueEntry=True, command=lambda value: self.update_cross_sections_plot())
 
-        self.FL_title = App.create_label(self.settings_frame, row=row+5, column=0, text="FL Settings", font=customtkinter.CTkFont(size=16, weight="bold"), columnspan=4, padx=20, pady=(20, 5),sticky=None)
-        self.FL_absorption, self.FL_absorption_var = App.create_slider(self.settings_frame, from_=0, to=3, column=1, row=row+6, width=150, text="absorption depth [mm]", init_val=0, number_of_steps=100, SliderValueLabel=True, command=lambda value: self.update_cross_sections_plot())
+        self.fit_ZPL_button = App.create_button(self.settings_frame, row=row+4, column=0, text="Fit ZPL", command=self.fit_zero_phonon_line, columnspan=4, width=150)
+        self.fit_ZPL_result = App.create_label(self.settings_frame, row=row+5, column=0, text="", columnspan=4, anchor="center", sticky=None)
+
+        self.FL_title = App.create_label(self.settings_frame, row=row+6, column=0, text="FL Settings", font=customtkinter.CTkFont(size=16, weight="bold"), columnspan=4, padx=20, pady=(20, 5),sticky=None)
+        self.FL_absorption, self.FL_absorption_var = App.create_slider(self.settings_frame, from_=FL_depth_grid[0], to=FL_depth_grid[-1], column=1, row=row+7, width=150, text="absorption depth [mm]", init_val=0, number_of_steps=len(FL_depth_grid)-1, SliderValueLabel=True, command=lambda value: self.update_cross_sections_plot())
+        self.FL_excitation, self.FL_excitation_var = App.create_slider(self.settings_frame, from_=0, to=0.5, column=1, row=row+8, width=150, text="excited fraction β", init_val=0, number_of_steps=50, SliderValueLabel=True, command=lambda value: self.update_cross_sections_plot())
+
+        self.snapshot_title = App.create_label(self.settings_frame, row=row+9, column=0, text="Snapshots", font=customtkinter.CTkFont(size=16, weight="bold"), columnspan=4, padx=20, pady=(20, 5),sticky=None)
+        self.undo_button = App.create_button(self.settings_frame, row=row+10, column=0, text="undo", command=self.undo_snapshot, width=110)
+        self.redo_button = App.create_button(self.settings_frame, row=row+10, column=1, text="redo", command=self.redo_snapshot, width=110, sticky="w")
+        self.snapshot_B = App.create_Menu(self.settings_frame, values=[""], column=1, row=row+11, width=150, text="snapshot B", sticky="w", command=lambda value: self.compare_snapshot() if self.compare_snapshots.get() else None)
+        self.compare_snapshots = App.create_switch(self.settings_frame, row=row+12, column=0, text="A/B overlay", columnspan=4, command=self.compare_snapshot)
 
         # for widget in [self.MC_central, self.MC_width, self.FL_absorption]:
         #     widget.bind("<KeyRelease>", lambda val: self.update_material_dictionary(val))
@@ -366,48 +456,51 @@ class App(customtkinter.CTk):
         self.material_dict["zero_absorption_width"] = self.zero_bandwidth.get()
         self.material_dict["zero_absorption_wavelength"] = (int(self.lower_zero_index.get()), int(self.higher_zero_index.get()))
         self.material_dict["absorption_depth"] = float(self.FL_absorption.get())
+        self.material_dict["excitation_fraction"] = float(self.FL_excitation.get())
         self.material_dict["temperature"] = float(self.temperature.get())
         self.material_dict["n"] = float(self.refractive_index.get())
 
     # load the material
     def load_material(self, material):
-        path = os.path.join(Standard_path, "measurements", material, "basedata.json")
-        with open(path, "r") as file:
-            self.material_dict = json.load(file)
-
-        self.material_dict.setdefault("zero_absorption_wavelength", (0, np.inf))
-        self.material_dict.setdefault("folder_path", material)
-        self.material_dict.setdefault("zero_absorption_width", 0)
-
-        self.doping.reinsert(self.material_dict["N_dop"]*1e-6)
-        self.thickness.reinsert(str(self.material_dict["length"]*1e3))
-        self.tau_f.reinsert(str(self.material_dict["tau_f"]*1e3))
-        self.refractive_index.reinsert(str(self.material_dict["n"]))
-        self.temperature.reinsert(str(self.material_dict["temperature"]))
-        self.zero_bandwidth.set(self.material_dict["zero_absorption_width"])
-
-        self.E_u = self.material_dict.get("energy_upper_level", [1e-2/self.material_dict["ZPL"]])
-        self.E_l = self.material_dict.get("energy_lower_level", [0])
-
-        try:
-            sigma_a, absorption, reference, ratio = calc_absorption(self.material_dict, filter_width=float(self.FF_absorption.get()), savgol_filter_width=int(self.savgol_filter.get()))
-            lam_min = int(absorption[0,0])+1
-            lam_max = int(absorption[-1,0])
-            self.higher_zero_index.configure(from_=lam_min, to=lam_max, number_of_steps=int(lam_max - lam_min))
-            self.lower_zero_index.configure(from_=lam_min, to=lam_max, number_of_steps=int(lam_max - lam_min))
-            self.higher_zero_index.set(lam_max)
-            self.lower_zero_index.set(lam_min)
-
-            self.MC_central.configure(from_=lam_min, to=lam_max, number_of_steps=int(lam_max - lam_min))
+        with self.settings_transaction(recompute=False):
+            self.material_dict = self.prefetcher.material(material)
+            self.backend.refresh(self.material_dict)
+
+            self.doping.reinsert(self.material_dict["N_dop"]*1e-6)
+            self.thickness.reinsert(str(self.material_dict["length"]*1e3))
+            self.tau_f.reinsert(str(self.material_dict["tau_f"]*1e3))
+            self.refractive_index.reinsert(str(self.material_dict["n"]))
+            self.temperature.reinsert(str(self.material_dict["temperature"]))
+            self.zero_bandwidth.set(self.material_dict["zero_absorption_width"])
+
+            self.E_u = self.material_dict.get("energy_upper_level", [1e-2/self.material_dict["ZPL"]])
+            self.E_l = self.material_dict.get("energy_lower_level", [0])
+
+            try:
+                sigma_a, absorption, reference, ratio = self.backend.call(calc_absorption, self.material_dict, filter_width=float(self.FF_absorption.get()), savgol_filter_width=float(self.savgol_filter_nm.get()))
+                lam_min = int(absorption[0,0])+1
+                lam_max = int(absorption[-1,0])
+                self.higher_zero_index.configure(from_=lam_min, to=lam_max, number_of_steps=int(lam_max - lam_min))
+                self.lower_zero_index.configure(from_=lam_min, to=lam_max, number_of_steps=int(lam_max - lam_min))
+                self.higher_zero_index.set(lam_max)
+                self.lower_zero_index.set(lam_min)
+
+                self.MC_central.configure(from_=lam_min, to=lam_max, number_of_steps=int(lam_max - lam_min))
             
 
-        except:
-            FileNotFoundError("Absorption or reference data not found in the selected material folder.")
+            except:
+                FileNotFoundError("Absorption or reference data not found in the selected material folder.")
 
-        self.FF_absorption_var.set(0)
-        self.MC_central.set(self.material_dict["ZPL"]*1e9)
-        self.MC_width.set(10)
+            self.FF_absorption_var.set(0)
+            self.MC_central.set(self.material_dict["ZPL"]*1e9)
+            self.MC_width.set(10)
         
+    def filter_material_list(self):
+        # restrict the option menu to the materials matching the search entry
+        materials = self.catalog.query(search=self.material_search.get())
+        self.material_list.configure(values=materials if materials else [""])
+        self.schedule_prefetch()
+
     def toggle_sidebar_window(self, button, widgets, First_time=False):
         if button.get():
             self.settings_frame.grid()
@@ -442,6 +535,9 @@ class App(customtkinter.CTk):
         self.tabview.tab("Show Plots").columnconfigure(0, weight=1)
         self.tabview.tab("Show Plots").rowconfigure(0, weight=1)
 
+        self.session_bar = App.create_segmented_button(self, values=[""], command=self.open_session, row=2, column=1, sticky="w", pady=(10,0))
+        self.close_session_button = App.create_button(self, text="close session", command=self.close_session, row=2, column=2, width=110, sticky="e", pady=(10,0))
+
         self.fig = plt.figure(constrained_layout=True, dpi=150)
         self.ax = self.fig.add_subplot(1, 1, 1)
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.tabview.tab("Show Plots"))
@@ -450,16 +546,90 @@ class App(customtkinter.CTk):
         self.canvas_widget.pack(fill="both", expand=True)
         self.canvas.draw()
 
+    # Sessions: every opened material keeps its settings, figure and artists
+    session_prefixes = ("material_dict", "E_l", "E_u", "fig", "ax", "legend", "line_", "vline_", "shade_", "sigma_", "stack_", "McCumber_line", "current_plot", "manifest", "snapshot_")
+    session_sliders = ("lower_zero_index", "higher_zero_index", "MC_central")
+
+    def open_session(self, material):
+        if material == self.current_session or material == "":
+            return
+        if self.current_session is not None:
+            self.sessions[self.current_session] = self.store_session()
+
+        if material in self.sessions:
+            self.restore_session(self.sessions[material])
+        else:
+            if self.current_session is not None:
+                self.clear_session_attributes()
+                self.fig = plt.figure(constrained_layout=True, dpi=150)
+                self.ax = self.fig.add_subplot(1, 1, 1)
+                self.show_figure(self.fig)
+            self.load_material(material)
+
+        self.current_session = material
+        self.sessions.setdefault(material, None)
+        self.material_list.set(material)
+        self.session_bar.configure(values=list(self.sessions))
+        self.session_bar.set(material)
+        self.update_snapshot_widgets()
+        self.recent_materials = [material] + [name for name in self.recent_materials if name != material][:7]
+        self.schedule_prefetch()
+
+    def close_session(self):
+        if len(self.sessions) <= 1:
+            return
+        material = self.current_session
+        plt.close(self.fig)
+        del self.sessions[material]
+        self.current_session = None
+        self.open_session(next(iter(self.sessions)))
+
+    def store_session(self):
+        self.flush_snapshot()
+        state = {name: getattr(self, name) for name in self.session_attribute_names()}
+        state["settings"] = self.collect_project_data()
+        state["slider_ranges"] = {name: [getattr(self, name).cget(key) for key in ("from_", "to", "number_of_steps")] for name in self.session_sliders}
+        return state
+
+    def session_attribute_names(self):
+        # plot artists and material data of the current session, widgets are shared by all sessions
+        return [name for name, value in vars(self).items() if name.startswith(self.session_prefixes) and not isinstance(value, customtkinter.CTkBaseClass)]
+
+    def clear_session_attributes(self):
+        for name in self.session_attribute_names():
+            if name not in ("fig", "ax"):
+                delattr(self, name)
+
+    def restore_session(self, state):
+        self.clear_session_attributes()
+        for name, value in state.items():
+            if name not in ("settings", "slider_ranges"):
+                setattr(self, name, value)
+        self.show_figure(self.fig)
+
+        for name, (from_, to, number_of_steps) in state["slider_ranges"].items():
+            getattr(self, name).configure(from_=from_, to=to, number_of_steps=number_of_steps)
+        with self.settings_transaction(recompute=False):
+            self.apply_settings(state["settings"])
+
+    def show_figure(self, fig):
+        # display another figure in the same Tk canvas
+        fig.set_size_inches(self.canvas.figure.get_size_inches())
+        self.canvas.figure = fig
+        fig.set_canvas(self.canvas)
+        self.canvas.draw_idle()
+
     def clear_figure(self):
         self.fig.clear()
         self.ax = self.fig.add_subplot(1, 1, 1)
 
+    @profiled_action
     def fluorescence_plot(self):
         self.clear_figure()
+        self.current_plot = "fluorescence"
 
         # get fluorescence file names!
-        path = os.path.join(Standard_path, "measurements", self.material_dict["folder_path"])
-        fluorescence_files = glob.glob(os.path.join(path, '*fluorescence*.txt')) 
+        fluorescence_files = measurement_files(self.material_dict, "fluorescence")
         filenames = [os.path.basename(f).replace(".txt", "").replace("_", " ") for f in fluorescence_files]
     
         if len(fluorescence_files) > 1: 
@@ -476,9 +646,10 @@ class App(customtkinter.CTk):
         if self.show_title.get(): self.ax.set_title(f"fluorescence of {self.material_dict['name']}")
         self.update_fluorescence_plot()
 
+    @profiled_action
     def update_fluorescence_plot(self):
         if hasattr(self, 'line_fluo'):
-            Fluo, Fluo_low, Fluo_high = calc_fluorescence(self.material_dict, filter_width=self.FF_fluorescence.get())
+            Fluo, Fluo_low, Fluo_high = self.backend.call(calc_fluorescence, self.material_dict, filter_width=self.FF_fluorescence.get())
 
             if Fluo_low is not None and Fluo_high is not None: 
                 self.line_fluo_low.set_data(Fluo_low[:,0], Fluo_low[:,1])
@@ -489,8 +660,10 @@ class App(customtkinter.CTk):
             self.ax.autoscale_view()
             self.canvas.draw_idle()
 
+    @profiled_action
     def absorption_plot(self):
         self.clear_figure()
+        self.current_plot = "absorption"
 
         self.line_abs, = self.ax.plot([],[], label="absorption")
         self.line_ref, = self.ax.plot([],[], label="reference")
@@ -515,11 +688,12 @@ class App(customtkinter.CTk):
 
         self.update_absorption_plot()
 
+    @profiled_action
     def update_absorption_plot(self):
         if not hasattr(self, 'line_abs'):
             return  # plot not initialized yet
 
-        sigma_a, absorption, reference, ratio = calc_absorption(self.material_dict, filter_width=float(self.FF_absorption.get()), savgol_filter_width=int(self.savgol_filter.get()))
+        sigma_a, absorption, reference, ratio = self.backend.call(calc_absorption, self.material_dict, filter_width=float(self.FF_absorption.get()), savgol_filter_width=float(self.savgol_filter_nm.get()))
 
         # update plot data
         self.line_abs.set_data(absorption[:,0], absorption[:,1])
@@ -545,42 +719,81 @@ class App(customtkinter.CTk):
         self.ax.autoscale_view()
         self.canvas.draw_idle()
 
-    def cross_sections_plot(self):
+    @profiled_action
+    def stack_plot(self):
+        # heat map of sigma_a (or with "Use McCumber" the McCumber sigma_e) for all spectra of an absorption stack,
+        # the image is updated in place by the sliders
         self.clear_figure()
-        # absorption_depth in cm, accounts for reabsorption in the crystal
+        self.current_plot = "stack"
+        try:
+            lambdas, sigma, label = self.stack_cross_sections()
+        except FileNotFoundError as error:
+            self.ax.text(0.5, 0.5, str(error), transform=self.ax.transAxes, ha="center", wrap=True)
+            self.canvas.draw()
+            return
+
+        stack_values = self.material_dict.get("stack_values", np.arange(sigma.shape[0]))
+        self.stack_image = self.ax.imshow(sigma, aspect="auto", origin="lower", interpolation="nearest", cmap="viridis",
+                                          extent=(lambdas[0], lambdas[-1], stack_values[0], stack_values[-1]))
+        self.stack_colorbar = self.fig.colorbar(self.stack_image, ax=self.ax, label=f"{label} in cm²")
+
+        self.ax.set_xlabel("wavelength in nm")
+        self.ax.set_ylabel(self.material_dict.get("stack_label", "spectrum index"))
+        self.ax.grid(False)
+        if self.show_title.get(): self.ax.set_title(f"absorption stack of {self.material_dict['name']}")
+        self.canvas.draw()
+
+    @profiled_action
+    def update_stack_plot(self):
+        if not hasattr(self, 'stack_image') or self.stack_image not in self.ax.images:
+            return  # plot not initialized yet
+
+        sigma = self.stack_cross_sections()[1]
+        self.stack_image.set_data(sigma)
+        self.stack_image.set_clim(np.nanmin(sigma), np.nanmax(sigma))
+        self.canvas.draw_idle()
 
-        self.sigma_a = calc_absorption(self.material_dict, filter_width=float(self.FF_absorption.get()), savgol_filter_width=int(self.savgol_filter.get()))[0]
+    def stack_cross_sections(self):
+        # (lambdas, M x n cross sections, label) of the stack view, the McCumber relation is applied to all spectra at once
+        lambdas, sigma_a = calc_absorption_stack(self.material_dict, filter_width=float(self.FF_absorption.get()), savgol_filter_width=float(self.savgol_filter_nm.get()))[:2]
+        if not self.use_McCumber.get():
+            return lambdas, sigma_a, "$\\sigma_a$"
+        thermal_energy = kb * self.material_dict.get("temperature", 295)
+        return lambdas, McCumber_relation_stack(self.E_l, self.E_u, lambdas, sigma_a, thermal_energy), "$\\sigma_e$ (McCumber)"
 
-        plot_list = [self.sigma_a]
-        plot_list_labels = [f"$\\sigma_a$ {self.material_dict['name']}"]
-        plot_list_names = ["line_sigma_a", "line_sigma_e"]
+    def pipeline_settings(self):
+        return {"FF_absorption": float(self.FF_absorption.get()), "savgol_filter_nm": float(self.savgol_filter_nm.get()),
+                "use_McCumber": self.use_McCumber.get(), "use_Fuchtbauer": self.use_Fuchtbauer.get(), "average_sigma": self.average_sigma.get(),
+                "MC_central": float(self.MC_central.get()), "MC_width": float(self.MC_width.get())}
 
-        if self.use_Fuchtbauer.get():
-            Fluo = calc_fluorescence(self.material_dict)[0]
-            self.sigma_e = Fuchtbauer_Ladenburg(Fluo, self.material_dict, sigma_a=self.sigma_a, absorption_depth=self.material_dict["absorption_depth"])
-            plot_list += [self.sigma_e]
-            plot_list_labels += [f"$\\sigma_e$ Füchtbauer"]
+    cross_section_lines = {"sigma_a": "line_sigma_a", "sigma_e": "line_sigma_e", "sigma_e_McCumber": "line_sigma_e_McCumber",
+                           "sigma_e_average": "line_sigma_e_average", "sigma_a_average": "line_sigma_a_average"}
+
+    @profiled_action
+    def cross_sections_plot(self):
+        # absorption_depth in cm, accounts for reabsorption in the crystal
+        settings = self.pipeline_settings()
+        self.manifest = RunManifest(self.material_dict, settings)
+        self.sigma_families = getattr(self, "sigma_families", {})
+        results = run_pipeline(self.material_dict, settings, manifest=self.manifest, backend=self.backend, families=self.sigma_families)
+        self.commit_snapshot(results)
+        self.draw_cross_sections(results)
+
+    def draw_cross_sections(self, results):
+        self.clear_figure()
+        self.current_plot = "cross_sections"
+        for key, data in results.items():
+            setattr(self, key, data)
 
         self.ax.set_xlabel("wavelength in nm")
         self.ax.set_ylabel("cross sections in cm²")
         if self.show_title.get(): self.ax.set_title(f"cross sections of {self.material_dict['name']}")
 
         if self.use_McCumber.get():
-            thermal_energy = kb * self.material_dict.get("temperature", 295)  # in eV
-
-            self.sigma_e_McCumber = McCumber_relation(self.E_l, self.E_u, self.sigma_a, thermal_energy)
-            plot_list += [self.sigma_e_McCumber]
-            plot_list_labels += ["$\\sigma_e$ McCumber"]
-            plot_list_names += ["line_sigma_e_McCumber"]
             self.ax.set_ylim(-1e-21,2*np.max(self.sigma_a[:,1]))
 
             if self.use_Fuchtbauer.get() and self.average_sigma.get():
                 self.McCumber_line = self.ax.axvline(self.MC_central.get(), color='red', linestyle='--', lw=0.8)
-                self.sigma_e_average = average_MCcumber_FL(self.material_dict, self.sigma_e, self.sigma_e_McCumber, self.MC_central.get() - self.MC_width.get()/2, self.MC_central.get() + self.MC_width.get()/2)
-                self.sigma_a_average = McCumber_relation(self.E_l, self.E_u, self.sigma_e_average, thermal_energy, inverse_relation=True)
-                plot_list += [self.sigma_e_average, self.sigma_a_average]
-                plot_list_labels += ["$\\sigma_e$ average", "$\\sigma_a$ average"]
-                plot_list_names += ["line_sigma_e_average", "line_sigma_a_average"]
             
             if self.use_Fuchtbauer.get():
                 self.ax.set_ylim(-1e-21,1.3*max(np.max(self.sigma_a[:,1]), np.max(self.sigma_e[:,1])))
@@ -593,31 +806,40 @@ class App(customtkinter.CTk):
                 for E_l in energy_lower:
                     self.ax.axvline(1/(E_u - E_l)*1e7, color='gray', linestyle=':', lw=0.8)
                     
-        for data, label, name in zip(plot_list, plot_list_labels, plot_list_names):
-            setattr(self, name, self.ax.plot(data[:,0], data[:,1], label=label)[0])
+        for key, data in results.items():
+            setattr(self, self.cross_section_lines[key], self.ax.plot(data[:,0], data[:,1], label=cross_section_labels[key].format(name=self.material_dict['name']))[0])
+
+        # A/B overlay: the results of snapshot B dashed in the colors of the current lines
+        snapshot_B = self.snapshots().find(self.snapshot_B.get()) if self.compare_snapshots.get() else None
+        self.line_B = []
+        if snapshot_B is not None:
+            self.line_B = [self.ax.plot(data[:,0], data[:,1], linestyle="--", lw=0.8, color=getattr(self, self.cross_section_lines[key]).get_color() if key in results else None,
+                                        label=cross_section_labels[key].format(name=self.material_dict['name']) + f" (#{snapshot_B.number})")[0] for key, data in snapshot_B.results.items()]
 
         self.legend = self.ax.legend()
         self.legend.set_visible(self.show_legend.get())
         self.canvas.draw()
     
+    @profiled_action
     def update_cross_sections_plot(self):
-        if not hasattr(self, 'line_sigma_a'):
+        if getattr(self, "current_plot", None) == "gain":
+            return self.update_gain_plot()   # the gain depends on the same settings
+        if not hasattr(self, 'line_sigma_a') or self.suspend_updates:
             return  # plot not initialized yet
 
         self.update_material_dictionary(None)
-        if self.use_Fuchtbauer.get():
-            Fluo = calc_fluorescence(self.material_dict)[0]
-            self.sigma_e = Fuchtbauer_Ladenburg(Fluo, self.material_dict, sigma_a=self.sigma_a, absorption_depth=self.material_dict["absorption_depth"])
-            self.line_sigma_e.set_data(self.sigma_e[:,0], self.sigma_e[:,1])
-
-        if self.use_McCumber.get() and self.use_Fuchtbauer.get() and self.average_sigma.get():
-            thermal_energy = kb * self.material_dict.get("temperature", 295)  # in eV
-            # update plot data
-            self.sigma_e_average = average_MCcumber_FL(self.material_dict, self.sigma_e, self.sigma_e_McCumber, self.MC_central.get() - self.MC_width.get()/2, self.MC_central.get() + self.MC_width.get()/2)
-            self.sigma_a_average = McCumber_relation(self.E_l, self.E_u, self.sigma_e_average, thermal_energy, inverse_relation=True)
-            self.line_sigma_e_average.set_data(self.sigma_e_average[:,0], self.sigma_e_average[:,1])
-            self.line_sigma_a_average.set_data(self.sigma_a_average[:,0], self.sigma_a_average[:,1])
+        settings = self.pipeline_settings()
+        self.manifest = RunManifest(self.material_dict, settings)
+        results = run_pipeline(self.material_dict, settings, manifest=self.manifest, backend=self.backend, families=self.sigma_families)
+        self.commit_snapshot(results, delay=self.snapshot_delay)
 
+        # update plot data
+        for key, data in results.items():
+            setattr(self, key, data)
+            if hasattr(self, self.cross_section_lines[key]):
+                getattr(self, self.cross_section_lines[key]).set_data(data[:,0], data[:,1])
+
+        if hasattr(self, 'McCumber_line'):
             # update vertical lines
             val  = float(self.MC_central.get())
 
@@ -628,6 +850,180 @@ class App(customtkinter.CTk):
         self.ax.autoscale_view()
         self.canvas.draw_idle()
  
+    @profiled_action
+    def gain_plot(self):
+        # single pass small signal gain of the pumped crystal for several pump intensities
+        self.clear_figure()
+        self.current_plot = "gain"
+        self.update_material_dictionary(None)
+        self.sigma_families = getattr(self, "sigma_families", {})
+        gain = simulate_gain(self.material_dict, run_pipeline(self.material_dict, self.pipeline_settings(), backend=self.backend, families=self.sigma_families))
+
+        self.line_gain = [self.ax.plot(gain["lambdas"], G, label=f"$I_p$ = {I:g} kW/cm²")[0] for I, G in zip(gain["pump_intensities"], gain["gain"])]
+        self.ax.axhline(1, color='gray', linestyle=':', lw=0.8)
+
+        self.ax.set_xlabel("wavelength in nm")
+        self.ax.set_ylabel("single pass small signal gain")
+        if self.show_title.get(): self.ax.set_title(f"gain of {self.material_dict['name']} (pump at {gain['pump_wavelength']:.1f} nm)")
+        self.legend = self.ax.legend()
+        self.legend.set_visible(self.show_legend.get())
+        self.canvas.draw()
+
+    @profiled_action
+    def update_gain_plot(self):
+        if not hasattr(self, 'line_gain') or self.suspend_updates:
+            return  # plot not initialized yet
+
+        self.update_material_dictionary(None)
+        gain = simulate_gain(self.material_dict, run_pipeline(self.material_dict, self.pipeline_settings(), backend=self.backend, families=self.sigma_families))
+        if len(gain["gain"]) != len(self.line_gain):
+            return self.gain_plot()
+        for line, G in zip(self.line_gain, gain["gain"]):
+            line.set_data(gain["lambdas"], G)
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.canvas.draw_idle()
+
+    # Snapshots: committed cross section states of the session, undo/redo and the A/B overlay redraw the stored results
+    snapshot_delay = 1000   # ms, slider states are committed once they did not change for this time
+
+    def snapshots(self):
+        if getattr(self, "snapshot_history", None) is None:
+            self.snapshot_history = SnapshotHistory()
+        return self.snapshot_history
+
+    def commit_snapshot(self, results, delay=None):
+        self.cancel_snapshot()
+        commit = functools.partial(self.snapshots().commit, self.collect_project_data(), dict(self.material_dict), results)
+        if delay:
+            self.snapshot_job = (self.after(delay, self.flush_snapshot), commit)
+        elif commit() is not None:
+            self.update_snapshot_widgets()
+
+    def cancel_snapshot(self):
+        # returns the commit of a scheduled snapshot, None if there is none
+        job = getattr(self, "snapshot_job", None)
+        self.snapshot_job = None
+        if job is None:
+            return None
+        self.after_cancel(job[0])
+        return job[1]
+
+    def flush_snapshot(self):
+        commit = self.cancel_snapshot()
+        if commit is not None and commit() is not None:
+            self.update_snapshot_widgets()
+
+    def undo_snapshot(self):
+        self.flush_snapshot()
+        self.show_snapshot(self.snapshots().undo())
+
+    def redo_snapshot(self):
+        self.flush_snapshot()
+        self.show_snapshot(self.snapshots().redo())
+
+    def show_snapshot(self, snapshot):
+        # restore the settings of a snapshot and draw its results, nothing is recomputed
+        if snapshot is None:
+            return
+        with self.settings_transaction(recompute=False):
+            self.apply_settings(snapshot.settings)
+        self.material_dict = dict(snapshot.material)
+        self.manifest = None   # the shown results were not computed with the current manifest
+        self.draw_cross_sections(snapshot.results)
+        self.update_snapshot_widgets()
+
+    def compare_snapshot(self):
+        self.flush_snapshot()
+        if self.snapshots().current is None:
+            return self.cross_sections_plot()
+        self.show_snapshot(self.snapshots().current)
+
+    def update_snapshot_widgets(self):
+        history = self.snapshots()
+        labels = history.labels()
+        self.snapshot_B.configure(values=labels if labels else [""])
+        if self.snapshot_B.get() not in labels:
+            self.snapshot_B.set(labels[1] if len(labels) > 1 else "")
+        self.undo_button.configure(state="normal" if history.position > 0 else "disabled")
+        self.redo_button.configure(state="normal" if history.position < len(history.snapshots) - 1 else "disabled")
+
+    prefetch_delay = 1000   # ms after the last interactive action
+
+    def schedule_prefetch(self):
+        if self.prefetch_job is not None:
+            self.after_cancel(self.prefetch_job)
+        self.prefetch_job = self.after(self.prefetch_delay, self.prefetch)
+
+    def prefetch(self):
+        # parse the basedata and spectrum files and compute calc_absorption (as load_material does) for the materials that are likely opened next
+        self.prefetch_job = None
+        if memory_profiler is not None:
+            return   # background allocations would be attributed to the profiled actions
+        materials = list(self.material_list.cget("values"))
+        index = materials.index(self.current_session) if self.current_session in materials else 0
+        neighbours = [materials[i] for i in (index+1, index-1, index+2, index-2) if 0 <= i < len(materials)]
+        candidates = [name for name in neighbours + self.recent_materials + self.project_materials if name in self.materials and name != self.current_session]
+        steps = [(read_measurement_files, {}),
+                 (functools.partial(self.backend.call, calc_absorption), {"filter_width": float(self.FF_absorption.get()), "savgol_filter_width": float(self.savgol_filter_nm.get())})]
+        self.prefetcher.request(candidates, steps)
+
+    def figure_of_merit_window(self):
+        # figures of merit of all materials with the current settings, filtered and sorted in the window
+        window = self.toplevel_window['Figure of Merit']
+        if window is not None and window.winfo_exists():
+            window.focus()
+            return
+
+        window = customtkinter.CTkToplevel(self)
+        window.title("Figures of merit")
+        self.toplevel_window['Figure of Merit'] = window
+        self.merit_rows = figure_of_merit_table(settings={**self.pipeline_settings(), "MC_central": None}, backend=self.backend)
+
+        self.merit_search = App.create_entry(window, row=0, column=0, width=300, placeholder_text="filter, e.g. Yb F_sat<10")
+        self.merit_search.bind("<KeyRelease>", lambda val: self.update_merit_table())
+        self.merit_sort = App.create_combobox(window, values=list(figure_of_merit_columns), column=1, row=0, command=lambda value: self.update_merit_table())
+        self.merit_sort.set("folder_path")
+        self.merit_descending = App.create_switch(window, row=0, column=2, text="descending", command=self.update_merit_table)
+        self.merit_export_button = App.create_button(window, text="export", command=self.export_merit_table, row=0, column=3, width=110, image=self.img_save)
+        self.merit_table = App.create_table(window, width=1300, row=1, column=0, columnspan=4, sticky="nsew")
+        self.merit_table.configure(font=customtkinter.CTkFont(family="Courier", size=12), wrap="none")
+        self.update_merit_table()
+
+    def update_merit_table(self):
+        self.merit_view = select_rows(self.merit_rows, self.merit_search.get(), self.merit_sort.get(), bool(self.merit_descending.get()))
+        self.merit_table.delete("1.0", "end")
+        self.merit_table.insert("1.0", format_table(self.merit_view))
+
+    def export_merit_table(self):
+        file_name = customtkinter.filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("csv", "*.csv"), ("json", "*.json")])
+        if file_name:
+            export_table(file_name, self.merit_view)
+
+    def fit_zero_phonon_line(self):
+        # shift the upper Stark levels such that McCumber and Füchtbauer-Ladenburg agree, basedata.json is only changed on confirmation
+        self.update_material_dictionary(None)
+        sigma_a = self.backend.call(calc_absorption, self.material_dict, filter_width=float(self.FF_absorption.get()), savgol_filter_width=float(self.savgol_filter_nm.get()))[0]
+        Fluo = self.backend.call(calc_fluorescence, self.material_dict, filter_width=self.FF_fluorescence.get())[0]
+        sigma_e = Fuchtbauer_Ladenburg(Fluo, self.material_dict, sigma_a=sigma_a, absorption_depth=self.material_dict["absorption_depth"])
+        try:
+            E_l, E_u, shift, rms = fit_zero_phonon_line(self.material_dict, sigma_a, sigma_e, self.E_l, self.E_u)
+        except ValueError as error:
+            self.fit_ZPL_result.configure(text=str(error))
+            return
+
+        ZPL_old, ZPL_new = 1e7/(self.E_u[0] - self.E_l[0]), 1e7/(E_u[0] - E_l[0])
+        self.fit_ZPL_result.configure(text=f"ZPL {ZPL_old:.2f} → {ZPL_new:.2f} nm ({shift:+.1f} 1/cm), rms {rms:.3f}")
+        self.E_l, self.E_u = E_l, E_u
+        if messagebox.askyesno("Fit ZPL", f"Upper Stark levels shifted by {shift:+.1f} 1/cm, ZPL {ZPL_old:.2f} → {ZPL_new:.2f} nm.\nWrite the levels to basedata.json of {self.material_dict['folder_path']}?", parent=self):
+            write_stark_levels(self.material_dict, E_l, E_u)
+        else:
+            # use the fitted levels in this session only
+            self.material_dict.update(energy_lower_level=list(E_l), energy_upper_level=list(E_u), ZPL=1e-2/(E_u[0] - E_l[0]))
+
+        self.line_transitions.select()
+        self.cross_sections_plot()
+
     def read_file_list(self):
         path = customtkinter.filedialog.askdirectory(initialdir=self.folder_path)
         if path != "":
@@ -658,38 +1054,37 @@ class App(customtkinter.CTk):
         file_name = customtkinter.filedialog.asksaveasfilename()
         if file_name.endswith((".pdf",".png",".jpg",".jpeg",".PNG",".JPG",".svg")): 
             self.fig.savefig(file_name, bbox_inches='tight')
-        elif file_name.endswith((".dat",".txt",".csv")):
-            all_data = []
-            headers = []
-
-            # Collect data
-            for i, ax in enumerate(self.fig.axes):
-                for j, line in enumerate(ax.get_lines()):
-                    label = line.get_label()
-                    if not label or label.startswith('_'): # skip unlabeled lines
-                        continue
-                    label = label.replace("$", "").replace("\\", "").replace(" ","_")
-                    x = line.get_xdata()
-                    y = line.get_ydata()
-                    # make sure lengths match if different lines differ
-                    length = min(len(x), len(y))
-                    all_data.append(np.column_stack([x[:length], y[:length]]))
-                    headers.extend([f"{label}_x", f"{label}_y"])
-
-            # Align all datasets by rows (pad with blanks if needed)
-            max_len = max(arr.shape[0] for arr in all_data)
-            aligned = np.full((max_len, len(all_data)*2), "", dtype=object)
-
-            for k, arr in enumerate(all_data):
-                aligned[:arr.shape[0], 2*k:2*k+2] = arr
-
-            # Write to file
-            with open(file_name, "w") as f:
-                f.write("\t".join(headers) + "\n")
-                for row in aligned:
-                    f.write("\t".join(f"{float(val):.5e}" if val != "" else "" for val in row) + "\n")
-
-    def save_project(self, filename):
+        elif file_name.endswith((".dat",".txt",".csv",".npz",".h5",".hdf5",".parquet")):
+            metadata = {"material": self.material_dict, "settings": self.collect_project_data()}
+            export_lines(file_name, self.collect_lines(), metadata)
+        else:
+            return   # cancelled or unsupported format
+
+        # the run manifest describes the computation of the cross section plot, snapshots and other plots have none
+        if getattr(self, "current_plot", None) == "cross_sections" and getattr(self, "manifest", None) is not None:
+            self.manifest.save(file_name + ".manifest.json")
+
+    def collect_lines(self):
+        # Collect all labelled lines of the current figure as {label: (x, y)}
+        lines = {}
+        for ax in self.fig.axes:
+            for line in ax.get_lines():
+                label = line.get_label()
+                if not label or label.startswith('_'): # skip unlabeled lines
+                    continue
+                label = label.replace("$", "").replace("\\", "").replace(" ","_")
+                x = np.asarray(line.get_xdata(), dtype=float)
+                y = np.asarray(line.get_ydata(), dtype=float)
+                # make sure lengths match if different lines differ
+                length = min(len(x), len(y))
+                # lines with the same label (e.g. in two subplots) get a number, so none is dropped from the export
+                unique_label, number = label, 2
+                while unique_label in lines:
+                    unique_label, number = f"{label}_{number}", number + 1
+                lines[unique_label] = (x[:length], y[:length])
+        return lines
+
+    def collect_project_data(self):
         # collect all data-variables to be saved into a dictionary
         project_data = {}
         for name in self.save_attributes:
@@ -707,27 +1102,44 @@ class App(customtkinter.CTk):
                 value = val.get()
                 project_data[name] = value
 
-        # Read out the variables and convert to JSON-safe dict
-        def to_json_safe(obj):
-            if isinstance(obj, np.ndarray):
-                return obj.tolist()      # convert numpy arrays to lists
-            if isinstance(obj, (np.int64, np.float64)):
-                return obj.item()        # convert numpy scalars to Python
-            if isinstance(obj, dict):
-                return {k: to_json_safe(v) for k, v in obj.items()}
-            if isinstance(obj, list):
-                return [to_json_safe(v) for v in obj]
-            return obj                   # base case
-
-        safe_data = to_json_safe(project_data)
+        return to_json_safe(project_data)
 
+    def save_project(self, filename):
         with open(filename, "w") as f:
-            json.dump(safe_data, f, indent=2)
+            json.dump({**self.collect_project_data(), "sessions": list(self.sessions)}, f, indent=2)
 
     def load_project(self, filename):
         with open(filename, "r") as f:
             data = json.load(f)
 
+        self.project_materials = data.pop("sessions", [data.get("material_list")])
+        if data.get("material_list") in self.materials:
+            self.open_session(data["material_list"])
+        data = migrate_settings(data, self.material_dict)
+        with self.settings_transaction():
+            self.apply_settings(data)
+        self.close_sidebar_window()
+
+    @contextmanager
+    def settings_transaction(self, recompute=True):
+        # suspend the widget callbacks while several settings are applied, afterwards update material_dict and recompute once
+        suspended = self.suspend_updates
+        self.suspend_updates = True
+        try:
+            yield
+        finally:
+            self.suspend_updates = suspended
+        if not suspended:
+            self.update_material_dictionary(None)
+            if recompute:
+                self.refresh_plot()
+
+    def refresh_plot(self):
+        plots = {"fluorescence": self.fluorescence_plot, "absorption": self.absorption_plot, "cross_sections": self.cross_sections_plot, "stack": self.stack_plot, "gain": self.gain_plot}
+        if getattr(self, "current_plot", None) in plots:
+            plots[self.current_plot]()
+
+    def apply_settings(self, data):
         for name, val in data.items():
             if hasattr(self, name):
                 attr = getattr(self, name)
@@ -739,15 +1151,15 @@ class App(customtkinter.CTk):
                     attr.select()
                 elif hasattr(attr, "deselect") and val == 0:
                     attr.deselect()
-        
-        self.close_sidebar_window()
-        self.material_dict["folder_path"] = self.material_list.get()
 
     def update_abs_slider_value(self, value):
+        if self.suspend_updates: return
         self.update_material_dictionary(value)
         self.update_absorption_plot()
+        self.update_stack_plot()
     
     def update_fluo_slider_value(self, value):
+        if self.suspend_updates: return
         self.update_material_dictionary(value)
         self.update_fluorescence_plot()
 
@@ -778,6 +1190,12 @@ class App(customtkinter.CTk):
         try:
             if hasattr(self, "canvas"): self.canvas.get_tk_widget().destroy()
             if hasattr(self, "fig"): plt.close(self.fig)
+            for state in self.sessions.values():
+                if state is not None: plt.close(state["fig"])
+            self.prefetcher.shutdown()
+            if memory_profiler is not None:
+                print("\n".join(memory_profiler.report()))
+                memory_profiler.save(f"memory_profile_{datetime.now():%y%m%d_%H%M%S}.json")
         except:
             pass
         self.quit()    # Python 3.12 works
@@ -810,37 +1228,656 @@ class CustomEntry(customtkinter.CTkEntry):
         self.delete(0, 'end')  # Delete the current text
         self.insert(0, text)  # Insert the new text
 
-def linear(x,a,b):
-    return -a*x+b
+# material parameters read by the cached calculations, the other parameters (e.g. absorption depth, Stark levels) do not change their results
+material_inputs = {"calc_absorption": ("folder_path", "instrument_response", "zero_absorption_wavelength", "zero_absorption_width", "N_dop", "length"),
+                   "calc_absorption_stack": ("folder_path", "instrument_response", "zero_absorption_wavelength", "zero_absorption_width", "N_dop", "length"),
+                   "calc_fluorescence": ("folder_path", "instrument_response", "smoothing_windows")}
+
+def key_value(obj, digits=12):
+    # JSON-safe value with floats rounded to digits significant digits, so values that went through a text entry give the same key
+    obj = to_json_safe(obj)
+    if isinstance(obj, float):
+        return float(f"{obj:.{digits}g}")
+    if isinstance(obj, dict):
+        return {k: key_value(v, digits) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [key_value(v, digits) for v in obj]
+    return obj
+
+def result_nbytes(result):
+    # bytes of the arrays of a result (an array or a tuple/list of arrays and scalars)
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, (tuple, list)):
+        return sum(result_nbytes(item) for item in result)
+    return 0
+
+def array_digest(array):
+    # content key of an array
+    return (hashlib.blake2b(np.ascontiguousarray(array).tobytes(), digest_size=16).hexdigest(), array.shape, array.dtype.str)
+
+class ComputeBackend:
+    """
+    Result cache shared by all sessions and the background prefetch. Results are keyed by the function, the material
+    parameters it reads (material_inputs), the keyword arguments and the sizes/mtimes of the files in the
+    material folder, so switching between materials or settings that were already computed is a dictionary lookup.
+    The folder listing is read once and again after refresh(material), i.e. when a session is opened.
+    The least recently used results are dropped beyond max_entries or max_bytes of arrays.
+    Cached arrays are shared between sessions and must not be modified in place.
+    """
+    def __init__(self, max_entries=256, max_bytes=256*2**20):
+        self.cache = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.folders = {}
+
+    def files(self, material):
+        folder = os.path.join(Standard_path, "measurements", material["folder_path"])
+        with self.lock:
+            files = self.folders.get(folder)
+        if files is None:
+            files = MaterialCatalog.scan_files(folder) if os.path.isdir(folder) else {}
+            with self.lock:
+                self.folders[folder] = files
+        return files
+
+    def refresh(self, material):
+        # read the folder listing again, changed files then give new keys
+        with self.lock:
+            self.folders.pop(os.path.join(Standard_path, "measurements", material["folder_path"]), None)
+
+    def key(self, function, material, kwargs):
+        inputs = material_inputs.get(function.__name__)
+        parameters = {name: material.get(name) for name in inputs} if inputs is not None else material
+        return json.dumps([function.__name__, key_value(parameters), key_value(kwargs), self.files(material)], sort_keys=True, default=str)
+
+    def cached(self, function, material, kwargs):
+        key = self.key(function, material, kwargs)
+        with self.lock:
+            return key in self.cache
+
+    def call(self, function, material, **kwargs):
+        key = self.key(function, material, kwargs)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        result = function(material, **kwargs)
+        with self.lock:
+            if key in self.cache:   # computed by another thread in the meantime
+                self.bytes -= result_nbytes(self.cache[key])
+            self.cache[key] = result
+            self.bytes += result_nbytes(result)
+            while len(self.cache) > 1 and (len(self.cache) > self.max_entries or self.bytes > self.max_bytes):
+                self.bytes -= result_nbytes(self.cache.popitem(last=False)[1])
+        return result
+
+class Prefetcher:
+    """
+    Warms the caches for materials that are likely opened next on a small I/O thread pool: the parsed
+    basedata.json and the results of the requested steps, e.g. the spectrum files (spectrum_cache) and
+    calc_absorption through the ComputeBackend. A new request or cancel() drops the queued materials,
+    running ones stop before their next step (cancel(wait=True) also waits for that step).
+    Nothing is started while usage() - the bytes held by the caches that are warmed - exceeds max_bytes,
+    so the prefetch never grows the caches beyond this budget, however often it is requested.
+    """
+    def __init__(self, max_workers=2, max_bytes=128*2**20, usage=lambda: spectrum_cache.bytes):
+        self.max_bytes = max_bytes
+        self.usage = usage
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.futures = []
+        self.materials = OrderedDict()
+
+    def material(self, material):
+        # material dictionary like read_material, parsed once per modification of basedata.json
+        key = (material, os.stat(os.path.join(Standard_path, "measurements", material, "basedata.json")).st_mtime_ns)
+        with self.lock:
+            material_dict = self.materials.get(key)
+        if material_dict is None:
+            material_dict = read_material(material)
+            with self.lock:
+                self.materials[key] = material_dict
+                while len(self.materials) > 64:
+                    self.materials.popitem(last=False)
+        return copy.deepcopy(material_dict)
+
+    def request(self, materials, steps):
+        # steps: [(function, kwargs)] called as function(material_dict, **kwargs) for every material, in the order of materials
+        self.cancel()
+        with self.lock:
+            generation = self.generation
+        self.futures = [self.pool.submit(self.warm, material, steps, generation) for material in dict.fromkeys(materials)]
+
+    def cancel(self, wait=False):
+        with self.lock:
+            self.generation += 1
+        running = [future for future in self.futures if not future.cancel()]
+        self.futures = []
+        if wait:
+            wait_futures(running)
+
+    def active(self, generation):
+        with self.lock:
+            if generation != self.generation:
+                return False
+        return self.usage() < self.max_bytes
+
+    def warm(self, material, steps, generation):
+        if not self.active(generation):
+            return
+        try:
+            material_dict = self.material(material)
+        except (OSError, ValueError):
+            return
+        for function, kwargs in steps:
+            if not self.active(generation):
+                return
+            try:
+                function(material_dict, **kwargs)
+            except (OSError, ValueError, IndexError):
+                continue   # incomplete measurement folder, the GUI reports it when the material is opened
+
+    def shutdown(self):
+        self.cancel()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+class Snapshot:
+    # committed state of a session: GUI settings, material parameters and references to the computed cross sections
+    def __init__(self, number, settings, material, results, label):
+        self.number = number
+        self.settings = settings
+        self.material = material
+        self.results = results
+        self.time = datetime.now()
+        self.label = f"#{number} {self.time:%H:%M:%S} {label}".strip()
+
+class SnapshotHistory:
+    """
+    Undo/redo history of the committed states of a session. Snapshots reference the computed spectra
+    instead of copying them, arrays with the same content are stored once (keyed by a digest), so
+    stages that did not change between snapshots share their arrays. Committing after an undo discards
+    the redo branch, at most max_snapshots are kept.
+    """
+    def __init__(self, max_snapshots=100):
+        self.snapshots = []
+        self.position = -1
+        self.max_snapshots = max_snapshots
+        self.arrays = {}
+        self.count = 0
+
+    def share(self, array):
+        return self.arrays.setdefault(array_digest(array), array)
+
+    @property
+    def current(self):
+        return self.snapshots[self.position] if self.snapshots else None
+
+    def commit(self, settings, material, results):
+        # returns the new Snapshot, None if the state equals the current snapshot
+        current = self.current
+        if current is not None and current.settings == settings and current.material == material:
+            return None
+        self.count += 1
+        snapshot = Snapshot(self.count, settings, material, {name: self.share(data) for name, data in results.items()}, describe_changes(current.settings if current else {}, settings))
+        del self.snapshots[self.position+1:]
+        self.snapshots.append(snapshot)
+        del self.snapshots[:-self.max_snapshots]
+        self.position = len(self.snapshots) - 1
+        # forget the arrays that are no longer referenced by a snapshot
+        used = {id(data) for snapshot in self.snapshots for data in snapshot.results.values()}
+        self.arrays = {key: data for key, data in self.arrays.items() if id(data) in used}
+        return snapshot
+
+    def undo(self):
+        if self.position <= 0:
+            return None
+        self.position -= 1
+        return self.current
+
+    def redo(self):
+        if self.position >= len(self.snapshots) - 1:
+            return None
+        self.position += 1
+        return self.current
+
+    def find(self, label):
+        return next((snapshot for snapshot in self.snapshots if snapshot.label == label), None)
+
+    def labels(self):
+        # newest first
+        return [snapshot.label for snapshot in reversed(self.snapshots)]
+
+def describe_changes(old, new, limit=2):
+    # short description of the settings that differ, e.g. "MC_width=12 FF_absorption=0.2"
+    changes = [f"{name}={value:.4g}" if isinstance(value, float) else f"{name}={value}" for name, value in new.items() if old.get(name) != value]
+    if not old:
+        return "initial"
+    return " ".join(changes[:limit]) + (" ..." if len(changes) > limit else "")
+
+class MemoryProfiler:
+    """
+    Memory profiling mode: records the allocations of every pipeline stage and plot action with tracemalloc
+    (net and peak bytes, largest allocating source lines) together with the live matplotlib figures and artists.
+    Actions which keep memory or artists in each of their last calls are flagged as possible leaks.
+    The records are saved as json to compare versions with compare_memory_profiles.
+    """
+    def __init__(self, frames=5, top=5):
+        self.top = top
+        self.records = []
+        self.peaks = []   # peak bytes of the enclosing tracked actions
+        tracemalloc.start(frames)
+
+    @contextmanager
+    def track(self, name):
+        outermost = not self.peaks
+        if outermost:
+            gc.collect()
+        before = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], peak)
+        self.peaks.append(0)
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            if outermost:
+                gc.collect()   # count only memory which is still referenced
+            after, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, self.peaks.pop())
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], peak)
+            tracemalloc.reset_peak()
+
+            filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+            statistics = tracemalloc.take_snapshot().filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+            self.records.append({"name": name, "nested": not outermost, "duration": duration,
+                                 "allocated": after - current, "peak": peak - current,
+                                 "top": [f"{stat.traceback[0].filename}:{stat.traceback[0].lineno} {stat.size_diff:+d} B" for stat in statistics[:self.top]],
+                                 **matplotlib_objects()})
+
+    def leaks(self, repeats=3, threshold=65536):
+        # names of actions which retained more than threshold bytes or added artists in each of their last repeats calls
+        records = defaultdict(list)
+        for record in self.records:
+            records[record["name"]].append(record)
+
+        flagged = []
+        for name, calls in records.items():
+            last = calls[-repeats-1:]
+            if len(last) <= repeats:
+                continue
+            growing_memory = all(record["allocated"] > threshold for record in last[1:])
+            growing_artists = all(b["artists"] > a["artists"] for a, b in zip(last, last[1:]))
+            if growing_memory or growing_artists:
+                flagged.append(name)
+        return flagged
+
+    def summary(self):
+        # per action: number of calls, mean net and largest peak allocation in bytes, total time in s
+        summary = {}
+        for record in self.records:
+            entry = summary.setdefault(record["name"], {"calls": 0, "allocated": 0, "peak": 0, "duration": 0})
+            entry["calls"] += 1
+            entry["allocated"] += record["allocated"]
+            entry["peak"] = max(entry["peak"], record["peak"])
+            entry["duration"] += record["duration"]
+        for entry in summary.values():
+            entry["allocated"] /= entry["calls"]
+        return summary
+
+    def report(self):
+        lines = [f"{'action':28s} {'calls':>5s} {'net/call':>10s} {'peak':>10s} {'time':>9s}"]
+        for name, entry in self.summary().items():
+            lines.append(f"{name:28s} {entry['calls']:5d} {entry['allocated']/1024:8.1f} kB {entry['peak']/1024:7.1f} kB {entry['duration']*1e3:6.1f} ms")
+        objects = matplotlib_objects()
+        lines.append(f"live: {objects['figures']} figures ({objects['pyplot_figures']} pyplot), {objects['axes']} axes, {objects['artists']} artists, traced {tracemalloc.get_traced_memory()[0]/1024**2:.1f} MB")
+        for name in self.leaks():
+            lines.append(f"possible leak: {name} keeps memory or artists on every call")
+        if objects["pyplot_figures"]:
+            lines.append(f"possible leak: {objects['pyplot_figures']} pyplot figures are not closed")
+        return lines
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"program_version": version_number, "created": datetime.now().isoformat(timespec="seconds"),
+                       "summary": self.summary(), "leaks": self.leaks(), "records": self.records}, f, indent=2)
+
+def matplotlib_objects():
+    # live matplotlib figures (also those not shown anymore but still referenced) with their axes and artists
+    figures = [obj for obj in gc.get_objects() if isinstance(obj, Figure)]
+    return {"figures": len(figures), "pyplot_figures": len(plt.get_fignums()),
+            "axes": sum(len(fig.axes) for fig in figures), "artists": sum(len(fig.findobj()) for fig in figures)}
+
+def start_memory_profiling(frames=5):
+    global memory_profiler
+    memory_profiler = MemoryProfiler(frames)
+    return memory_profiler
+
+def compare_memory_profiles(old_file, new_file):
+    # compare the per action summaries of two saved memory profiles (e.g. of two program versions)
+    with open(old_file, "r") as f:
+        old = json.load(f)
+    with open(new_file, "r") as f:
+        new = json.load(f)
+
+    lines = [f"{old['program_version']} -> {new['program_version']}"]
+    for name in dict.fromkeys(list(old["summary"]) + list(new["summary"])):
+        a, b = old["summary"].get(name), new["summary"].get(name)
+        if a is None or b is None:
+            lines.append(f"{name:28s} {'only in ' + (old_file if b is None else new_file)}")
+            continue
+        lines.append(f"{name:28s} net/call {a['allocated']/1024:8.1f} -> {b['allocated']/1024:8.1f} kB, peak {a['peak']/1024:8.1f} -> {b['peak']/1024:8.1f} kB")
+    for name in set(new["leaks"]) - set(old["leaks"]):
+        lines.append(f"new possible leak: {name}")
+    return lines
+
+class MaterialCatalog:
+    """
+    Persistent index of all measurement folders, stored as json next to the measurements.
 
-def moving_average(x, window_size):
-    # Ensure the window_size is even
-    if window_size % 2 == 0:
-        half_window = window_size // 2
-    else:
-        half_window = (window_size - 1) // 2
+    Each entry holds the basedata.json values (name, dopant, host, N_dop, ZPL, temperature, ...),
+    the measurement date parsed from the folder name and the size and mtime of every file.
+    update() only re-reads folders whose files changed, query() never touches the folders.
+    """
+    index_name = "material_catalog.json"
+
+    def __init__(self, measurement_path, index_path=None):
+        self.measurement_path = measurement_path
+        self.index_path = index_path or os.path.join(os.path.dirname(measurement_path), self.index_name)
+        self.entries = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r") as file:
+                self.entries = json.load(file)
+
+    @staticmethod
+    def scan_files(folder):
+        return {f.name: [f.stat().st_size, f.stat().st_mtime] for f in os.scandir(folder) if f.is_file()}
+
+    def read_entry(self, folder, name, files):
+        entry = {"folder_path": name, "files": files}
+        try:
+            with open(os.path.join(folder, "basedata.json"), "r") as file:
+                basedata = json.load(file)
+        except (OSError, ValueError):
+            basedata = {}
+
+        entry.update({key: basedata.get(key) for key in ("name", "N_dop", "ZPL", "temperature", "length", "tau_f", "n")})
+        dopant, _, host = (basedata.get("name") or name).partition(":")
+        entry["dopant"] = dopant.strip() if host else None
+        entry["host"] = host.strip() if host else None
+        date = name.split("_")[0]
+        entry["date"] = date if date.isdigit() and len(date) == 6 else None
+        return entry
+
+    def update(self, save=True):
+        # incremental update: only folders with changed file sizes/mtimes are read again
+        changed = False
+        folders = {f.name: f.path for f in os.scandir(self.measurement_path) if f.is_dir()}
+
+        for name in set(self.entries) - set(folders):
+            del self.entries[name]
+            changed = True
+
+        for name, folder in folders.items():
+            files = self.scan_files(folder)
+            if name in self.entries and self.entries[name]["files"] == files:
+                continue
+            self.entries[name] = self.read_entry(folder, name, files)
+            changed = True
+
+        if changed and save:
+            self.save()
+        return changed
+
+    def save(self):
+        try:
+            with open(self.index_path, "w") as file:
+                json.dump(self.entries, file, indent=1)
+        except OSError:
+            pass  # read-only installation, the index is rebuilt in memory next time
+
+    def matches(self, entry, search):
+        # terms like T<300, N>1e26 or date>=241101 compare numbers
+        return matches_search(entry, search, {"T": "temperature", "N": "N_dop", "ZPL": "ZPL", "date": "date"}, ("folder_path", "name", "dopant", "host"))
+
+    def query(self, search="", dopant=None, host=None, temperature=None, date=None, sort_by="folder_path"):
+        """
+        Return the folder names of all materials matching the filters.
+        temperature and date can be given as (min, max) tuples, dates as 'yymmdd' strings.
+        """
+        results = []
+        for entry in self.entries.values():
+            if dopant is not None and entry["dopant"] != dopant: continue
+            if host is not None and entry["host"] != host: continue
+            if temperature is not None and not (entry["temperature"] is not None and temperature[0] <= entry["temperature"] <= temperature[1]): continue
+            if date is not None and not (entry["date"] is not None and date[0] <= entry["date"] <= date[1]): continue
+            if search and not self.matches(entry, search): continue
+            results.append(entry)
+
+        results.sort(key=lambda entry: (entry.get(sort_by) is None, entry.get(sort_by) or 0))
+        return [entry["folder_path"] for entry in results]
+
+def matches_search(entry, search, keys, text_keys):
+    # every whitespace separated term has to match: key<value, key>=value, ... compare the number entry[keys[key]],
+    # other terms have to appear in one of the text_keys values
+    for term in search.split():
+        for op in ("<=", ">=", "<", ">", "="):
+            key, found, value = term.partition(op)
+            if found and key in keys:
+                entry_value = entry.get(keys[key])
+                try:
+                    a, b = float(entry_value), float(value)
+                except (TypeError, ValueError):
+                    return False
+                if not {"<=": a <= b, ">=": a >= b, "<": a < b, ">": a > b, "=": a == b}[op]:
+                    return False
+                break
+        else:
+            text = " ".join(str(entry.get(key) or "") for key in text_keys).lower()
+            if term.lower() not in text:
+                return False
+    return True
+
+def to_json_safe(obj):
+    # Read out the variables and convert to JSON-safe dict
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()      # convert numpy arrays to lists
+    if isinstance(obj, (np.integer, np.floating)):
+        return obj.item()        # convert numpy scalars to Python
+    if isinstance(obj, dict):
+        return {k: to_json_safe(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_json_safe(v) for v in obj]
+    return obj                   # base case
+
+def pad_columns(lines):
+    # Align all datasets by rows in one float array, missing values are NaN
+    max_len = max((len(x) for x, _ in lines.values()), default=0)
+    aligned = np.full((max_len, 2*len(lines)), np.nan)
+    for k, (x, y) in enumerate(lines.values()):
+        aligned[:len(x), 2*k] = x
+        aligned[:len(y), 2*k+1] = y
+    headers = [f"{label}_{axis}" for label in lines for axis in ("x", "y")]
+    return aligned, headers
+
+def export_lines(file_name, lines, metadata=None):
+    """
+    Write labelled lines {label: (x, y)} in one call, the format is chosen by the file extension.
+
+    .npz            numpy archive, one array per column plus the metadata as JSON string
+    .h5 / .hdf5     one group per line with x and y datasets, metadata as JSON attributes (needs h5py)
+    .parquet        NaN-padded columns, metadata stored in the schema (needs pyarrow)
+    .dat/.txt/.csv  tab separated text, the cells below the end of shorter lines are left blank
+    """
+    metadata = json.dumps(to_json_safe(metadata or {}))
+    extension = os.path.splitext(file_name)[1].lower()
+
+    if extension == ".npz":
+        columns = {f"{label}_{axis}": data for label, xy in lines.items() for axis, data in zip("xy", xy)}
+        np.savez_compressed(file_name, metadata=np.array(metadata), **columns)
+
+    elif extension in (".h5", ".hdf5"):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("HDF5 export requires the h5py package: python -m pip install h5py")
+        with h5py.File(file_name, "w") as f:
+            f.attrs["metadata"] = metadata
+            for label, (x, y) in lines.items():
+                group = f.create_group(label.replace("/", "_"))
+                group.create_dataset("x", data=x, compression="gzip")
+                group.create_dataset("y", data=y, compression="gzip")
+
+    elif extension == ".parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet export requires the pyarrow package: python -m pip install pyarrow")
+        aligned, headers = pad_columns(lines)
+        table = pa.Table.from_arrays([pa.array(column) for column in aligned.T], names=headers)
+        table = table.replace_schema_metadata({"metadata": metadata})
+        pq.write_table(table, file_name)
 
-    if window_size <= 1:
-        return x
+    else:
+        write_text_columns(file_name, [np.asarray(data, dtype=float) for xy in lines.values() for data in xy],
+                           [f"{label}_{axis}" for label in lines for axis in ("x", "y")])
+
+def write_text_columns(file_name, columns, headers, block_rows=8192):
+    # tab separated columns of different lengths, the cells below the end of a column are left blank.
+    # Between two column ends the same columns are present, so these rows share one row format and are written in blocks.
+    ends = sorted({0, *(len(column) for column in columns)})
+    with open(file_name, "w") as f:
+        f.write("\t".join(headers) + "\n")
+        for start, stop in zip(ends[:-1], ends[1:]):
+            present = [column for column in columns if len(column) >= stop]
+            row_format = "\t".join("%.5e" if len(column) >= stop else "" for column in columns) + "\n"
+            for block in range(start, stop, block_rows):
+                rows = np.column_stack([column[block:min(block + block_rows, stop)] for column in present])
+                f.writelines(row_format % tuple(row) for row in rows.tolist())
 
-    half_window = window_size // 2
-    cumsum = np.cumsum(x)
+def linear(x,a,b):
+    return -a*x+b
 
-    # Calculate the sum of elements for each centered window
-    cumsum[window_size:] = cumsum[window_size:] - cumsum[:-window_size]
-    centered_sums = cumsum[window_size - 1:-1]
+def make_spectrum(x, y, dtype=np.float64):
+    # allocate a (n,2) spectrum with contiguous columns in one go, instead of np.vstack([x, y]).T
+    spectrum = np.empty((2, len(x)), dtype=dtype).T
+    spectrum[:,0] = x
+    spectrum[:,1] = y
+    return spectrum
 
-    # Divide each sum by the window size to get the centered moving average
-    smoothed_array = centered_sums / window_size
+class SpectrumDialect:
+    """
+    Layout of a spectrum text file of one instrument: detect(first_line) recognizes the file,
+    header_lines are skipped before the data, the columns are separated by delimiter.
+    """
+    def __init__(self, name, detect, header_lines=0, delimiter=","):
+        self.name = name
+        self.detect = detect
+        self.header_lines = header_lines
+        self.delimiter = delimiter
+
+# tried in this order, the last one (no header) accepts every file
+spectrum_dialects = [SpectrumDialect("comment header", lambda line: line.startswith("#"), header_lines=1),
+                     SpectrumDialect("IstTemp header", lambda line: line.startswith("IstTemp"), header_lines=2),
+                     SpectrumDialect("plain", lambda line: True)]
+
+def register_spectrum_dialect(dialect):
+    # dialects of other instruments are tried before the built-in ones
+    spectrum_dialects.insert(0, dialect)
+
+def detect_dialect(file):
+    with open(file, "r") as f:
+        first_line = f.readline()
+    return next(dialect for dialect in spectrum_dialects if dialect.detect(first_line))
+
+def read_spectrum_file(file, dialect=None):
+    """
+    Read all columns of a spectrum text file (n x columns) with the vectorized np.loadtxt parser,
+    about 10x faster than np.genfromtxt. The dialect is detected from the first line if not given.
+    Raises ValueError if a value is missing (NaN) or the wavelengths are not strictly increasing.
+    """
+    dialect = dialect or detect_dialect(file)
+    data = np.loadtxt(file, delimiter=dialect.delimiter, skiprows=dialect.header_lines, ndmin=2)
+    if np.isnan(data).any():
+        row = np.flatnonzero(np.isnan(data).any(axis=1))[0]
+        raise ValueError(f"{file}: missing value in data row {row+1}")
+    if np.any(np.diff(data[:,0]) <= 0):
+        row = np.flatnonzero(np.diff(data[:,0]) <= 0)[0]
+        raise ValueError(f"{file}: wavelengths not increasing at data row {row+2}")
+    return data
+
+class SpectrumCache:
+    """
+    Parsed spectrum files keyed by path, size and modification time, so a file is parsed once however
+    often (and from whichever thread) it is loaded. The least recently used files are dropped beyond
+    max_bytes. read(file) returns the wavelengths (n, float64) and the signal columns (columns x n, compute_dtype).
+    The cached arrays are read-only and shared, callers copy what they modify.
+    """
+    def __init__(self, max_bytes=256*2**20):
+        self.entries = OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def read(self, file):
+        stat = os.stat(file)
+        key = (os.path.abspath(file), stat.st_size, stat.st_mtime_ns, np.dtype(compute_dtype).str)
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                return data
+
+        columns = read_spectrum_file(file)
+        data = (np.ascontiguousarray(columns[:,0]), np.array(columns[:,1:].T, dtype=compute_dtype, order="C"))
+        del columns
+        for array in data:
+            array.setflags(write=False)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = data
+                self.bytes += result_nbytes(data)
+                while self.bytes > self.max_bytes and len(self.entries) > 1:
+                    self.bytes -= result_nbytes(self.entries.popitem(last=False)[1])
+        return data
 
-    # Pad the beginning and end of the smoothed array with the first and last values of x
-    first_value = np.repeat(x[0], half_window)
-    last_value = np.repeat(x[-1], half_window)
-    smoothed_array = np.concatenate((first_value, smoothed_array, last_value))
+spectrum_cache = SpectrumCache()
 
-    return smoothed_array
+def load_spectrum(file):
+    lambdas, signals = spectrum_cache.read(file)
+    return make_spectrum(lambdas, signals[0])
 
-def fourier_filter(data, filter_width, Do_plots = False):
+def measurement_files(material, kind):
+    """
+    Sorted spectrum files (*.txt) of one kind in the material folder: "absorption" (without reference and stack files),
+    "reference", "fluorescence" or "stack". The file names are matched case-insensitively.
+    """
+    path = os.path.join(Standard_path, "measurements", material["folder_path"])
+    files = sorted(f.path for f in os.scandir(path) if f.is_file() and f.name.endswith(".txt") and kind in f.name.lower())
+    if kind == "absorption":
+        files = [f for f in files if "reference" not in os.path.basename(f).lower() and "stack" not in os.path.basename(f).lower()]
+    return files
+
+def read_measurement_files(material, kinds=("absorption", "reference", "fluorescence")):
+    # parse the spectrum files of a material into the spectrum cache
+    return [spectrum_cache.read(file) for kind in kinds for file in measurement_files(material, kind)]
+
+def trim_spectrum(spectrum, x_min, x_max):
+    # view (no copy) of the monotonic spectrum within [x_min, x_max]
+    start = np.searchsorted(spectrum[:,0], x_min, side="left")
+    stop = np.searchsorted(spectrum[:,0], x_max, side="right")
+    return spectrum[start:stop]
+
+def fourier_filter(data, filter_width, Do_plots = False, inplace = False):
     
     if filter_width == 0:
         return data
@@ -864,41 +1901,183 @@ def fourier_filter(data, filter_width, Do_plots = False):
         ax2.plot(data[:,0], data[:,1])
         ax2.plot(data[:,0], filtered_data)
     
-    return np.vstack([data[:,0], filtered_data]).T
+    if inplace:
+        data[:,1] = filtered_data
+        return data
+    return make_spectrum(data[:,0], filtered_data)
+
+def fourier_filter_values(values, filter_width):
+    # same filter as fourier_filter along the last axis, values can be a stack of spectra (M x n)
+    if filter_width == 0:
+        return values
+
+    fft = np.fft.fft(values, axis=-1)
+    mid_index = int(values.shape[-1]/2)
+    fft[..., mid_index-int(filter_width*mid_index):mid_index+int(filter_width*mid_index)] = 0
+    return np.fft.ifft(fft, axis=-1).real
+
+##########################################################################
+# Smoothing: Savitzky-Golay filters with the window given in nm
+##########################################################################
+
+fft_kernel_size = 128   # kernels with at least this many samples are applied with FFT (overlap-add), shorter ones directly
+
+def window_samples(window, step):
+    # odd number of samples of a window [nm] (distance between the outermost samples) on a grid with step [nm]
+    return 2*int(round(window/(2*step))) + 1
+
+@functools.lru_cache(maxsize=64)
+def savgol_kernels(samples, order):
+    """
+    Savitzky-Golay coefficients of a window with samples points: the kernel for all points with a full window, the
+    least squares fit (order+1 x samples) of the polynomial to a window and its values at the first/last samples//2
+    points (samples//2 x order+1), as mode="interp" of scipy.signal.savgol_filter. The memory grows linearly with samples.
+    """
+    half = samples // 2
+    kernel = savgol_coeffs(samples, order, use="dot")
+    x = (np.arange(samples) - half) / max(half, 1)
+    vandermonde = np.vander(x, order + 1, increasing=True)
+    fit = np.linalg.pinv(vandermonde)
+    left, right = vandermonde[:half], vandermonde[samples-half:]
+    for array in (kernel, fit, left, right):
+        array.flags.writeable = False
+    return kernel, fit, left, right
+
+def savgol_smooth(values, samples, order=3):
+    """
+    Savitzky-Golay filter along the last axis of one spectrum (n) or a stack of spectra (M x n), equal to
+    scipy.signal.savgol_filter(values, samples, order, axis=-1) but with cached coefficients.
+    Windows with samples <= order leave the values unchanged, windows longer than the spectrum are shortened.
+    """
+    n = values.shape[-1]
+    samples = min(samples, n if n % 2 else n - 1)
+    if samples <= order:
+        return values.copy()
+
+    kernel, fit, left, right = savgol_kernels(samples, order)
+    half = samples // 2
+    smoothed = np.empty_like(values)
+    if samples >= fft_kernel_size:
+        smoothed[..., half:n-half] = oaconvolve(values, kernel[::-1].reshape((1,)*(values.ndim-1) + (-1,)).astype(values.dtype), mode="valid", axes=-1)
+    else:
+        smoothed[..., half:n-half] = correlate1d(values, kernel, axis=-1, mode="constant")[..., half:n-half]
+    smoothed[..., :half] = (values[..., :samples] @ fit.T) @ left.T
+    smoothed[..., n-half:] = (values[..., n-samples:] @ fit.T) @ right.T
+    return smoothed
+
+def smooth_spectrum(lambdas, values, window, order=3):
+    # Savitzky-Golay filter with the window in nm (on the mean grid step of lambdas), order 0 is a moving average
+    if len(lambdas) < 2:
+        return values.copy()
+    step = (lambdas[-1] - lambdas[0]) / (len(lambdas) - 1)
+    return savgol_smooth(values, window_samples(window, step), order)
+
+##########################################################################
+# Instrument response: deconvolution of the spectrometer resolution
+##########################################################################
+
+@functools.lru_cache(maxsize=32)
+def response_transfer_function(size, step, fwhm, shape="gaussian"):
+    # rfft of the normalized point spread function (fwhm and step in nm) on a periodic grid with size points
+    offsets = np.minimum(np.arange(size), size - np.arange(size)) * step
+    if shape == "gaussian":
+        psf = np.exp(-offsets**2 / (2*(fwhm/(2*np.sqrt(2*np.log(2))))**2))
+    elif shape == "lorentzian":
+        psf = 1 / (1 + (2*offsets/fwhm)**2)
+    else:
+        raise ValueError(f"Unknown instrument response shape '{shape}', use 'gaussian' or 'lorentzian'.")
+    transfer_function = np.fft.rfft(psf / np.sum(psf))
+    transfer_function.flags.writeable = False
+    return transfer_function
+
+def deconvolve(values, step, fwhm, shape="gaussian", method="wiener", noise=1e-3, iterations=30, floor=1e-6):
+    """
+    Remove the instrument response (point spread function with fwhm in nm) from one spectrum (n) or a stack (M x n)
+    on a uniform grid with step in nm.
+    method "wiener": regularized inverse filter, noise is the noise to signal power ratio.
+    method "richardson_lucy": iterative positive deconvolution with the given number of iterations.
+    The spectra are extended with their edge values by 4 fwhm against wrap-around. The result is at least floor times
+    the maximum of each spectrum, so the ringing of the inverse filter cannot make the logarithm of sigma_a undefined.
+    """
+    n = values.shape[-1]
+    pad = min(n, int(np.ceil(4*fwhm/step)))
+    size = next_fast_len(n + 2*pad, real=True)
+    padded = np.pad(values, [(0, 0)]*(values.ndim-1) + [(pad, size - n - pad)], mode="edge")
+    transfer_function = response_transfer_function(size, float(step), float(fwhm), shape)
+    minimum = floor * np.max(np.abs(values), axis=-1, keepdims=True)
+
+    if method == "wiener":
+        restored = np.fft.irfft(np.fft.rfft(padded) * np.conj(transfer_function) / (np.abs(transfer_function)**2 + noise), size)
+    elif method == "richardson_lucy":
+        observed = np.maximum(padded, minimum)
+        restored = observed.copy()
+        for _ in range(iterations):
+            blurred = np.fft.irfft(np.fft.rfft(restored) * transfer_function, size)
+            restored *= np.fft.irfft(np.fft.rfft(observed / np.maximum(blurred, minimum)) * np.conj(transfer_function), size)
+    else:
+        raise ValueError(f"Unknown deconvolution method '{method}', use 'wiener' or 'richardson_lucy'.")
+    return np.maximum(restored[..., pad:pad+n], minimum)
+
+def instrument_response(material, file):
+    """
+    Response function of the instrument which measured file, from the basedata key "instrument_response":
+    either one response for all files {"fwhm": 0.5, ...} or one per instrument {"ando": {...}, "yoko": {...}},
+    where the instrument name has to appear in the file name. None if the file is not deconvolved.
+    """
+    responses = material.get("instrument_response")
+    if not responses:
+        return None
+    if "fwhm" in responses:
+        return responses
+    name = os.path.basename(file).lower()
+    return next((response for instrument, response in responses.items() if instrument.lower() in name), None)
+
+def load_spectra(material, files):
+    # load spectra and deconvolve their instrument responses, all spectra with the same grid and response in one batch
+    spectra = [load_spectrum(f) for f in files]
+    batches = defaultdict(list)
+    for index, file in enumerate(files):
+        response = instrument_response(material, file)
+        if response is not None:
+            spectrum = spectra[index]
+            step = (spectrum[-1,0] - spectrum[0,0]) / (len(spectrum) - 1)
+            batches[(len(spectrum), round(step, 9), json.dumps(response, sort_keys=True))].append(index)
+
+    for (n, step, response), indices in batches.items():
+        restored = deconvolve(np.array([spectra[i][:,1] for i in indices]), step, **json.loads(response))
+        for i, values in zip(indices, restored):
+            spectra[i][:,1] = values
+    return spectra
 
 def normalize(array):
     return array / (np.sum(array))
 
 def calc_fluorescence(material, filter_width=0.6):
-    path = os.path.join(Standard_path, "measurements", material["folder_path"])
     Fluo_low = None
     Fluo_high = None
     
-    fluorescence_files = glob.glob(os.path.join(path, '*fluorescence*.txt'))
-    
+    fluorescence_files = measurement_files(material, "fluorescence")
+    if len(fluorescence_files) == 0:
+        raise FileNotFoundError(f"No fluorescence file (*fluorescence*.txt) found for {material['folder_path']}.")
+
+    fluorescence_spectra = load_spectra(material, fluorescence_files[:2])
     if len(fluorescence_files) == 1:
-        Fluo = np.genfromtxt(fluorescence_files[0], skip_header=2, delimiter=",")
+        Fluo = fluorescence_spectra[0]
 
     else: 
-        fluo_low_name = fluorescence_files[0]
-        fluo_high_name = fluorescence_files[1]
-        Fluo_low = np.genfromtxt(fluo_low_name, skip_header=2, delimiter=",")
-        Fluo_high = np.genfromtxt(fluo_high_name, skip_header=2, delimiter=",")
-
-        Fluo_low[:,1] = normalize(Fluo_low[:,1])
-        Fluo_high[:,1] = normalize(Fluo_high[:,1])
-        Fluo = Fluo_low.copy()
-
-        for i, (low, high) in enumerate(zip(Fluo_low[:,1], Fluo_high[:,1])):  
-            if abs(high - low) > 1e-5: 
-                Fluo[i,1] = min(low,high)
+        Fluo_low, Fluo_high = fluorescence_spectra
+
+        Fluo_low[:,1] /= np.sum(Fluo_low[:,1])
+        Fluo_high[:,1] /= np.sum(Fluo_high[:,1])
+
+        low, high = Fluo_low[:,1], Fluo_high[:,1]
+        Fluo = make_spectrum(Fluo_low[:,0], np.where(np.abs(high - low) > 1e-5, np.minimum(low, high), low))
     
-    average_interval = find_interval(Fluo[:,0], 990, 1150)
-    average_interval2 = find_interval(Fluo[:,0], 1000, 1060)
-    Fluo[average_interval,1] = moving_average(Fluo[average_interval,1], 4)
-    Fluo[average_interval2,1] = moving_average(Fluo[average_interval2,1], 6)
-    Fluo[:,1] = normalize(Fluo[:,1])
-    Fluo = fourier_filter(Fluo, filter_width = filter_width)
+    for lmin, lmax, window in material.get("smoothing_windows", default_smoothing_windows):
+        average_interval = find_interval(Fluo[:,0], lmin, lmax)
+        Fluo[average_interval,1] = smooth_spectrum(Fluo[average_interval,0], Fluo[average_interval,1], window, order=0)
+    Fluo[:,1] /= np.sum(Fluo[:,1])
+    Fluo = fourier_filter(Fluo, filter_width = filter_width, inplace = True)
 
     return Fluo, Fluo_low, Fluo_high
 
@@ -925,37 +2104,52 @@ def calc_cubic_interpolation(absorption, reference, zero_absorption_width, mid_l
         Interpolated values of the cubic polynomial evaluated over absorption[:,0].
     """
     dlambda = absorption[1,0] - absorption[0,0]
-    w = int(zero_absorption_width / dlambda)  # Convert width in nm to number of pixels
     n = len(absorption)
-    mid_idx1 = np.argmin(np.abs(absorption[:,0] - mid_lambda1))
-    mid_idx2 = np.argmin(np.abs(absorption[:,0] - mid_lambda2)) if mid_lambda2 != np.inf else len(absorption) - 1
+    axis = wavelength_axis(absorption[:,0])
+    mid_idx1 = axis.index(mid_lambda1)
+    mid_idx2 = axis.index(mid_lambda2) if mid_lambda2 != np.inf else len(absorption) - 1
 
-    # Handle default special case: only use end section if w == 0
-    if w == 0:
-        y1 = absorption[mid_idx1, 1]/reference[mid_idx1, 1]
-        y2 = absorption[mid_idx2, 1]/reference[mid_idx2, 1]
+    w, regions = zero_absorption_regions(n, dlambda, zero_absorption_width, mid_idx1, mid_idx2)
+    ratio = baseline_ratio(w, mid_idx1, mid_idx2, [(absorption[region], reference[region]) for region in regions])
 
-        if mid_idx1 == mid_idx2: return y1  # both indices are the same
-        
-        x = np.arange(n)
-        return y1 + (x-mid_idx1) * (y2 - y1) / (mid_idx2 - mid_idx1)
-        # return np.mean(absorption[-10:,1]) / np.mean(reference[-10:,1])
+    return ratio(np.arange(n), absorption[:,0])
+
+def zero_absorption_regions(n, dlambda, zero_absorption_width, mid_idx1, mid_idx2):
+    # index slices of the zero absorption regions used by baseline_ratio
+    w = int(zero_absorption_width / dlambda)  # Convert width in nm to number of pixels
+    if w == 0:
+        return w, [slice(mid_idx1, mid_idx1+1), slice(mid_idx2, mid_idx2+1)]
 
     # Define start and end slices for both regions
     region1 = slice(max(0, mid_idx1 - w//2), min(n, mid_idx1 + w//2))
     region2 = slice(max(0, mid_idx2 - w//2), min(n, mid_idx2 + w//2))
+    return w, [region1, region2]
+
+def baseline_ratio(w, mid_idx1, mid_idx2, regions):
+    """
+    Return the function ratio(index, wavelength) calibrating the reference to the absorption measurement,
+    regions is a list of the (absorption, reference) rows within both zero_absorption_regions.
+    """
+    # Handle default special case: only use end section if w == 0
+    if w == 0:
+        (absorption1, reference1), (absorption2, reference2) = regions
+        y1 = absorption1[0, 1]/reference1[0, 1]
+        y2 = absorption2[0, 1]/reference2[0, 1]
+
+        if mid_idx1 == mid_idx2: return lambda index, x: y1  # both indices are the same
+        
+        return lambda index, x: y1 + (index-mid_idx1) * (y2 - y1) / (mid_idx2 - mid_idx1)
 
     # Subdivide each region into two averaged sections (for total of 4 interpolation points)
-    def region_points(region):
-        idx = np.arange(region.start, region.stop)
-        sublen = max(1, len(idx) // 5)
-        y1 = np.mean(absorption[idx[:sublen],1]) / np.mean(reference[idx[:sublen],1])
-        y2 = np.mean(absorption[idx[-sublen:],1]) / np.mean(reference[idx[-sublen:],1])
-        x1 = np.mean(absorption[idx[:sublen],0])
-        x2 = np.mean(absorption[idx[-sublen:],0])
+    def region_points(absorption, reference):
+        sublen = max(1, len(absorption) // 5)
+        y1 = np.mean(absorption[:sublen,1]) / np.mean(reference[:sublen,1])
+        y2 = np.mean(absorption[-sublen:,1]) / np.mean(reference[-sublen:,1])
+        x1 = np.mean(absorption[:sublen,0])
+        x2 = np.mean(absorption[-sublen:,0])
         return [(x1, y1), (x2, y2)]
 
-    points = region_points(region1) + region_points(region2)
+    points = region_points(*regions[0]) + region_points(*regions[1])
     x_values, y_values = np.array(points).T
 
     # Solve cubic polynomial
@@ -963,18 +2157,15 @@ def calc_cubic_interpolation(absorption, reference, zero_absorption_width, mid_l
     coefficients = np.linalg.solve(A, y_values)
     poly = np.polynomial.Polynomial(coefficients[::-1])
 
-    return poly(absorption[:,0])
+    return lambda index, x: poly(x)
 
-def calc_absorption(material, filter_width = 0, savgol_filter_width = 20, savgol_filter_order=3):
-    path = os.path.join(Standard_path, "measurements", material["folder_path"])
+def calc_absorption(material, filter_width = 0, savgol_filter_width = 4, savgol_filter_order=3):
 
-    absorption_files = [f for f in glob.glob(os.path.join(path, '*absorption*.txt')) if 'reference' not in f.lower()]
-    reference_files = glob.glob(os.path.join(path, '*reference*.txt'))
+    absorption_files = measurement_files(material, "absorption")
+    reference_files = measurement_files(material, "reference")
 
-    load_txt = lambda f: np.genfromtxt(f, skip_header=2, delimiter=",")
-
-    absorption_spectra = [load_txt(f) for f in absorption_files]
-    reference_spectra = [load_txt(f) for f in reference_files]
+    spectra = load_spectra(material, absorption_files + reference_files)
+    absorption_spectra, reference_spectra = spectra[:len(absorption_files)], spectra[len(absorption_files):]
 
     absorption = join_spectra(absorption_spectra) if len(absorption_spectra) > 1 else absorption_spectra[0]
     reference  = join_spectra(reference_spectra)  if len(reference_spectra)  > 1 else reference_spectra[0]
@@ -983,17 +2174,17 @@ def calc_absorption(material, filter_width = 0, savgol_filter_width = 20, savgol
     x_min = max(absorption[:,0].min(), reference[:,0].min())
     x_max = min(absorption[:,0].max(), reference[:,0].max())
 
-    # Trim to overlapping region
-    absorption = absorption[(absorption[:,0] >= x_min) & (absorption[:,0] <= x_max)]
-    reference = reference[(reference[:,0] >= x_min) & (reference[:,0] <= x_max)]
+    # Trim to overlapping region (views, the loaded arrays are not used elsewhere)
+    absorption = trim_spectrum(absorption, x_min, x_max)
+    reference = trim_spectrum(reference, x_min, x_max)
 
     if absorption.shape[0] != reference.shape[0]:
         # Interpolate to common x-values
-        reference_interp = np.interp(absorption[:,0], reference[:,0], reference[:,1])
-        reference = np.vstack([absorption[:,0], reference_interp]).T
+        reference_interp = resample(reference[:,1], reference[:,0], absorption[:,0], edges="hold")
+        reference = make_spectrum(absorption[:,0], reference_interp)
 
-    reference = fourier_filter(reference, filter_width = filter_width)
-    absorption = fourier_filter(absorption, filter_width = filter_width)
+    reference = fourier_filter(reference, filter_width = filter_width, inplace = True)
+    absorption = fourier_filter(absorption, filter_width = filter_width, inplace = True)
     
     mid_wavelength = material.get("zero_absorption_wavelength")
     # ratio = np.mean(absorption[-20:,1]) / np.mean(reference[-20:,1])
@@ -1002,19 +2193,94 @@ def calc_absorption(material, filter_width = 0, savgol_filter_width = 20, savgol
     # print(ratio)
     reference[:,1] *= ratio
     
-    # Calculate the Absorption 
-    sigma_a = np.abs(np.log(reference[:,1]/absorption[:,1]))/(material["N_dop"]*1e-6*material["length"]*1e2)
-
-    if savgol_filter_width > savgol_filter_order:
-        sigma_a = savgol_filter(sigma_a, savgol_filter_width, savgol_filter_order)
+    # Calculate the Absorption (in place in the result column)
+    sigma_a = make_spectrum(absorption[:,0], reference[:,1])
+    sigma_a[:,1] /= absorption[:,1]
+    np.log(sigma_a[:,1], out=sigma_a[:,1])
+    np.abs(sigma_a[:,1], out=sigma_a[:,1])
+    sigma_a[:,1] /= material["N_dop"]*1e-6*material["length"]*1e2
+
+    sigma_a[:,1] = smooth_spectrum(sigma_a[:,0], sigma_a[:,1], savgol_filter_width, savgol_filter_order)
     
-    return np.vstack([absorption[:,0], sigma_a]).T, absorption, reference, ratio
+    return sigma_a, absorption, reference, ratio
+
+def load_spectrum_stack(file):
+    # stack file: wavelength column followed by M signal columns -> (lambdas, M x n matrix in compute_dtype, read-only)
+    return spectrum_cache.read(file)
+
+def calc_absorption_stack(material, filter_width = 0, savgol_filter_width = 4, savgol_filter_order=3):
+    """
+    calc_absorption for a stack of M absorption spectra (temperature ramp, pump-probe delays, spatial scan)
+    measured against one reference. The stack is read from *stack*.txt in the material folder.
+
+    Returns
+    -------
+    lambdas (n), sigma_a (M x n), absorption (M x n), reference (n), ratio (M x n or M x 1)
+    """
+    path = os.path.join(Standard_path, "measurements", material["folder_path"])
+    stack_files = measurement_files(material, "stack")
+    reference_files = measurement_files(material, "reference")
+    if len(stack_files) == 0:
+        raise FileNotFoundError(f"No absorption stack (*stack*.txt) found in {path}.")
+
+    lambdas, absorption = load_spectrum_stack(stack_files[0])
+    response = instrument_response(material, stack_files[0])
+    if response is not None:
+        absorption = deconvolve(absorption, (lambdas[-1] - lambdas[0]) / (len(lambdas) - 1), **response)
+    reference_spectra = load_spectra(material, reference_files)
+    reference = join_spectra(reference_spectra) if len(reference_spectra) > 1 else reference_spectra[0]
+
+    # Trim to overlapping region
+    x_min = max(lambdas.min(), reference[:,0].min())
+    x_max = min(lambdas.max(), reference[:,0].max())
+    trim = slice(np.searchsorted(lambdas, x_min, side="left"), np.searchsorted(lambdas, x_max, side="right"))
+    lambdas, absorption = lambdas[trim], absorption[:,trim]
+    reference = trim_spectrum(reference, x_min, x_max)
+    reference = resample(reference[:,1], reference[:,0], lambdas, edges="hold") if len(reference) != len(lambdas) else reference[:,1]
+
+    reference = fourier_filter_values(reference, filter_width)
+    absorption = fourier_filter_values(absorption, filter_width)
+
+    # broadcasted baseline: one ratio per spectrum of the stack
+    n = len(lambdas)
+    mid_lambda1, mid_lambda2 = material.get("zero_absorption_wavelength")
+    axis = wavelength_axis(lambdas)
+    mid_idx1 = axis.index(mid_lambda1)
+    mid_idx2 = axis.index(mid_lambda2) if mid_lambda2 != np.inf else n - 1
+    w, regions = zero_absorption_regions(n, lambdas[1] - lambdas[0], material['zero_absorption_width'], mid_idx1, mid_idx2)
+
+    if w == 0:
+        y1 = absorption[:,mid_idx1] / reference[mid_idx1]
+        y2 = absorption[:,mid_idx2] / reference[mid_idx2]
+        ratio = y1[:,None] if mid_idx1 == mid_idx2 else y1[:,None] + (np.arange(n) - mid_idx1) * ((y2 - y1) / (mid_idx2 - mid_idx1))[:,None]
+    else:
+        x_values, y_values = [], []
+        for region in regions:
+            sublen = max(1, len(range(n)[region]) // 5)
+            for section in (slice(region.start, region.start + sublen), slice(region.stop - sublen, region.stop)):
+                x_values.append(np.mean(lambdas[section]))
+                y_values.append(np.mean(absorption[:,section], axis=1) / np.mean(reference[section]))
+        # the same Vandermonde matrix for all spectra: one solve with M right hand sides
+        coefficients = np.linalg.solve(np.vander(x_values, 4), np.array(y_values))
+        ratio = np.polynomial.polynomial.polyval(lambdas, coefficients[::-1])
+
+    reference_scaled = reference * ratio
+    sigma_a = np.abs(np.log(reference_scaled / absorption)) / (material["N_dop"]*1e-6*material["length"]*1e2)
+
+    sigma_a = smooth_spectrum(lambdas, sigma_a, savgol_filter_width, savgol_filter_order)
+
+    return lambdas, sigma_a, absorption, reference, ratio
+
+def McCumber_relation_stack(energies_lower, energies_upper, lambdas, sigma_stack, kbT, inverse_relation = False):
+    # McCumber relation for all M spectra of a stack at once
+    return McCumber_factor(energies_lower, energies_upper, lambdas, kbT, inverse_relation) * sigma_stack
 
 def join_spectra(spectra_list):
     # Join multiple spectra into one, removing overlapping regions by averaging
     if len(spectra_list) == 0:
         return np.array([])
 
+    spectra_list = sorted(spectra_list, key=lambda spectrum: spectrum[0,0])   # in order of the wavelength ranges
     combined_spectrum = spectra_list[0]
 
     for next_spectrum in spectra_list[1:]:
@@ -1033,7 +2299,7 @@ def join_spectra(spectra_list):
             x2, y2 = next_spectrum[next_indices, 0], next_spectrum[next_indices, 1]
 
             # interpolate y2 onto x1 grid
-            y2_interp = np.interp(x1, x2, y2)
+            y2_interp = resample(y2, x2, x1, edges="hold")
 
             # average the y-values on the same x-grid
             averaged_overlap = np.column_stack([x1, (y1 + y2_interp) / 2])
@@ -1082,42 +2348,327 @@ def calc_Z_lower_upper(energies_lower, energies_upper, kbT):
 def McCumber_relation(energies_lower, energies_upper, sigma_a, kbT, inverse_relation = False):
     # Calculate the emission cross section with the McCumber relation for a given absorption spectrum and the energy levels 
     # if inverse_relation == True, the absorption cross section is calculated from the emission cross section
+    # Calculate the emission cross section
+    sigma_e = McCumber_factor(energies_lower, energies_upper, sigma_a[:,0], kbT, inverse_relation) * sigma_a[:,1]
+    
+    return make_spectrum(sigma_a[:,0], sigma_e)
+
+def McCumber_factor(energies_lower, energies_upper, wavelengths, kbT, inverse_relation = False):
+    # sigma_e/sigma_a of the McCumber relation for wavelengths in nm, broadcasts against a stack of spectra
     sign = -1 if inverse_relation else 1
     # lambdas should be given in cm
-    lambdas = sigma_a[:,0]*1e-7   # units: cm
+    lambdas = wavelengths*1e-7   # units: cm
     Z_lower, Z_upper, ZPL = calc_Z_lower_upper(energies_lower, energies_upper, kbT)
+    return (Z_lower/Z_upper)**sign * np.exp(sign*(ZPL-hc/lambdas)/kbT)
 
-    # Calculate the emission cross section
-    sigma_e = (Z_lower/Z_upper)**sign * np.exp(sign*(ZPL-hc/lambdas)/kbT) * sigma_a[:,1]
-    
-    return np.vstack([sigma_a[:,0], sigma_e]).T
+def fit_zero_phonon_line(material, sigma_a, sigma_e, energies_lower, energies_upper, threshold=0.05):
+    """
+    Shift the upper Stark manifold such that the McCumber emission cross section matches the
+    Füchtbauer-Ladenburg one in the region where both sigma_a and sigma_e exceed threshold*max.
+    log(sigma_e/sigma_a) = (eps - E)/kbT depends on the levels only through the effective energy
+    eps = ZPL + kbT*log(Z_lower/Z_upper), so only eps is fitted (in closed form); the splittings within
+    the manifolds are kept as given.
+
+    Returns (energies_lower, energies_upper, shift, rms) with levels and shift in 1/cm and the rms
+    deviation of log(sigma_e/sigma_a).
+    """
+    kbT = kb * material.get("temperature", 295)
+    sigma_e = resample(sigma_e[:,1], sigma_e[:,0], sigma_a[:,0])
+    mask = (sigma_a[:,1] > threshold*np.max(sigma_a[:,1])) & (sigma_e > threshold*np.max(sigma_e))
+    if np.count_nonzero(mask) < 2:
+        raise ValueError("McCumber and Füchtbauer-Ladenburg cross sections do not overlap.")
+
+    photon_energy = hc/(sigma_a[mask,0]*1e-7)   # in eV
+    log_ratio = np.log(sigma_e[mask]/sigma_a[mask,1])
+    eps = np.mean(kbT*log_ratio + photon_energy)
+
+    Z_lower, Z_upper, ZPL = calc_Z_lower_upper(energies_lower, energies_upper, kbT)
+    shift = (eps - ZPL - kbT*np.log(Z_lower/Z_upper))/hc
+    rms = np.sqrt(np.mean(((eps - photon_energy)/kbT - log_ratio)**2))
+    energies_upper = [round(float(E + shift), 1) for E in energies_upper]
+    return [float(E) for E in energies_lower], energies_upper, float(shift), float(rms)
+
+def write_stark_levels(material, energies_lower, energies_upper):
+    # write fitted levels and the resulting ZPL back to the basedata.json of the material
+    path = os.path.join(Standard_path, "measurements", material["folder_path"], "basedata.json")
+    with open(path, "r") as file:
+        basedata = json.load(file)
+
+    basedata["energy_lower_level"] = list(energies_lower)
+    basedata["energy_upper_level"] = list(energies_upper)
+    basedata["ZPL"] = float(f"{1e-2/(energies_upper[0] - energies_lower[0]):.5g}")
+
+    with open(path, "w") as file:
+        json.dump(basedata, file, indent=4)
+
+    for key in ("energy_lower_level", "energy_upper_level", "ZPL"):
+        material[key] = basedata[key]
 
 def beta_eq(sigma_a, sigma_e):
     return sigma_a / (sigma_a + sigma_e)
 
 def Fuchtbauer_Ladenburg(flourescence, material, sigma_a = None, absorption_depth=0):
+    # Calculate the emission cross section with the Füchtbauer-Ladenburg relation for a given fluorescence spectrum (wavelengths given in nm)
+    lambdas, sigma_e = Fuchtbauer_Ladenburg_sweep(flourescence, material, sigma_a=sigma_a, absorption_depths=[absorption_depth])
+    return make_spectrum(lambdas, sigma_e[0])
+
+def Fuchtbauer_Ladenburg_sweep(flourescence, material, sigma_a = None, absorption_depths=(0,), absorption_cross_section=None):
+    """
+    Füchtbauer-Ladenburg emission cross sections for a vector of D reabsorption depths [mm] in one pass.
+    absorption_cross_section (on the fluorescence grid, shape n or D x n) replaces the interpolated sigma_a.
+
+    Returns lambdas in nm (n) and sigma_e (D x n).
+    """
     n = material["n"]
     tau = material["tau_f"]
     N_dop = material["N_dop"]*1e-6  # in cm^-3
     lambdas = flourescence[:,0]*1e-7   # units: cm
-    # Calculate the emission cross section with the Füchtbauer-Ladenburg relation for a given fluorescence spectrum (wavelengths given in nm)
     
-    absorption_cross_section = np.interp(flourescence[:,0], sigma_a[:,0], sigma_a[:,1], left=0, right=0) if sigma_a is not None else np.zeros_like(lambdas)
+    if absorption_cross_section is None:
+        absorption_cross_section = resample(sigma_a[:,1], sigma_a[:,0], flourescence[:,0]) if sigma_a is not None else np.zeros_like(lambdas)
+    depths = np.asarray(absorption_depths, dtype=float)[:,None]*0.1
+    # the D x n work is done in one compute_dtype buffer: absorption factor -> integrand -> sigma_e
+    sigma_e = np.empty(np.broadcast_shapes(depths.shape, np.shape(absorption_cross_section)), dtype=compute_dtype)
     # correct for absorption effects, c.f. Toepfer, Jena, 2001, page 43
-    absorption_factor = np.exp(N_dop*absorption_cross_section*absorption_depth*0.1)
+    np.multiply(N_dop*depths, absorption_cross_section, out=sigma_e)
+    np.exp(sigma_e, out=sigma_e)
 
     Intensity = flourescence[:,1]
-    Integral = integrate.simpson(Intensity*lambdas*absorption_factor,x=lambdas)
-    g = lambdas**3/c * Intensity * absorption_factor / Integral
-
-    sigma_e = lambdas**2 / (8*np.pi*n**2*tau) * g 
+    sigma_e *= Intensity*lambdas
+    # integrated in blocks of rows, so the temporaries of simpson stay small for many depths
+    rows = max(1, 2**22 // sigma_e.shape[-1])
+    Integral = np.concatenate([integrate.simpson(sigma_e[i:i+rows], x=lambdas, axis=-1) for i in range(0, len(sigma_e), rows)])
+    # g = lambdas**3/c * Intensity * absorption_factor / Integral, sigma_e = lambdas**2 / (8*np.pi*n**2*tau) * g
+    sigma_e *= lambdas**4 / (c*8*np.pi*n**2*tau)
+    sigma_e /= Integral[:,None]
     
-    return np.vstack([lambdas*1e7, sigma_e]).T
+    return lambdas*1e7, sigma_e
+
+def Fuchtbauer_Ladenburg_self_consistent(flourescence, material, sigma_a, absorption_depths=(0,), excitation_fraction=0, tol=1e-6, max_iterations=50, newton_steps=4):
+    """
+    Reabsorption correction for a partially excited crystal: the fluorescence is attenuated by the net absorption
+    N_dop*((1-beta)*sigma_a - beta*sigma_e), which depends on the result sigma_e itself.
+    Each iteration updates the normalization integral and solves sigma_e = K*exp(-a*sigma_e) pointwise with
+    a few Newton steps (vectorized over wavelengths and depths), until the relative change is below tol.
+
+    Returns lambdas in nm (n), sigma_e (D x n) and the number of iterations.
+    """
+    n = material["n"]
+    tau = material["tau_f"]
+    N_dop = material["N_dop"]*1e-6  # in cm^-3
+    lambdas = flourescence[:,0]*1e-7   # units: cm
+    Intensity = flourescence[:,1]
+    depths = np.asarray(absorption_depths, dtype=float)[:,None]*0.1   # in cm
+
+    sigma_a_fluo = resample(sigma_a[:,1], sigma_a[:,0], flourescence[:,0])
+    ground_state_factor = np.exp(N_dop*(1-excitation_fraction)*sigma_a_fluo*depths)
+    a = N_dop*excitation_fraction*depths
+    prefactor = lambdas**2 / (8*np.pi*n**2*tau) * lambdas**3/c * Intensity * ground_state_factor
+
+    sigma_e = np.zeros((len(depths), len(lambdas)))
+    for iteration in range(1, max_iterations+1):
+        Integral = integrate.simpson(Intensity*lambdas*ground_state_factor*np.exp(-a*sigma_e), x=lambdas, axis=-1)
+        K = prefactor / Integral[:,None]
+        sigma_e_new = sigma_e.copy()
+        for _ in range(newton_steps):
+            emission = K*np.exp(-a*sigma_e_new)
+            sigma_e_new -= (sigma_e_new - emission) / (1 + a*emission)
+
+        change = np.max(np.abs(sigma_e_new - sigma_e)) / np.max(np.abs(sigma_e_new))
+        sigma_e = sigma_e_new
+        if change < tol:
+            break
+
+    return lambdas*1e7, sigma_e, iteration
+
+class FuchtbauerLadenburgFamily:
+    """
+    sigma_e of the Füchtbauer-Ladenburg relation precomputed for all depths of a grid (default: the steps of the
+    absorption depth slider). Calling it with a depth on the grid is a lookup, other depths are computed directly.
+    """
+    def __init__(self, flourescence, material, sigma_a, absorption_depths=None):
+        self.flourescence, self.sigma_a = flourescence, sigma_a
+        self.inputs = self.key(flourescence, material, sigma_a)
+        self.material = material
+        self.depths = FL_depth_grid if absorption_depths is None else np.asarray(absorption_depths, dtype=float)
+        self.lambdas, self.sigma_e = Fuchtbauer_Ladenburg_sweep(flourescence, material, sigma_a=sigma_a, absorption_depths=self.depths)
+
+    @staticmethod
+    def key(flourescence, material, sigma_a):
+        # everything the sweep reads besides the depth, compared by value
+        return (array_digest(flourescence), array_digest(sigma_a), key_value([material["n"], material["tau_f"], material["N_dop"]]))
+
+    def matches(self, flourescence, material, sigma_a):
+        return self.inputs == self.key(flourescence, material, sigma_a)
+
+    def __call__(self, absorption_depth):
+        index = np.argmin(np.abs(self.depths - absorption_depth))
+        if abs(self.depths[index] - absorption_depth) > 1e-9:
+            return Fuchtbauer_Ladenburg(self.flourescence, self.material, sigma_a=self.sigma_a, absorption_depth=absorption_depth)
+        return make_spectrum(self.lambdas, self.sigma_e[index])
+
+def find_interval(lambdas, lmin, lmax, axis=None):
+    # slice between the grid points closest to lmin and lmax
+    axis = axis or wavelength_axis(lambdas)
+    return slice(axis.index(lmin), axis.index(lmax))
+
+class WavelengthAxis:
+    """
+    Wavelength grid with fast nearest-index lookup, equivalent to np.argmin(np.abs(lambdas - x)).
+    Uniform grids are detected once and use O(1) index arithmetic, other ascending grids use
+    np.searchsorted (O(log n)), unsorted grids fall back to the full scan.
+    """
+    def __init__(self, lambdas, uniform=None, rtol=1e-6):
+        self.lambdas = lambdas
+        self.n = len(lambdas)
+        self.step = (lambdas[-1] - lambdas[0]) / (self.n - 1) if self.n > 1 else 0
+        if uniform is None:
+            steps = np.diff(lambdas)
+            self.ascending = bool(np.all(steps > 0))
+            uniform = self.ascending and bool(np.all(np.abs(steps - self.step) <= rtol*abs(self.step)))
+        else:
+            self.ascending = True
+        self.uniform = uniform
+
+    def index(self, x):
+        if self.n < 2 or not self.ascending:
+            return np.argmin(np.abs(self.lambdas - x))
+        if self.uniform:
+            i = int(np.clip(np.rint((x - self.lambdas[0]) / self.step), 0, self.n - 1))
+        else:
+            i = int(np.clip(np.searchsorted(self.lambdas, x), 0, self.n - 1))
+        # the guess is at most one point off: compare with the neighbours, ties go to the lower index like argmin
+        candidates = range(max(i - 1, 0), min(i + 2, self.n))
+        distances = [abs(self.lambdas[k] - x) for k in candidates]
+        return candidates[int(np.argmin(distances))]
+
+wavelength_axes = OrderedDict()
+wavelength_axes_lock = threading.Lock()   # the caches are shared with the prefetch threads
+
+def grid_signature(grid):
+    # O(1) cache key of a grid: length, end points and dtype; equal keys still need a comparison of the full grids
+    grid = np.asarray(grid)
+    return (len(grid), float(grid[0]), float(grid[-1]), grid.dtype.str) if len(grid) else (0, grid.dtype.str)
+
+def wavelength_axis(lambdas):
+    # cached WavelengthAxis of a wavelength array; the axis keeps its own copy of the wavelengths, so the cache neither
+    # pins the spectrum nor sees later in-place edits. The grids are only compared in full if the signatures match.
+    key = grid_signature(lambdas)
+    with wavelength_axes_lock:
+        axis = wavelength_axes.get(key)
+        if axis is None or not np.array_equal(axis.lambdas, lambdas):
+            axis = wavelength_axes[key] = WavelengthAxis(np.array(lambdas))
+            while len(wavelength_axes) > 64:
+                wavelength_axes.popitem(last=False)
+        else:
+            wavelength_axes.move_to_end(key)
+    return axis
+
+####################################################################################################
+# Resampling
+####################################################################################################
 
-def find_interval(lambdas, lmin, lmax):
-    index_min = np.argmin(np.abs(lambdas-lmin))
-    index_max = np.argmin(np.abs(lambdas-lmax))
-    return slice(index_min, index_max)
+class ResamplingOperator:
+    """
+    Linear map from spectra on a source grid to spectra on a target grid, stored as a sparse
+    (n_target x n_source) matrix. Applies to a single spectrum (n_source) or a stack (M x n_source)
+    with one sparse matrix product.
+    """
+    def __init__(self, target, matrix):
+        self.target = target
+        self.matrix = matrix
+
+    def __call__(self, values):
+        values = np.asarray(values)
+        return (self.matrix @ values.T).T
+
+def interpolation_operator(source, target, edges="zero"):
+    # linear interpolation like np.interp, outside the source range the result is 0 (edges="zero") or the edge value (edges="hold")
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    n = len(source)
+    if n < 2:
+        return ResamplingOperator(target, sparse.csr_matrix(np.ones((len(target), n))))
+    if edges not in ("zero", "hold"):
+        raise ValueError(f"Unknown edge mode {edges!r}, use 'zero' or 'hold'.")
+    # points outside the source range are moved onto its edges, which holds the edge values
+    clipped = np.clip(target, source[0], source[-1])
+    i = np.clip(np.searchsorted(source, clipped, side="right") - 1, 0, n - 2)
+    weight = (clipped - source[i]) / (source[i+1] - source[i])
+    rows = np.arange(len(target))
+    columns = np.concatenate((i, i + 1))
+    weights = np.concatenate((1 - weight, weight))
+    if edges == "zero":
+        outside = clipped != target
+        weights[np.concatenate((outside, outside))] = 0
+    matrix = sparse.csr_matrix((weights, (np.concatenate((rows, rows)), columns)), shape=(len(target), n))
+    matrix.eliminate_zeros()
+    return ResamplingOperator(target, matrix)
+
+def cell_edges(centers):
+    # edges of the cells around the grid points, halfway between neighbours; the outer cells are symmetric around the end points
+    middle = 0.5*(centers[1:] + centers[:-1])
+    return np.concatenate(([2*centers[0] - middle[0]], middle, [2*centers[-1] - middle[-1]]))
+
+def rebinning_matrix(source_edges, target_edges):
+    # sparse matrix of the overlap lengths between the source cells (columns) and the target bins (rows), both given by ascending edges
+    breakpoints = np.union1d(source_edges, target_edges)
+    breakpoints = breakpoints[(breakpoints >= max(source_edges[0], target_edges[0])) & (breakpoints <= min(source_edges[-1], target_edges[-1]))]
+    centers = 0.5*(breakpoints[1:] + breakpoints[:-1])
+    columns = np.searchsorted(source_edges, centers) - 1
+    rows = np.searchsorted(target_edges, centers) - 1
+    return sparse.csr_matrix((np.diff(breakpoints), (rows, columns)), shape=(len(target_edges) - 1, len(source_edges) - 1))
+
+def wavenumber_operator(lambdas, step=None):
+    """
+    Flux-conserving rebinning of spectral densities per nm onto a uniform wavenumber grid (1/cm),
+    the result is a density per 1/cm with the same integral over each bin. The default step gives
+    as many bins as wavelength points.
+    """
+    lambdas = np.asarray(lambdas, dtype=np.float64)
+    edges = cell_edges(lambdas)   # in nm
+    k_min, k_max = 1e7/edges[-1], 1e7/edges[0]
+    if step is None:
+        step = (k_max - k_min) / len(lambdas)
+    k_edges = k_min + step*np.arange(int(np.ceil((k_max - k_min)/step - 1e-9)) + 1)
+    # wavenumber bins as ascending wavelength intervals, the last bin is reversed to be the first
+    overlap = rebinning_matrix(edges, np.sort(1e7/k_edges))[::-1]
+    matrix = sparse.diags(1/np.diff(k_edges)) @ overlap
+    return ResamplingOperator(0.5*(k_edges[1:] + k_edges[:-1]), matrix.tocsr())
+
+resampling_operators = OrderedDict()
+resampling_lock = threading.Lock()
+
+def cached_operator(key, grids, build):
+    # LRU cache of ResamplingOperators keyed by grid_signature of the grids; an entry is only used if its copies of the grids
+    # equal the requested ones, so in-place edits of the data arrays cannot hit a stale operator
+    with resampling_lock:
+        entry = resampling_operators.get(key)
+        if entry is None or not all(np.array_equal(old, new) for old, new in zip(entry[0], grids)):
+            entry = resampling_operators[key] = ([np.array(grid) for grid in grids], build())
+            while len(resampling_operators) > 64:
+                resampling_operators.popitem(last=False)
+        else:
+            resampling_operators.move_to_end(key)
+    return entry[1]
+
+def resample(values, source, target, edges="zero"):
+    # values (n_source or M x n_source) linearly interpolated from the source onto the target grid; a single spectrum
+    # is interpolated directly, stacks share one cached sparse operator
+    values = np.asarray(values)
+    if values.ndim == 1 and len(source) > 1:
+        if edges not in ("zero", "hold"):
+            raise ValueError(f"Unknown edge mode {edges!r}, use 'zero' or 'hold'.")
+        outside = {"left": 0, "right": 0} if edges == "zero" else {}
+        return np.interp(target, source, values, **outside)
+    operator = cached_operator(("interpolation", grid_signature(source), grid_signature(target), edges), (source, target), lambda: interpolation_operator(source, target, edges))
+    return operator(values)
+
+def to_wavenumber(spectrum, step=None):
+    # spectrum (density per nm) rebinned onto a uniform wavenumber grid, returns (wavenumbers in 1/cm, density per 1/cm)
+    lambdas = spectrum[:,0]
+    operator = cached_operator(("wavenumber", grid_signature(lambdas), step), (lambdas,), lambda: wavenumber_operator(lambdas, step))
+    return make_spectrum(operator.target, operator(spectrum[:,1]))
 
 def get_overlap_lengths(arr):
     """Finds the lengths of contiguous patches of ones in a binary array."""
@@ -1132,11 +2683,13 @@ def get_overlap_lengths(arr):
     return start_indices, lengths
 
 def average_MCcumber_FL(material, FL_array, MC_array, FL_min=None, MC_max=None):
-    Delta_lambd = min(np.diff(FL_array[:,0]).min(), np.diff(MC_array[:,0]).min())
-    lambdas = np.arange(min(FL_array[0,0], MC_array[0,0]), max(FL_array[-1,0], MC_array[-1,0]), Delta_lambd)
+    # common grid with the mean step of the finer grid, at most as many points as both grids together
+    lambda_min, lambda_max = min(FL_array[0,0], MC_array[0,0]), max(FL_array[-1,0], MC_array[-1,0])
+    Delta_lambd = max(min(np.diff(FL_array[:,0]).mean(), np.diff(MC_array[:,0]).mean()), (lambda_max - lambda_min) / (len(FL_array) + len(MC_array)))
+    lambdas = np.arange(lambda_min, lambda_max, Delta_lambd)
 
-    FL_array = np.vstack([lambdas, np.interp(lambdas, FL_array[:,0], FL_array[:,1], left=FL_array[0,1], right=FL_array[-1,1])]).T
-    MC_array = np.vstack([lambdas, np.interp(lambdas, MC_array[:,0], MC_array[:,1], left=MC_array[0,1], right=MC_array[-1,1])]).T
+    FL_array = make_spectrum(lambdas, resample(FL_array[:,1], FL_array[:,0], lambdas, edges="hold"))
+    MC_array = make_spectrum(lambdas, resample(MC_array[:,1], MC_array[:,0], lambdas, edges="hold"))
 
     array_FL, array_MC = [np.zeros_like(lambdas) for _ in range(2)]
     if FL_min is None: FL_min = material.get("ZPL", 980e-9)*1e9 - 10 
@@ -1144,8 +2697,9 @@ def average_MCcumber_FL(material, FL_array, MC_array, FL_min=None, MC_max=None):
 
     print(FL_min, MC_max)
 
-    sliceFL = find_interval(lambdas, FL_min, 10000)
-    sliceMC = find_interval(lambdas, 100, MC_max)
+    axis = WavelengthAxis(lambdas, uniform=True)
+    sliceFL = find_interval(lambdas, FL_min, 10000, axis)
+    sliceMC = find_interval(lambdas, 100, MC_max, axis)
 
     array_FL[sliceFL] += FL_array[sliceFL,1]
     array_MC[sliceMC] += MC_array[sliceMC,1]
@@ -1174,9 +2728,916 @@ def average_MCcumber_FL(material, FL_array, MC_array, FL_min=None, MC_max=None):
     stacked = np.vstack(arrays)
     average = np.sum(stacked * nonzero_mask, axis=0)
 
-    return np.vstack([lambdas, average]).T
+    return make_spectrum(lambdas, average)
+
+##########################################################################
+# Headless pipeline, run manifests and replay
+##########################################################################
+
+def read_material(material):
+    # material dictionary of a measurement folder including the default values used by the GUI
+    path = os.path.join(Standard_path, "measurements", material, "basedata.json")
+    with open(path, "r") as file:
+        material_dict = json.load(file)
+
+    material_dict.setdefault("zero_absorption_wavelength", (0, np.inf))
+    material_dict.setdefault("folder_path", material)
+    material_dict.setdefault("zero_absorption_width", 0)
+    material_dict.setdefault("absorption_depth", 0)
+    return material_dict
+
+default_settings = {"FF_absorption": 0, "savgol_filter_nm": 0, "FF_fluorescence": 0.6, "use_McCumber": 1, "use_Fuchtbauer": 1,
+                    "average_sigma": 0, "MC_central": None, "MC_width": 10}
+
+def run_pipeline(material, settings=None, manifest=None, backend=None, families=None):
+    """
+    Compute the cross sections of one material like the "Plot cross section" button, without GUI.
+    settings uses the keys of default_settings (MC_central=None means the ZPL), manifest records the stage
+    timings and outputs, backend (ComputeBackend) caches the loaded and computed spectra.
+    families (dict kept by the caller) stores a FuchtbauerLadenburgFamily, so changing only the absorption
+    depth is a lookup.
+
+    Returns a dict with sigma_a and, depending on the settings, sigma_e, sigma_e_McCumber, sigma_e_average, sigma_a_average.
+    """
+    settings = {**default_settings, **(settings or {})}
+    manifest = manifest or RunManifest(material, settings)
+    def call(function, material, **kwargs):
+        if backend is None:
+            return function(material, **kwargs)
+        if backend.cached(function, material, kwargs):
+            manifest.mark_cached()
+        return backend.call(function, material, **kwargs)
+    E_u = material.get("energy_upper_level", [1e-2/material["ZPL"]])
+    E_l = material.get("energy_lower_level", [0])
+    thermal_energy = kb * material.get("temperature", 295)  # in eV
+    MC_central = settings["MC_central"] if settings["MC_central"] is not None else material["ZPL"]*1e9
+
+    results = {}
+    with manifest.stage("calc_absorption"):
+        results["sigma_a"] = call(calc_absorption, material, filter_width=float(settings["FF_absorption"]), savgol_filter_width=float(settings["savgol_filter_nm"]))[0]
+
+    if settings["use_Fuchtbauer"]:
+        with manifest.stage("calc_fluorescence"):
+            Fluo = call(calc_fluorescence, material, filter_width=settings["FF_fluorescence"])[0]
+        with manifest.stage("Fuchtbauer_Ladenburg"):
+            absorption_depth = material.get("absorption_depth", 0)
+            if material.get("excitation_fraction", 0) > 0:
+                lambdas, sigma_e, _ = Fuchtbauer_Ladenburg_self_consistent(Fluo, material, results["sigma_a"], [absorption_depth], material["excitation_fraction"])
+                results["sigma_e"] = make_spectrum(lambdas, sigma_e[0])
+            elif families is not None:
+                if "Fuchtbauer_Ladenburg" not in families or not families["Fuchtbauer_Ladenburg"].matches(Fluo, material, results["sigma_a"]):
+                    families["Fuchtbauer_Ladenburg"] = FuchtbauerLadenburgFamily(Fluo, material, results["sigma_a"])
+                else:
+                    manifest.mark_cached()
+                results["sigma_e"] = families["Fuchtbauer_Ladenburg"](absorption_depth)
+            else:
+                results["sigma_e"] = Fuchtbauer_Ladenburg(Fluo, material, sigma_a=results["sigma_a"], absorption_depth=absorption_depth)
+
+    if settings["use_McCumber"]:
+        with manifest.stage("McCumber_relation"):
+            results["sigma_e_McCumber"] = McCumber_relation(E_l, E_u, results["sigma_a"], thermal_energy)
+
+        if settings["use_Fuchtbauer"] and settings["average_sigma"]:
+            with manifest.stage("average_MCcumber_FL"):
+                results["sigma_e_average"] = average_MCcumber_FL(material, results["sigma_e"], results["sigma_e_McCumber"], MC_central - settings["MC_width"]/2, MC_central + settings["MC_width"]/2)
+            with manifest.stage("McCumber_inverse"):
+                results["sigma_a_average"] = McCumber_relation(E_l, E_u, results["sigma_e_average"], thermal_energy, inverse_relation=True)
+
+    for name, data in results.items():
+        manifest.record_output(name, data)
+    return results
+
+file_hashes = {}   # sha256 of files keyed by (path, size, mtime)
+file_hashes_lock = threading.Lock()
+
+def file_hash(file):
+    stat = os.stat(file)
+    key = (os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+    with file_hashes_lock:
+        if key in file_hashes:
+            return file_hashes[key]
+    sha256 = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    with file_hashes_lock:
+        file_hashes[key] = sha256.hexdigest()
+    return file_hashes[key]
+
+class RunManifest:
+    """
+    Record of one computation: input file hashes, material and settings, library versions,
+    stage timings (seconds) and output checksums with summary values to quantify numerical drift.
+    The input files are only hashed when the manifest is saved or compared (inputs()), not on every slider step.
+    Stages served from the compute cache are listed in "cached", their timings are not compared on replay.
+    """
+    def __init__(self, material, settings):
+        self.folder = os.path.join(Standard_path, "measurements", material["folder_path"])
+        self.data = {"program_version": version_number,
+                     "created": datetime.now().isoformat(timespec="seconds"),
+                     "material": to_json_safe(dict(material)),
+                     "settings": to_json_safe(dict(settings)),
+                     "inputs": None,
+                     "libraries": {"python": platform.python_version(), "numpy": np.__version__, "scipy": scipy.__version__, "matplotlib": matplotlib.__version__},
+                     "timings": {},
+                     "cached": [],
+                     "outputs": {}}
+        self.current_stage = None
+
+    @contextmanager
+    def stage(self, name):
+        self.current_stage = name
+        with memory_profiler.track(name) if memory_profiler is not None else nullcontext():
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.data["timings"][name] = self.data["timings"].get(name, 0) + time.perf_counter() - start
+
+    def mark_cached(self):
+        if self.current_stage not in self.data["cached"]:
+            self.data["cached"].append(self.current_stage)
+
+    def record_output(self, name, array):
+        array = np.ascontiguousarray(array)
+        self.data["outputs"][name] = {"sha256": hashlib.sha256(array.tobytes()).hexdigest(), "shape": list(array.shape), "dtype": str(array.dtype),
+                                      "norm": float(np.linalg.norm(np.nan_to_num(array[:,1]))), "max": float(np.nanmax(array[:,1]))}
+
+    def inputs(self):
+        if self.data["inputs"] is None:
+            self.data["inputs"] = {f: file_hash(os.path.join(self.folder, f)) for f in sorted(os.listdir(self.folder))} if os.path.isdir(self.folder) else {}
+        return self.data["inputs"]
+
+    def save(self, filename):
+        self.inputs()
+        with open(filename, "w") as f:
+            json.dump(self.data, f, indent=2)
+
+def replay_manifest(filename, rtol=1e-9, slowdown=1.5, min_time=1e-3):
+    """
+    Re-run the computation of a manifest headlessly and report changed inputs, numerical drift of the outputs
+    (relative change of norm and maximum > rtol) and stages which became slower than slowdown * recorded time
+    (and by more than min_time seconds, to ignore the jitter of sub-millisecond stages).
+    Returns (report lines, True if nothing drifted).
+    """
+    with open(filename, "r") as f:
+        recorded = json.load(f)
+
+    material = recorded["material"]
+    material["zero_absorption_wavelength"] = tuple(float(x) for x in material["zero_absorption_wavelength"])
+    recorded["settings"] = migrate_settings(recorded["settings"], material)
+    manifest = RunManifest(material, recorded["settings"])
+    run_pipeline(material, recorded["settings"], manifest=manifest)
+    current = manifest.data
+
+    report, ok = [f"replay of {filename} ({material['folder_path']})"], True
+    for name, digest in recorded["inputs"].items():
+        if manifest.inputs().get(name) != digest:
+            report.append(f"  input changed: {name}")
+            ok = False
+    for name, library in recorded["libraries"].items():
+        if current["libraries"].get(name) != library:
+            report.append(f"  {name} {library} -> {current['libraries'].get(name)}")
+
+    for name, old in recorded["outputs"].items():
+        new = current["outputs"].get(name)
+        if new is None:
+            report.append(f"  output {name}: missing"); ok = False
+        elif new["sha256"] == old["sha256"]:
+            report.append(f"  output {name}: identical")
+        elif new["shape"] != old["shape"]:
+            report.append(f"  output {name}: shape {old['shape']} -> {new['shape']}"); ok = False
+        else:
+            drift = max(abs(new[key] - old[key]) / abs(old[key]) if old[key] else abs(new[key]) for key in ("norm", "max"))
+            report.append(f"  output {name}: relative drift {drift:.2e}" + (" DRIFT" if drift > rtol else ""))
+            ok &= drift <= rtol
+
+    for name, old in recorded["timings"].items():
+        if name in recorded.get("cached", []) or name in current["cached"]:
+            report.append(f"  {name}: cached, timing not compared")
+            continue
+        new = current["timings"].get(name, 0)
+        slower = new > slowdown*old and new - old > min_time
+        report.append(f"  {name}: {old*1e3:.2f} ms -> {new*1e3:.2f} ms" + (" SLOWER" if slower else ""))
+        ok &= not slower
+
+    return report, ok
+
+def absorption_step(material):
+    # wavelength step of the (first) absorption measurement in nm
+    files = measurement_files(material, "absorption")
+    if not files:
+        raise FileNotFoundError(f"No absorption file found for {material['folder_path']}.")
+    lambdas = spectrum_cache.read(files[0])[0]
+    return (lambdas[-1] - lambdas[0]) / (len(lambdas) - 1)
+
+def migrate_settings(settings, material=None):
+    """
+    Settings of older projects and manifests: "savgol_filter" was the Savitzky-Golay window in samples of the
+    absorption grid, it is converted to "savgol_filter_nm" with the wavelength step of the material it was saved for.
+    """
+    settings = dict(settings)
+    samples = settings.pop("savgol_filter", None)
+    if samples is not None and "savgol_filter_nm" not in settings:
+        if int(samples) > 1 and material is None:
+            raise ValueError("The Savitzky-Golay window of this file is given in samples, the material is needed to convert it to nm.")
+        settings["savgol_filter_nm"] = round(float((int(samples) - 1)*absorption_step(material)), 3) if int(samples) > 1 else 0
+    return settings
+
+def load_project_settings(filename):
+    """
+    Read a project file saved by the GUI and return (settings, material_overrides) for run_pipeline.
+    Only the processing settings are taken over; crystal data, zero absorption wavelengths and
+    the MC central wavelength belong to the material the project was saved for.
+    """
+    with open(filename, "r") as f:
+        data = json.load(f)
+    if "savgol_filter" in data:
+        data = migrate_settings(data, read_material(data["material_list"]) if data.get("material_list") else None)
+
+    settings = {key: data[key] for key in ("FF_absorption", "savgol_filter_nm", "use_McCumber", "use_Fuchtbauer", "average_sigma", "MC_width") if key in data}
+    material_overrides = {}
+    if "FL_absorption" in data: material_overrides["absorption_depth"] = float(data["FL_absorption"])
+    if "zero_bandwidth" in data: material_overrides["zero_absorption_width"] = data["zero_bandwidth"]
+    return settings, material_overrides
+
+def run_batch(materials=None, settings=None, output_dir="manifests", material_overrides=None):
+    # compute all (or the given) materials headlessly and write one manifest per material
+    os.makedirs(output_dir, exist_ok=True)
+    if not materials:
+        catalog = MaterialCatalog(os.path.join(Standard_path, "measurements"))
+        catalog.update()
+        materials = catalog.query()
+
+    for material in materials:
+        material_dict = {**read_material(material), **(material_overrides or {})}
+        manifest = RunManifest(material_dict, {**default_settings, **(settings or {})})
+        try:
+            run_pipeline(material_dict, settings, manifest=manifest)
+        except (OSError, IndexError, ValueError) as error:
+            print(f"{material}: {error!r}")
+            continue
+        manifest.save(os.path.join(output_dir, f"{material}.manifest.json"))
+        print(f"{material}: {sum(manifest.data['timings'].values())*1e3:.1f} ms")
+
+##########################################################################
+# Golden outputs: reference results of all materials to check changes of the implementation
+##########################################################################
+
+# pinned settings of the golden cases (materials without fluorescence only compute the absorption side)
+golden_settings = {**default_settings, "FF_absorption": 0.1, "savgol_filter_nm": 2, "average_sigma": 1, "MC_width": 10}
+golden_material_overrides = {"absorption_depth": 0.5}
+
+def golden_settings_key():
+    # the pinned settings as stored with every recorded case, a corpus recorded with other settings is stale
+    return json.dumps([golden_settings, golden_material_overrides], sort_keys=True)
+
+def golden_case(material, repeat=3):
+    # run the pinned pipeline of one material, returns (results, best runtime of repeat runs in s)
+    material_dict = {**read_material(material), **golden_material_overrides}
+    settings = dict(golden_settings)
+    if not measurement_files(material_dict, "fluorescence"):
+        settings.update(use_Fuchtbauer=0, average_sigma=0)
+
+    runtimes = []
+    for _ in range(repeat):
+        manifest = RunManifest(material_dict, settings)
+        results = run_pipeline(material_dict, settings, manifest=manifest)
+        runtimes.append(sum(manifest.data["timings"].values()))
+    return results, min(runtimes)
+
+def golden_materials(materials=None):
+    if materials:
+        return materials
+    catalog = MaterialCatalog(os.path.join(Standard_path, "measurements"))
+    catalog.update()
+    return catalog.query()
+
+golden_path = os.path.join(Standard_path, "golden")   # the recorded corpus is part of the repository
+
+def record_golden(materials=None, golden_dir=golden_path):
+    # store the results and runtime of every material as <golden_dir>/<material>.npz
+    os.makedirs(golden_dir, exist_ok=True)
+    for material in golden_materials(materials):
+        results, runtime = golden_case(material)
+        np.savez_compressed(os.path.join(golden_dir, f"{material}.npz"), runtime=runtime, settings=golden_settings_key(), **results)
+        print(f"{material}: {', '.join(results)} ({runtime*1e3:.1f} ms)")
+
+def golden_difference(old, new):
+    # largest deviation of two spectra relative to the maximum of each column, inf if shape or NaN positions differ
+    if old.shape != new.shape or np.any(np.isnan(old) != np.isnan(new)):
+        return np.inf
+    return max(np.nanmax(np.abs(new[:,i] - old[:,i])) / np.nanmax(np.abs(old[:,i])) for i in range(old.shape[1]))
+
+def check_golden(materials=None, golden_dir=golden_path, rtol=1e-9, slowdown=None, min_time=1e-3):
+    """
+    Compare the current implementation against the recorded golden outputs. Every case reports the largest
+    relative deviation of each output next to the recorded and current runtime.
+    Fails for deviations > rtol, missing outputs and cases recorded with other pinned settings. Runtimes depend on the machine, so cases slower than
+    slowdown * recorded runtime (and by more than min_time s) only fail if slowdown is given.
+    Returns (report lines, True if all cases passed).
+    """
+    if not materials:
+        materials = sorted(f[:-4] for f in os.listdir(golden_dir) if f.endswith(".npz"))
+
+    report, all_ok = [], True
+    for material in materials:
+        with np.load(os.path.join(golden_dir, f"{material}.npz")) as golden:
+            reference = {name: golden[name] for name in golden.files}
+        results, runtime = golden_case(material)
+
+        stale = "settings" in reference and str(reference["settings"]) != golden_settings_key()
+        ok, diffs = not stale, ["recorded with other settings, record again"] if stale else []
+        for name, old in reference.items():
+            if name in ("runtime", "settings"):
+                continue
+            difference = golden_difference(old, results[name]) if name in results else np.inf
+            diffs.append(f"{name} {difference:.1e}")
+            ok &= difference <= rtol
+        slower = slowdown is not None and runtime > slowdown*reference["runtime"] and runtime - reference["runtime"] > min_time
+        ok &= not slower
+
+        report.append(f"{'ok  ' if ok else 'FAIL'} {material}: {reference['runtime']*1e3:.1f} ms -> {runtime*1e3:.1f} ms{' SLOWER' if slower else ''} | " + ", ".join(diffs))
+        all_ok &= ok
+    return report, all_ok
+
+def emission_cross_section(results):
+    # sigma_e of the run_pipeline results used for derived quantities: average, else Füchtbauer-Ladenburg, else McCumber
+    return next(results[key] for key in ("sigma_e_average", "sigma_e", "sigma_e_McCumber") if key in results)
+
+##########################################################################
+# Figures of merit of all materials
+##########################################################################
+
+# column: (header, format) of the figure of merit table
+figure_of_merit_columns = {"folder_path": ("material folder", "{:24s}"), "name": ("name", "{:14s}"),
+                           "sigma_e_peak": ("σe peak [cm²]", "{:.3e}"), "lambda_e_peak": ("λe peak [nm]", "{:.1f}"),
+                           "sigma_a_peak": ("σa peak [cm²]", "{:.3e}"), "lambda_a_peak": ("λa peak [nm]", "{:.1f}"),
+                           "F_sat": ("Fsat [J/cm²]", "{:.2f}"), "beta_min": ("βmin", "{:.3f}"), "I_min": ("Imin [kW/cm²]", "{:.2f}"),
+                           "gain_bandwidth": ("gain FWHM [nm]", "{:.1f}"), "sigma_e_tau": ("σe·τ [cm² s]", "{:.3e}"),
+                           "sigma_e_tau_weighted": ("<σe>·τ [cm² s]", "{:.3e}"), "N_dop": ("N_dop [m⁻³]", "{:.2e}"), "tau_f": ("τf [s]", "{:.2e}")}
+
+def figures_of_merit(material, results, inversion=0.25):
+    """
+    Figures of merit of one material from the run_pipeline results (sigma_e: average, else Füchtbauer-Ladenburg, else McCumber),
+    at the emission peak λe (laser) and the absorption peak λa (pump):
+    saturation fluence hν/(σa+σe), minimum inversion βmin = σa/(σa+σe), minimum pump intensity βmin*hν_p/(σa_p*τf),
+    FWHM of the gain cross section inversion*σe - (1-inversion)*σa, σe*τf at the peak and emission weighted <σe>*τf.
+    """
+    sigma_a = results["sigma_a"]
+    sigma_e = emission_cross_section(results)
+    lambdas = sigma_e[:,0]
+    se = np.nan_to_num(sigma_e[:,1])
+    sa = resample(sigma_a[:,1], sigma_a[:,0], lambdas)
+    tau = material["tau_f"]
+
+    laser = np.argmax(se)
+    pump = np.argmax(sigma_a[:,1])
+    photon_energy_laser = planck*c / (lambdas[laser]*1e-7)   # in J
+    photon_energy_pump = planck*c / (sigma_a[pump,0]*1e-7)
+    beta_min = sa[laser] / (sa[laser] + se[laser])
+
+    # contiguous region around the gain maximum above half maximum
+    gain = inversion*se - (1-inversion)*sa
+    peak = np.argmax(gain)
+    below = np.flatnonzero(gain < gain[peak]/2)
+    left = lambdas[below[below < peak][-1] + 1] if np.any(below < peak) else lambdas[0]
+    right = lambdas[below[below > peak][0] - 1] if np.any(below > peak) else lambdas[-1]
+
+    return {"folder_path": material["folder_path"], "name": material.get("name", ""),
+            "sigma_e_peak": se[laser], "lambda_e_peak": lambdas[laser],
+            "sigma_a_peak": sigma_a[pump,1], "lambda_a_peak": sigma_a[pump,0],
+            "F_sat": photon_energy_laser / (sa[laser] + se[laser]), "beta_min": beta_min,
+            "I_min": beta_min * photon_energy_pump / (sigma_a[pump,1] * tau) * 1e-3,
+            "gain_bandwidth": right - left, "sigma_e_tau": se[laser] * tau,
+            "sigma_e_tau_weighted": tau * integrate.simpson(se**2, x=lambdas) / integrate.simpson(se, x=lambdas),
+            "N_dop": material["N_dop"], "tau_f": tau}
+
+def figure_of_merit_table(materials=None, settings=None, inversion=0.25, backend=None):
+    """
+    Figures of merit of all (or the given) materials, one row (dict) per material.
+    With a ComputeBackend the spectra and cross sections computed before are reused.
+    Materials without fluorescence use the McCumber emission cross section.
+    """
+    rows = []
+    for material in golden_materials(materials):
+        material_dict = read_material(material)
+        material_settings = {**default_settings, **(settings or {})}
+        if not measurement_files(material_dict, "fluorescence"):
+            material_settings.update(use_Fuchtbauer=0, average_sigma=0)
+        try:
+            results = run_pipeline(material_dict, material_settings, backend=backend)
+        except (OSError, IndexError, ValueError) as error:
+            print(f"{material}: {error!r}")
+            continue
+        rows.append(figures_of_merit(material_dict, results, inversion))
+    return rows
+
+def select_rows(rows, search="", sort_by="folder_path", descending=False):
+    # filter the rows with search terms like "Yb sigma_e_peak>1e-20 gain_bandwidth>=20" and sort them by one column
+    keys = {column: column for column in figure_of_merit_columns}
+    rows = [row for row in rows if matches_search(row, search, keys, ("folder_path", "name"))]
+    return sorted(rows, key=lambda row: row[sort_by], reverse=descending)
+
+def format_table(rows, columns=tuple(figure_of_merit_columns)):
+    # aligned text table of the rows
+    cells = [[figure_of_merit_columns[column][0] for column in columns]]
+    cells += [[figure_of_merit_columns[column][1].format(row[column]).strip() for column in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(line, widths)) for line in cells)
+
+def export_table(file_name, rows):
+    # figure of merit table as .json or comma separated text
+    if file_name.endswith(".json"):
+        with open(file_name, "w") as f:
+            json.dump(to_json_safe(rows), f, indent=2)
+        return
+    with open(file_name, "w", encoding="utf-8") as f:
+        f.write(",".join(figure_of_merit_columns) + "\n")
+        for row in rows:
+            f.write(",".join(str(to_json_safe(row[column])) for column in figure_of_merit_columns) + "\n")
+
+##########################################################################
+# Quasi-three-level gain simulation of the pumped crystal
+##########################################################################
+
+default_pump_intensities = [1, 5, 10, 20, 50]   # kW/cm², can be changed per material with the key "pump_intensities"
+
+def pump_propagation(pump_intensities, z, N, tau, sigma_a_p, sigma_e_p, photon_energy):
+    """
+    Steady state pump intensity (W/cm²) and inversion along z (cm) for all pump intensities at z=0, shape (P x Z),
+    without signal and ASE. The rate equations give dI/dz = -N*σa*I/(1 + I/I_sat) with I_sat = hν/((σa+σe)*τ),
+    which is solved exactly by I/I_sat = W(I0/I_sat * exp(I0/I_sat - N*σa*z)) (Lambert W, as Wright omega against overflow).
+    """
+    I_sat = photon_energy / ((sigma_a_p + sigma_e_p) * tau)
+    I0 = np.asarray(pump_intensities, dtype=float)[:,None] / I_sat
+    with np.errstate(divide="ignore"):
+        intensity = wrightomega(np.log(I0) + I0 - N*sigma_a_p*z[None,:]).real
+    inversion = sigma_a_p / (sigma_a_p + sigma_e_p) * intensity / (1 + intensity)
+    return intensity * I_sat, inversion
+
+def gain_block(pump_intensities, z, lambdas, sigma_a, sigma_e, pump, N, tau):
+    # pump, inversion (P x Z) and single pass small signal gain (P x n) for a block of pump intensities
+    intensity, inversion = pump_propagation(pump_intensities, z, N, tau, *pump)
+    mean_inversion = integrate.simpson(inversion, x=z, axis=-1) / (z[-1] - z[0])
+    gain = np.exp(N * (z[-1] - z[0]) * (mean_inversion[:,None] * (sigma_a + sigma_e)[None,:] - sigma_a[None,:]))
+    return intensity, inversion, gain
+
+def simulate_gain(material, results, pump_intensities=None, pump_wavelength=None, nz=200, block_size=256, max_workers=None):
+    """
+    Longitudinally pumped crystal (N_dop, length, tau_f of material) with the cross sections of run_pipeline:
+    steady state inversion along the crystal and single pass small signal gain for every wavelength and pump intensity.
+    pump_intensities in kW/cm² (default: basedata key "pump_intensities" or default_pump_intensities),
+    pump_wavelength in nm (default: basedata key "pump_wavelength" or the absorption peak).
+    Grids with more than block_size pump intensities are split over a process pool.
+
+    Returns a dict with lambdas (n, nm), z (Z, cm), pump_intensities (P, kW/cm²), pump (P x Z, W/cm²),
+    inversion (P x Z), gain (P x n) and the absorbed pump fraction (P).
+    """
+    pump_intensities = np.asarray(pump_intensities if pump_intensities is not None else material.get("pump_intensities", default_pump_intensities), dtype=float)
+    N = material["N_dop"]*1e-6            # in cm^-3
+    z = np.linspace(0, material["length"]*1e2, nz)   # in cm
+    tau = material["tau_f"]
+
+    sigma_e = emission_cross_section(results)
+    lambdas = sigma_e[:,0]
+    sigma_a = resample(results["sigma_a"][:,1], results["sigma_a"][:,0], lambdas)
+    sigma_e = np.nan_to_num(sigma_e[:,1])
+
+    if pump_wavelength is None:
+        pump_wavelength = material.get("pump_wavelength", results["sigma_a"][np.argmax(results["sigma_a"][:,1]),0])
+    pump = (np.interp(pump_wavelength, lambdas, sigma_a), np.interp(pump_wavelength, lambdas, sigma_e), planck*c / (pump_wavelength*1e-7))
+
+    blocks = [pump_intensities[i:i+block_size]*1e3 for i in range(0, len(pump_intensities), block_size)]
+    arguments = (z, lambdas, sigma_a, sigma_e, pump, N, tau)
+    if len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            parts = list(executor.map(gain_block, blocks, *[[argument]*len(blocks) for argument in arguments]))
+    else:
+        parts = [gain_block(blocks[0], *arguments)]
+    intensity, inversion, gain = (np.concatenate(part) for part in zip(*parts))
+
+    return {"lambdas": lambdas, "z": z, "pump_intensities": pump_intensities, "pump_wavelength": pump_wavelength,
+            "pump": intensity, "inversion": inversion, "gain": gain, "absorbed": 1 - intensity[:,-1] / np.maximum(intensity[:,0], np.finfo(float).tiny)}
+
+##########################################################################
+# Offscreen rendering of the figures for reports (Agg backend, no Tk)
+##########################################################################
+
+class FigureTemplate:
+    """
+    Figure of one plot type, created once per process and reused for all materials.
+    Lines are kept by name and only their data is replaced, lines not used by the current material are hidden.
+    Lines without explicit color get the colors of the matplotlib color cycle in plotting order, as in the GUI.
+    """
+    def __init__(self, xlabel, ylabel):
+        set_plot_params()
+        self.fig = Figure(constrained_layout=True, dpi=150)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(1, 1, 1)
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel(ylabel)
+        self.lines = {}
+        self.used = []
+        self.transient = []
+
+    def begin(self, title=""):
+        for artist in self.transient:
+            artist.remove()
+        self.used, self.transient = [], []
+        self.color_index = 0
+        self.ax.set_title(title)
+        self.ax.set_autoscale_on(True)
+
+    def plot(self, name, x, y, label, color=None, **kwargs):
+        if name not in self.lines:
+            self.lines[name], = self.ax.plot([], [], **kwargs)
+        line = self.lines[name]
+        line.set_data(x, y)
+        line.set_label(label)
+        if color is None:
+            color = f"C{self.color_index}"
+            self.color_index += 1
+        line.set_color(color)
+        self.used.append(line)
+
+    def axvline(self, x, **kwargs):
+        # vertical lines differ in number between materials and are created for every figure
+        self.transient.append(self.ax.axvline(x, **kwargs))
+
+    def finish(self, legend=True, ylim=None):
+        for line in self.lines.values():
+            line.set_visible(line in self.used)
+        self.ax.relim(visible_only=True)
+        self.ax.autoscale_view()
+        if ylim is not None:
+            self.ax.set_ylim(*ylim)
+        if self.ax.get_legend() is not None:
+            self.ax.get_legend().remove()
+        if legend:
+            self.ax.legend(handles=self.used)
+
+def render_fluorescence(template, material, settings, title=True, legend=True, **kwargs):
+    Fluo, Fluo_low, Fluo_high = calc_fluorescence(material, filter_width=settings["FF_fluorescence"])
+    template.begin(f"fluorescence of {material['name']}" if title else "")
+    if Fluo_low is not None and Fluo_high is not None:
+        filenames = [os.path.basename(f).replace(".txt", "").replace("_", " ") for f in measurement_files(material, "fluorescence")]
+        template.plot("fluo_low", Fluo_low[:,0], Fluo_low[:,1], filenames[0])
+        template.plot("fluo_high", Fluo_high[:,0], Fluo_high[:,1], filenames[1])
+    template.plot("fluo", Fluo[:,0], Fluo[:,1], "fluorescence")
+    template.finish(legend)
+
+def render_absorption(template, material, settings, title=True, legend=True, **kwargs):
+    sigma_a, absorption, reference, ratio = calc_absorption(material, filter_width=float(settings["FF_absorption"]), savgol_filter_width=float(settings["savgol_filter_nm"]))
+    template.begin(f"absorption of {material['name']}" if title else "")
+    template.plot("abs", absorption[:,0], absorption[:,1], "absorption")
+    template.plot("ref", reference[:,0], reference[:,1], "reference")
+    template.plot("sigma", sigma_a[:,0], sigma_a[:,1]/(np.max(sigma_a[:,1])/np.max(reference[:,1])), "absorption cross section", color="tab:green", lw=0.8)
+    template.finish(legend)
+
+def render_cross_sections(template, material, settings, title=True, legend=True, line_transitions=False):
+    results = run_pipeline(material, settings)
+    template.begin(f"cross sections of {material['name']}" if title else "")
+
+    ylim = None
+    if settings["use_McCumber"]:
+        ylim = (-1e-21, 2*np.max(results["sigma_a"][:,1]))
+        if settings["use_Fuchtbauer"]:
+            ylim = (-1e-21, 1.3*max(np.max(results["sigma_a"][:,1]), np.max(results["sigma_e"][:,1])))
+            if settings["average_sigma"]:
+                MC_central = settings["MC_central"] if settings["MC_central"] is not None else material["ZPL"]*1e9
+                template.axvline(MC_central, color='red', linestyle='--', lw=0.8)
+
+    if line_transitions:
+        for E_u in material.get("energy_upper_level", [1e-2/material["ZPL"]]):
+            for E_l in material.get("energy_lower_level", [0]):
+                template.axvline(1/(E_u - E_l)*1e7, color='gray', linestyle=':', lw=0.8)
+
+    for key, data in results.items():
+        template.plot(key, data[:,0], data[:,1], cross_section_labels[key].format(name=material['name']))
+    template.finish(legend, ylim)
+
+# plot type: (render function, x label, y label)
+render_kinds = {"fluorescence": (render_fluorescence, "wavelength in nm", "fluorescence intensity in a.u."),
+                "absorption": (render_absorption, "wavelength in nm", "absorption in a.u."),
+                "cross_sections": (render_cross_sections, "wavelength in nm", "cross sections in cm²")}
+
+figure_templates = {}   # templates of the current (worker) process
+
+def render_material(material, kinds=tuple(render_kinds), formats=("pdf",), output_dir="figures", settings=None, material_overrides=None, **options):
+    """
+    Render the figures of one material into output_dir as <material>_<kind>.<format>.
+    options (title, legend, line_transitions) correspond to the switches of the GUI.
+    Returns (written files, error messages).
+    """
+    material_dict = {**read_material(material), **(material_overrides or {})}
+    settings = {**default_settings, **(settings or {})}
+    written, errors = [], []
+    for kind in kinds:
+        render, xlabel, ylabel = render_kinds[kind]
+        if kind not in figure_templates:
+            figure_templates[kind] = FigureTemplate(xlabel, ylabel)
+        template = figure_templates[kind]
+        try:
+            render(template, material_dict, settings, **options)
+        except (OSError, IndexError, ValueError) as error:
+            errors.append(f"{material} {kind}: {error!r}")
+            continue
+        for file_format in formats:
+            file_name = os.path.join(output_dir, f"{material}_{kind}.{file_format}")
+            template.fig.savefig(file_name, bbox_inches='tight')
+            written.append(file_name)
+    return written, errors
+
+def render_batch(materials=None, kinds=tuple(render_kinds), formats=("pdf",), output_dir="figures", settings=None, material_overrides=None, max_workers=None, **options):
+    # render the figures of all (or the given) materials in parallel worker processes
+    os.makedirs(output_dir, exist_ok=True)
+    if not materials:
+        catalog = MaterialCatalog(os.path.join(Standard_path, "measurements"))
+        catalog.update()
+        materials = catalog.query()
+
+    written = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(render_material, material, kinds, formats, output_dir, settings, material_overrides, **options): material for material in materials}
+        for future in as_completed(futures):
+            files, errors = future.result()
+            written.extend(files)
+            for error in errors:
+                print(error)
+            print(f"{futures[future]}: {len(files)} files")
+    return written
+
+##########################################################################
+# Streaming variants for spectra which do not fit into memory
+##########################################################################
+
+def read_spectrum_chunks(file, chunk_size=100000, dialect=None):
+    # yield consecutive (chunk_size,2) blocks of a spectrum file, same rows as load_spectrum
+    dialect = dialect or detect_dialect(file)
+    with open(file, "r") as f:
+        for _ in islice(f, dialect.header_lines): pass
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                break
+            data = np.loadtxt(lines, delimiter=dialect.delimiter, ndmin=2)
+            yield make_spectrum(data[:,0], data[:,1])
+
+def savgol_chunks(chunks, window, order):
+    # Savitzky-Golay filter of a chunked spectrum, every chunk is extended by halos of the neighbouring chunks
+    # so the result equals savgol_smooth of the whole spectrum (chunks must be at least window long, except the last)
+    chunks = iter(chunks)
+    current = next(chunks, None)
+    left = np.empty((0,2))
+    for following in chain(chunks, [None]):
+        right = following[:window] if following is not None else np.empty((0,2))
+        extended = np.concatenate((left[:,1], current[:,1], right[:,1]))
+        filtered = savgol_smooth(extended, window, order)[len(left):len(left)+len(current)]
+        yield make_spectrum(current[:,0], filtered)
+
+        left = np.concatenate((left, current))[-window:]
+        current = following
+
+def rechunk(chunks, size):
+    # merge consecutive chunks until they have at least size rows (the last one may be shorter)
+    pending, rows = [], 0
+    for chunk in chunks:
+        pending.append(chunk)
+        rows += len(chunk)
+        if rows >= size:
+            yield np.concatenate(pending) if len(pending) > 1 else pending[0]
+            pending, rows = [], 0
+    if pending:
+        yield np.concatenate(pending) if len(pending) > 1 else pending[0]
+
+def smooth_rows_chunks(chunks, start, stop, window, order):
+    # rows start..stop-1 of a chunked spectrum filtered with savgol_chunks (like smooth_spectrum of this interval), the other rows pass unchanged
+    chunks = iter(chunks)
+    offset, first = 0, None
+    for chunk in chunks:
+        if offset + len(chunk) > start:
+            if start > offset:
+                yield chunk[:start-offset]
+            first = chunk[start-offset:]
+            break
+        yield chunk
+        offset += len(chunk)
+    if first is None:
+        return
+
+    rest = []
+    def interval():
+        part, position = first, start
+        while part is not None:
+            if position + len(part) >= stop:
+                yield part[:stop-position]
+                rest.append(part[stop-position:])
+                return
+            yield part
+            position += len(part)
+            part = next(chunks, None)
+
+    if stop > start:
+        yield from savgol_chunks(rechunk(interval(), window), window, order)
+    else:
+        rest.append(first)
+    for chunk in chain(rest, chunks):
+        if len(chunk):
+            yield chunk
+
+class SimpsonAccumulator:
+    """
+    Simpson integral of a chunked curve. Blocks with an odd number of points starting at even indices are
+    integrated as soon as possible, the rest is kept for the next chunk, so the sum equals integrate.simpson
+    of the whole curve.
+    """
+    def __init__(self):
+        self.x = np.empty(0)
+        self.y = np.empty(0)
+        self.total = 0
+
+    def add(self, x, y):
+        self.x = np.concatenate((self.x, x))
+        self.y = np.concatenate((self.y, y))
+        m = len(self.x) - 2 if (len(self.x) - 2) % 2 else len(self.x) - 3  # keep at least 3 points for the end correction
+        if m >= 3:
+            self.total += integrate.simpson(self.y[:m], x=self.x[:m])
+            self.x, self.y = self.x[m-1:], self.y[m-1:]
+
+    def result(self):
+        return self.total + (integrate.simpson(self.y, x=self.x) if len(self.x) > 1 else 0)
+
+def stream_absorption(material, chunk_size=100000, savgol_filter_width=4, savgol_filter_order=3):
+    """
+    Chunked version of calc_absorption, yields the absorption cross section in blocks of chunk_size rows
+    with constant memory. Absorption and reference have to be single files on the same wavelength grid,
+    the Fourier filter is not available as it needs the whole spectrum.
+    The files are read three times: grid and zero absorption indices, zero absorption regions, cross section.
+    """
+    absorption_files = measurement_files(material, "absorption")
+    reference_files = measurement_files(material, "reference")
+    if len(absorption_files) != 1 or len(reference_files) != 1:
+        raise ValueError("Streaming needs exactly one absorption and one reference file.")
+
+    def chunk_pairs():
+        offset = 0
+        for absorption, reference in zip(read_spectrum_chunks(absorption_files[0], chunk_size), read_spectrum_chunks(reference_files[0], chunk_size)):
+            if absorption.shape != reference.shape or not np.allclose(absorption[:,0], reference[:,0]):
+                raise ValueError("Streaming needs absorption and reference on the same wavelength grid.")
+            yield offset, absorption, reference
+            offset += len(absorption)
+
+    # 1st pass: grid size, step and the indices closest to the zero absorption wavelengths
+    mid_lambda1, mid_lambda2 = material.get("zero_absorption_wavelength")
+    n, dlambda = 0, None
+    mid_idx, best = [0, 0], [np.inf, np.inf]
+    for offset, absorption, reference in chunk_pairs():
+        if dlambda is None:
+            dlambda = absorption[1,0] - absorption[0,0]
+        axis = WavelengthAxis(absorption[:,0])
+        for k, mid_lambda in enumerate((mid_lambda1, mid_lambda2)):
+            index = axis.index(mid_lambda)
+            if abs(absorption[index,0] - mid_lambda) < best[k]:
+                best[k], mid_idx[k] = abs(absorption[index,0] - mid_lambda), offset + index
+        n = offset + len(absorption)
+    if mid_lambda2 == np.inf:
+        mid_idx[1] = n - 1
+
+    # 2nd pass: collect the rows within the zero absorption regions
+    w, regions = zero_absorption_regions(n, dlambda, material["zero_absorption_width"], *mid_idx)
+    rows = [([], []) for _ in regions]
+    for offset, absorption, reference in chunk_pairs():
+        for region, (absorption_rows, reference_rows) in zip(regions, rows):
+            part = slice(max(region.start - offset, 0), max(min(region.stop - offset, len(absorption)), 0))
+            absorption_rows.append(absorption[part])
+            reference_rows.append(reference[part])
+    ratio = baseline_ratio(w, *mid_idx, [(np.concatenate(a), np.concatenate(r)) for a, r in rows])
+
+    # 3rd pass: pointwise cross section, optionally smoothed with halos
+    def sigma_chunks():
+        for offset, absorption, reference in chunk_pairs():
+            sigma_a = make_spectrum(absorption[:,0], reference[:,1] * ratio(offset + np.arange(len(absorption)), absorption[:,0]))
+            sigma_a[:,1] /= absorption[:,1]
+            np.log(sigma_a[:,1], out=sigma_a[:,1])
+            np.abs(sigma_a[:,1], out=sigma_a[:,1])
+            sigma_a[:,1] /= material["N_dop"]*1e-6*material["length"]*1e2
+            yield sigma_a
+
+    samples = window_samples(savgol_filter_width, dlambda)
+    if samples > savgol_filter_order:
+        chunk_size = max(chunk_size, samples)
+        return savgol_chunks(sigma_chunks(), samples, savgol_filter_order)
+    return sigma_chunks()
+
+def stream_Fuchtbauer_Ladenburg(fluorescence_file, material, sigma_a=None, absorption_depth=0, chunk_size=100000):
+    """
+    Chunked version of Fuchtbauer_Ladenburg for one fluorescence file, smoothed with the smoothing windows of the
+    material like calc_fluorescence (the Fourier filter and the instrument response are not available, they need the
+    whole spectrum). The first pass finds the smoothing intervals, the second accumulates the normalization integral
+    and the third yields sigma_e in blocks.
+    """
+    n = material["n"]
+    tau = material["tau_f"]
+    N_dop = material["N_dop"]*1e-6  # in cm^-3
+
+    # 1st pass: rows closest to the ends of the smoothing windows (as find_interval) and their wavelengths
+    windows = material.get("smoothing_windows", default_smoothing_windows)
+    ends, best, wavelengths = np.zeros((len(windows), 2), dtype=int), np.full((len(windows), 2), np.inf), np.zeros((len(windows), 2))
+    offset, previous = 0, np.nan
+    for fluorescence in read_spectrum_chunks(fluorescence_file, chunk_size):
+        axis = WavelengthAxis(fluorescence[:,0])
+        for k, (lmin, lmax, _) in enumerate(windows):
+            for end, wavelength in enumerate((lmin, lmax)):
+                index = axis.index(wavelength)
+                if abs(fluorescence[index,0] - wavelength) < best[k, end]:
+                    best[k, end], ends[k, end] = abs(fluorescence[index,0] - wavelength), offset + index
+                    # first and last wavelength of the interval for the mean step of smooth_spectrum, the last row is before lmax
+                    wavelengths[k, end] = fluorescence[index,0] if end == 0 else (fluorescence[index-1,0] if index else previous)
+        previous = fluorescence[-1,0]
+        offset += len(fluorescence)
+
+    def smoothed_chunks():
+        chunks = read_spectrum_chunks(fluorescence_file, chunk_size)
+        for (start, stop), (first, last), (_, _, window) in zip(ends, wavelengths, windows):
+            if stop - start > 1:
+                chunks = smooth_rows_chunks(chunks, start, stop, window_samples(window, (last - first) / (stop - start - 1)), 0)
+        return chunks
+
+    def weighted_chunks():
+        for fluorescence in smoothed_chunks():
+            lambdas = fluorescence[:,0]*1e-7   # units: cm
+            absorption_cross_section = np.interp(fluorescence[:,0], sigma_a[:,0], sigma_a[:,1], left=0, right=0) if sigma_a is not None else np.zeros_like(lambdas)
+            absorption_factor = np.exp(N_dop*absorption_cross_section*absorption_depth*0.1)
+            yield lambdas, fluorescence[:,1]*absorption_factor
+
+    integral = SimpsonAccumulator()
+    for lambdas, intensity in weighted_chunks():
+        integral.add(lambdas, intensity*lambdas)
+    Integral = integral.result()
+
+    for lambdas, intensity in weighted_chunks():
+        g = lambdas**3/c * intensity / Integral
+        yield make_spectrum(lambdas*1e7, lambdas**2 / (8*np.pi*n**2*tau) * g)
 
 if __name__ == "__main__":
+    if "--float32" in sys.argv:
+        # reduced memory mode for very large spectra, for the GUI and all headless modes
+        sys.argv.remove("--float32")
+        compute_dtype = np.float32
+    # headless usage: --batch [--project project.json] [materials] writes manifests, --replay manifest.json [...] checks them
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        arguments = sys.argv[2:]
+        settings, material_overrides = None, None
+        if arguments[:1] == ["--project"]:
+            settings, material_overrides = load_project_settings(arguments[1])
+            arguments = arguments[2:]
+        run_batch(arguments or None, settings, material_overrides=material_overrides)
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1] == "--golden":
+        # --golden record [materials] stores golden/<material>.npz, --golden check [--timing] [materials] compares against them
+        if sys.argv[2:3] == ["record"]:
+            record_golden(sys.argv[3:] or None)
+            sys.exit()
+        arguments = sys.argv[3:]
+        timing = "--timing" in arguments
+        materials = [argument for argument in arguments if argument != "--timing"]
+        report, ok = check_golden(materials or None, slowdown=1.5 if timing else None)
+        print("\n".join(report))
+        sys.exit(0 if ok else 1)
+    if len(sys.argv) > 1 and sys.argv[1] == "--merit":
+        # --merit [table.csv|table.json] prints the figures of merit of all materials and exports them
+        rows = figure_of_merit_table()
+        print(format_table(rows))
+        if len(sys.argv) > 2:
+            export_table(sys.argv[2], rows)
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1] == "--render":
+        # --render [--project project.json] [--format pdf,png,svg] [materials] writes figures/<material>_<plot>.<format>
+        arguments = sys.argv[2:]
+        settings, material_overrides, formats = None, None, ("pdf",)
+        while arguments[:1] in (["--project"], ["--format"]):
+            if arguments[0] == "--project":
+                settings, material_overrides = load_project_settings(arguments[1])
+            else:
+                formats = tuple(arguments[1].split(","))
+            arguments = arguments[2:]
+        render_batch(arguments or None, formats=formats, settings=settings, material_overrides=material_overrides)
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1] == "--replay":
+        all_ok = True
+        for filename in sys.argv[2:]:
+            report, ok = replay_manifest(filename)
+            print("\n".join(report))
+            all_ok &= ok
+        sys.exit(0 if all_ok else 1)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--compare-memory":
+        print("\n".join(compare_memory_profiles(sys.argv[2], sys.argv[3])))
+        sys.exit()
+    if "--profile-memory" in sys.argv:
+        # GUI with memory profiling, the report is printed and saved as memory_profile_<date>.json when closing
+        start_memory_profiling()
 
     app = App()
     app.state('normal')
@@ -0,0 +1,583 @@
+import os
+import shutil
+import subprocess
+import sys
+import types
+
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+import pytest
+from scipy.integrate import solve_ivp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Cross_Section_Spectroscopy as css
+
+material_name = "241114_YbFP15"
+
+
+def test_absorption_depth_reuses_family():
+    # moving the absorption depth slider is a lookup: no new cache entries, the same precomputed family
+    backend = css.ComputeBackend()
+    families = {}
+    material = css.read_material(material_name)
+    css.run_pipeline(material, backend=backend, families=families)
+    family = families["Fuchtbauer_Ladenburg"]
+    entries = len(backend.cache)
+
+    for depth in css.FL_depth_grid[[3, 10, 40]]:
+        results = css.run_pipeline({**material, "absorption_depth": depth}, backend=backend, families=families)
+        assert families["Fuchtbauer_Ladenburg"] is family
+        sigma_a = backend.call(css.calc_absorption, material, filter_width=0.0, savgol_filter_width=0.0)[0]
+        Fluo = backend.call(css.calc_fluorescence, material, filter_width=0.6)[0]
+        expected = css.Fuchtbauer_Ladenburg(Fluo, material, sigma_a=sigma_a, absorption_depth=depth)
+        np.testing.assert_allclose(results["sigma_e"][:,1], expected[:,1], rtol=1e-10, atol=0)
+    assert len(backend.cache) == entries
+
+
+def test_backend_byte_budget():
+    material = css.read_material(material_name)
+    size = css.result_nbytes(css.calc_absorption(material))
+    backend = css.ComputeBackend(max_bytes=int(2.5*size))
+    for width in (0.0, 0.2, 0.4, 0.6):
+        backend.call(css.calc_absorption, material, filter_width=width)
+        assert backend.bytes <= backend.max_bytes
+    assert len(backend.cache) == 2
+    assert backend.bytes == sum(css.result_nbytes(result) for result in backend.cache.values())
+
+
+def test_sessions_share_backend_results(tmp_path, monkeypatch):
+    # switching back to a material reuses the results of the shared backend, equal to a computation without cache
+    backend = css.ComputeBackend()
+    first, second = css.read_material(material_name), css.read_material("241111_YbCaF2")
+    results = css.run_pipeline(first, backend=backend)
+    css.run_pipeline(second, backend=backend)
+    entries = len(backend.cache)
+    again = css.run_pipeline(first, backend=backend)
+    assert len(backend.cache) == entries
+    assert again["sigma_a"] is results["sigma_a"]
+    for name, expected in css.run_pipeline(first).items():
+        np.testing.assert_array_equal(again[name], expected)
+    # changed files give new keys for the absorption and fluorescence once the folder is read again
+    folder = tmp_path / "measurements" / material_name
+    shutil.copytree(os.path.join(css.Standard_path, "measurements", material_name), folder)
+    monkeypatch.setattr(css, "Standard_path", str(tmp_path))
+    css.run_pipeline(first, backend=backend)
+    entries = len(backend.cache)
+    with open(folder / f"{material_name}_absorption.txt", "a") as file:
+        file.write("\n")
+    css.run_pipeline(first, backend=backend)
+    assert len(backend.cache) == entries
+    backend.refresh(first)
+    css.run_pipeline(first, backend=backend)
+    assert len(backend.cache) == entries + 2
+
+
+def test_prefetch_stops_at_byte_budget():
+    # the budget is on what the caches hold, not reset per request
+    backend = css.ComputeBackend()
+    prefetcher = css.Prefetcher(max_bytes=0, usage=lambda: backend.bytes)
+    prefetcher.request([material_name], [(css.functools.partial(backend.call, css.calc_absorption), {})])
+    css.wait_futures(prefetcher.futures)
+    assert len(backend.cache) == 0
+    prefetcher.max_bytes = 2**40
+    prefetcher.request([material_name], [(css.functools.partial(backend.call, css.calc_absorption), {})])
+    css.wait_futures(prefetcher.futures)
+    assert len(backend.cache) == 1
+
+
+
+
+def test_plot_action_waits_for_prefetch_only_when_profiling(monkeypatch):
+    calls = []
+    app = types.SimpleNamespace(prefetcher=types.SimpleNamespace(cancel=lambda wait=False: calls.append(wait)),
+                                schedule_prefetch=lambda: None)
+    action = css.profiled_action(lambda self: None)
+    monkeypatch.setattr(css, "memory_profiler", None)
+    action(app)
+    monkeypatch.setattr(css, "memory_profiler", css.MemoryProfiler())
+    action(app)
+    css.tracemalloc.stop()
+    assert calls == [False, True]
+
+
+def test_family_matches_by_value():
+    material = css.read_material(material_name)
+    Fluo = css.calc_fluorescence(material)[0]
+    sigma_a = css.calc_absorption(material)[0]
+    family = css.FuchtbauerLadenburgFamily(Fluo, material, sigma_a)
+    assert family.matches(Fluo.copy(), dict(material), sigma_a.copy())
+    assert not family.matches(Fluo, {**material, "tau_f": 2*material["tau_f"]}, sigma_a)
+
+
+def test_fit_zero_phonon_line_is_consistent():
+    # fitting again with the fitted levels does not move them, the splittings of the manifolds are kept
+    material = css.read_material("241111_YbCaF2")
+    results = css.run_pipeline(material)
+    E_l, E_u = material["energy_lower_level"], material["energy_upper_level"]
+    E_l_fit, E_u_fit, shift, rms = css.fit_zero_phonon_line(material, results["sigma_a"], results["sigma_e"], E_l, E_u)
+    assert E_l_fit == E_l
+    np.testing.assert_allclose(np.diff(E_u_fit), np.diff(E_u))
+    assert abs(css.fit_zero_phonon_line(material, results["sigma_a"], results["sigma_e"], E_l_fit, E_u_fit)[2]) < 0.1
+
+
+def test_old_project_savgol_window_is_converted(tmp_path):
+    # projects saved before the window was given in nm store it in samples of the absorption grid
+    material = css.read_material(material_name)
+    step = css.absorption_step(material)
+    project = tmp_path / "project_data.json"
+    project.write_text(css.json.dumps({"material_list": material_name, "savgol_filter": 21, "FF_absorption": 0.1}))
+    settings, overrides = css.load_project_settings(str(project))
+    assert "savgol_filter" not in settings
+    assert settings["savgol_filter_nm"] == round(20*step, 3)
+    assert css.window_samples(settings["savgol_filter_nm"], step) == 21
+    assert css.migrate_settings({"savgol_filter_nm": 2.0, "FF_absorption": 0}) == {"savgol_filter_nm": 2.0, "FF_absorption": 0}
+
+
+def test_golden_outputs():
+    # the committed corpus in golden/, runtimes are not compared
+    report, ok = css.check_golden()
+    assert ok, "\n".join(report)
+
+
+def test_golden_recorded_with_other_settings_is_stale(tmp_path, monkeypatch):
+    css.record_golden([material_name], golden_dir=str(tmp_path))
+    assert css.check_golden([material_name], golden_dir=str(tmp_path))[1]
+    monkeypatch.setitem(css.golden_settings, "MC_width", 20)
+    report, ok = css.check_golden([material_name], golden_dir=str(tmp_path))
+    assert not ok and "recorded with other settings" in report[0]
+
+
+def test_float32_deviation(monkeypatch):
+    # the documented float32_tolerance holds for all outputs of all golden materials
+    for material in css.golden_materials():
+        monkeypatch.setattr(css, "compute_dtype", np.float64)
+        reference = css.golden_case(material, repeat=1)[0]
+        monkeypatch.setattr(css, "compute_dtype", np.float32)
+        results = css.golden_case(material, repeat=1)[0]
+        lambdas, signals = css.spectrum_cache.read(css.measurement_files(css.read_material(material), "absorption")[0])
+        assert lambdas.dtype == np.float64 and signals.dtype == np.float32
+        for name in reference:
+            assert css.golden_difference(reference[name], results[name]) < css.float32_tolerance, (material, name)
+
+
+large_spectrum_run = """
+import resource, sys
+import numpy as np
+sys.path.insert(0, {root!r})
+import Cross_Section_Spectroscopy as css
+css.compute_dtype = np.{dtype}
+material = {{**css.read_material({material!r}), "folder_path": {folder!r}}}
+start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+results = css.run_pipeline(material, css.golden_settings, families={{}})
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start)
+np.savez({output!r}, **results)
+"""
+
+
+def test_float32_large_spectrum(tmp_path):
+    # 1e6 samples, the Füchtbauer-Ladenburg family over all depths is where float32 saves memory
+    pytest.importorskip("resource")
+    lambdas = np.linspace(850, 1150, 1_000_000)
+    for kind in ("absorption", "absorption_reference", "fluorescence_high"):
+        measured_lambdas, signals = css.spectrum_cache.read(os.path.join(css.Standard_path, "measurements", material_name, f"{material_name}_{kind}.txt"))
+        data = np.column_stack((lambdas, np.interp(lambdas, measured_lambdas, signals[0])))
+        with open(tmp_path / f"large_{kind}.txt", "w") as file:
+            file.write("IstTemp[K]=293.00\n\n")
+            np.savetxt(file, data, fmt=["%.6f", "%.6E"], delimiter=",")
+
+    peak, results = {}, {}
+    for dtype in ("float64", "float32"):
+        script = large_spectrum_run.format(root=css.Standard_path, dtype=dtype, material=material_name, folder=str(tmp_path), output=str(tmp_path / f"{dtype}.npz"))
+        run = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, env={**os.environ, "MPLBACKEND": "Agg"})
+        assert run.returncode == 0, run.stderr
+        peak[dtype] = int(run.stdout.split()[-1])
+        results[dtype] = np.load(tmp_path / f"{dtype}.npz")
+
+    assert peak["float32"] < 0.75*peak["float64"], peak
+    for name in results["float64"].files:
+        assert css.golden_difference(results["float64"][name], results["float32"][name]) < css.float32_tolerance, name
+
+
+def test_text_export_blanks_only_padding(tmp_path):
+    # labels containing "nan" (e.g. nanometer) are kept, the cells below the end of the shorter line are blank
+    file_name = tmp_path / "lines.dat"
+    css.export_lines(str(file_name), {"sigma_a nanometer": ([1.0, 2.0, 3.0], [3.0, np.nan, 4.0]), "Fluo": ([1.0], [5.0])})
+    lines = file_name.read_text().splitlines()
+    assert lines[0] == "sigma_a nanometer_x\tsigma_a nanometer_y\tFluo_x\tFluo_y"
+    assert lines[1].split("\t") == ["1.00000e+00", "3.00000e+00", "1.00000e+00", "5.00000e+00"]
+    assert lines[2].split("\t") == ["2.00000e+00", "nan", "", ""]
+    assert lines[3].split("\t") == ["3.00000e+00", "4.00000e+00", "", ""]
+    assert len(lines) == 4
+
+
+def test_collect_lines_keeps_duplicate_labels():
+    figure, axes = css.plt.subplots(1, 2)
+    axes[0].plot([1, 2], [3, 4], label="sigma_a")
+    axes[1].plot([1, 2], [5, 6], label="sigma_a")
+    axes[1].plot([1, 2], [7, 8], label="_hidden")
+    lines = css.App.collect_lines(types.SimpleNamespace(fig=figure))
+    css.plt.close(figure)
+    assert list(lines) == ["sigma_a", "sigma_a_2"]
+    np.testing.assert_array_equal(lines["sigma_a_2"][1], [5, 6])
+
+
+def test_wavelength_axis_cache_compares_grids():
+    lambdas = np.linspace(900, 1100, 2001)
+    axis = css.wavelength_axis(lambdas)
+    assert css.wavelength_axis(lambdas.copy()) is axis
+    # same length and end points, different interior
+    shifted = lambdas.copy()
+    shifted[1000] += 0.05
+    other = css.wavelength_axis(shifted)
+    assert other is not axis and not other.uniform
+    assert other.index(1000.04) == np.argmin(np.abs(shifted - 1000.04))
+    assert css.wavelength_axis(lambdas).index(1000.04) == np.argmin(np.abs(lambdas - 1000.04))
+
+
+def test_resample_matches_interp():
+    rng = np.random.default_rng(1)
+    source = np.sort(rng.uniform(900, 1100, 500))
+    target = np.linspace(880, 1120, 700)
+    stack = rng.normal(size=(3, len(source)))
+    for edges, outside in (("zero", {"left": 0, "right": 0}), ("hold", {})):
+        expected = np.array([np.interp(target, source, row, **outside) for row in stack])
+        np.testing.assert_allclose(css.resample(stack, source, target, edges), expected, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(css.resample(stack[0], source, target, edges), expected[0], rtol=1e-12, atol=1e-12)
+    # same length and end points, different interior: a new operator
+    moved = source.copy()
+    moved[250] = 0.5*(moved[249] + moved[250])
+    np.testing.assert_allclose(css.resample(stack, moved, target), [np.interp(target, moved, row, left=0, right=0) for row in stack], rtol=1e-12, atol=1e-12)
+
+
+def test_to_wavenumber_conserves_integral():
+    lambdas = np.linspace(950, 1050, 2001)
+    spectrum = css.make_spectrum(lambdas, np.exp(-(lambdas - 1000)**2 / 50), dtype=np.float64)
+    wavenumbers = css.to_wavenumber(spectrum)
+    assert np.all(np.diff(wavenumbers[:,0]) > 0)
+    np.testing.assert_allclose(np.trapezoid(wavenumbers[:,1], wavenumbers[:,0]), np.trapezoid(spectrum[:,1], lambdas), rtol=1e-3)
+    assert abs(1e7/wavenumbers[np.argmax(wavenumbers[:,1]),0] - 1000) < 0.2
+
+
+def gaussian_line(x, center, fwhm):
+    return np.exp(-4*np.log(2)*(x - center)**2/fwhm**2)
+
+
+def test_deconvolve_blurred_lines():
+    # two 0.3 nm lines blurred by a 0.5 nm gaussian response, the tails are exactly zero
+    step = 0.05
+    x = np.arange(900, 1100, step)
+    lines = gaussian_line(x, 1000, 0.3) + 0.5*gaussian_line(x, 1003, 0.3)
+    psf = gaussian_line(x, x[0], 0.5) + gaussian_line(x, x[-1] + step, 0.5)
+    blurred = np.fft.irfft(np.fft.rfft(lines) * np.fft.rfft(psf/psf.sum()), len(x))
+    window = (x > 995) & (x < 1001)
+    for method, options, tolerance in (("wiener", {"noise": 1e-4}, 0.1), ("richardson_lucy", {"iterations": 200}, 1e-3)):
+        restored = css.deconvolve(np.array([blurred, 2*blurred]), step, 0.5, method=method, **options)
+        assert np.all(np.isfinite(restored)) and np.all(restored > 0), method
+        np.testing.assert_allclose(restored[1], 2*restored[0], rtol=1e-9)
+        assert np.max(np.abs(restored[0] - lines)) < tolerance, method
+        half = restored[0][window] > 0.5*restored[0][window].max()
+        assert abs(np.count_nonzero(half)*step - 0.3) < 0.06, method
+
+
+def test_deconvolved_cross_sections_are_finite():
+    # the ringing of the inverse filter on the steep absorption edge of this sample made sigma_a undefined
+    material = {**css.read_material("140905_YbLiMgAS"), "instrument_response": {"fwhm": 0.5}}
+    for name, result in css.run_pipeline(material).items():
+        assert np.all(np.isfinite(result)), name
+
+
+def test_stream_absorption_equals_in_memory():
+    material = css.read_material("250408_YbLiMgAS")
+    expected = css.calc_absorption(material, savgol_filter_width=4)[0]
+    for chunk_size in (50, 100000):
+        streamed = np.concatenate(list(css.stream_absorption(material, chunk_size=chunk_size, savgol_filter_width=4)))
+        np.testing.assert_allclose(streamed, expected, rtol=1e-10, atol=0)
+
+
+def test_stream_fuchtbauer_ladenburg_equals_in_memory():
+    # the smoothing windows of calc_fluorescence are applied in the stream too, wide windows span several chunks
+    for windows in (css.default_smoothing_windows, [[990, 1150, 5], [1000, 1060, 8]]):
+        material = {**css.read_material("250408_YbLiMgAS"), "smoothing_windows": windows}
+        sigma_a = css.calc_absorption(material)[0]
+        fluorescence = css.calc_fluorescence(material, filter_width=0)[0]
+        expected = css.Fuchtbauer_Ladenburg(fluorescence, material, sigma_a=sigma_a, absorption_depth=0.5)
+        for chunk_size in (7, 100, 100000):
+            chunks = css.stream_Fuchtbauer_Ladenburg(css.measurement_files(material, "fluorescence")[0], material, sigma_a=sigma_a, absorption_depth=0.5, chunk_size=chunk_size)
+            streamed = np.concatenate(list(chunks))
+            np.testing.assert_allclose(streamed, expected, rtol=1e-10, atol=1e-12*expected[:,1].max())
+
+
+def test_absorption_stack_rows_equal_calc_absorption(tmp_path, monkeypatch):
+    # a stack of the absorption spectrum and its double gives the same sigma_a as calc_absorption in every row
+    material = css.read_material(material_name)
+    folder = tmp_path / "measurements" / material_name
+    shutil.copytree(os.path.join(css.Standard_path, "measurements", material_name), folder)
+    lambdas, signals = css.spectrum_cache.read(str(folder / f"{material_name}_absorption.txt"))
+    np.savetxt(folder / f"{material_name}_stack.txt", np.column_stack([lambdas, signals[0], 2*signals[0]]), delimiter=",", fmt="%.17g")
+    monkeypatch.setattr(css, "Standard_path", str(tmp_path))
+    for filter_width, savgol_filter_width in ((0, 0), (0.4, 4)):
+        sigma_a = css.calc_absorption(material, filter_width=filter_width, savgol_filter_width=savgol_filter_width)[0]
+        stack_lambdas, sigma_stack = css.calc_absorption_stack(material, filter_width=filter_width, savgol_filter_width=savgol_filter_width)[:2]
+        assert np.array_equal(stack_lambdas, sigma_a[:,0])
+        assert sigma_stack.shape == (2, len(sigma_a))
+        assert np.allclose(sigma_stack, sigma_a[:,1], rtol=0, atol=1e-12*sigma_a[:,1].max())
+
+
+def test_McCumber_stack_equals_rows(monkeypatch):
+    # the stack view applies the McCumber relation to all spectra at once, equal to McCumber_relation per spectrum
+    material = css.read_material(material_name)
+    sigma_a = css.calc_absorption(material)[0]
+    E_l, E_u = material.get("energy_lower_level", [0]), material.get("energy_upper_level", [1e-2/material["ZPL"]])
+    kbT = css.kb * material.get("temperature", 295)
+    sigma_stack = sigma_a[:,1] * np.array([[1.0], [0.5], [2.0]])
+    app = types.SimpleNamespace(material_dict=material, E_l=E_l, E_u=E_u, use_McCumber=types.SimpleNamespace(get=lambda: 1),
+                                FF_absorption=types.SimpleNamespace(get=lambda: 0), savgol_filter_nm=types.SimpleNamespace(get=lambda: 0))
+    monkeypatch.setattr(css, "calc_absorption_stack", lambda material, **kwargs: (sigma_a[:,0], sigma_stack))
+    lambdas, sigma_e_stack, label = css.App.stack_cross_sections(app)
+    for row, sigma in zip(sigma_e_stack, sigma_stack):
+        assert np.allclose(row, css.McCumber_relation(E_l, E_u, css.make_spectrum(sigma_a[:,0], sigma), kbT)[:,1], rtol=1e-14, atol=0)
+
+
+def test_replay_skips_timings_of_cached_stages(tmp_path):
+    material = css.read_material(material_name)
+    backend = css.ComputeBackend()
+    css.run_pipeline(material, backend=backend)
+    manifest = css.RunManifest(material, css.default_settings)
+    css.run_pipeline(material, css.default_settings, manifest=manifest, backend=backend)
+    assert manifest.data["cached"] == ["calc_absorption", "calc_fluorescence"]
+    # a cache hit takes microseconds, the uncached replay must not count as a slowdown
+    manifest.data["timings"] = {name: 0.0 if name in manifest.data["cached"] else 10.0 for name in manifest.data["timings"]}
+    manifest.save(tmp_path / "run.manifest.json")
+    report, ok = css.replay_manifest(tmp_path / "run.manifest.json", min_time=0)
+    assert ok, "\n".join(report)
+    assert "  calc_absorption: cached, timing not compared" in report
+
+
+def test_manifest_only_saved_with_cross_section_plot(tmp_path, monkeypatch):
+    material = css.read_material(material_name)
+    figure = css.plt.figure()
+    app = types.SimpleNamespace(fig=figure, manifest=css.RunManifest(material, css.default_settings), current_plot="absorption")
+    for current_plot, file_name in (("absorption", "absorption.png"), ("cross_sections", ""), ("cross_sections", "figure.unknown"), ("cross_sections", "cross_sections.png")):
+        app.current_plot = current_plot
+        monkeypatch.setattr(css.customtkinter.filedialog, "asksaveasfilename", lambda: str(tmp_path / file_name) if file_name else "")
+        css.App.save_figure(app)
+    css.plt.close(figure)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["absorption.png", "cross_sections.png", "cross_sections.png.manifest.json"]
+
+
+def test_catalog_matches_basedata_and_updates_changed_folders(tmp_path):
+    shutil.copytree(os.path.join(css.Standard_path, "measurements"), tmp_path / "measurements")
+    catalog = css.MaterialCatalog(str(tmp_path / "measurements"))
+    assert catalog.update()
+    folders = sorted(os.listdir(tmp_path / "measurements"))
+    assert catalog.query() == folders
+    for folder in folders:
+        material = css.read_material(folder)
+        assert all(catalog.entries[folder][key] == material.get(key) for key in ("name", "N_dop", "ZPL", "temperature"))
+    # the filters give the same materials as filtering the basedata files
+    materials = {folder: css.read_material(folder) for folder in folders}
+    assert catalog.query("Yb T<300") == [folder for folder, material in materials.items() if "Yb" in material["name"] and material["temperature"] < 300]
+    ytterbium = catalog.query(dopant="Yb", sort_by="N_dop")
+    assert set(ytterbium) == {folder for folder, material in materials.items() if material["name"].startswith("Yb:")}
+    assert [materials[folder]["N_dop"] for folder in ytterbium] == sorted(materials[folder]["N_dop"] for folder in ytterbium)
+
+    # the saved index is loaded without reading the folders, only changed folders are read again
+    catalog = css.MaterialCatalog(str(tmp_path / "measurements"))
+    assert not catalog.update()
+    basedata = tmp_path / "measurements" / material_name / "basedata.json"
+    basedata.write_text(basedata.read_text().replace('"temperature": 295', '"temperature": 77'))
+    assert catalog.update()
+    assert catalog.entries[material_name]["temperature"] == 77
+
+
+def test_settings_transaction_recomputes_once():
+    # every slider write fires its callback, inside the transaction they are suspended and the plot is computed once
+    calls = []
+
+    class Slider:
+        def __init__(self, app):
+            self.app, self.value = app, None
+
+        def set(self, value):
+            self.value = value
+            self.app.update_abs_slider_value(value)
+
+    class FakeApp:
+        settings_transaction = css.App.settings_transaction
+        apply_settings = css.App.apply_settings
+        update_abs_slider_value = css.App.update_abs_slider_value
+
+        def __init__(self):
+            self.suspend_updates = False
+            self.FF_absorption, self.savgol_filter_nm, self.zero_bandwidth = Slider(self), Slider(self), Slider(self)
+
+        def update_material_dictionary(self, value): calls.append("material")
+        def update_absorption_plot(self): calls.append("absorption")
+        def update_stack_plot(self): calls.append("stack")
+        def refresh_plot(self): calls.append("refresh")
+
+    app = FakeApp()
+    app.FF_absorption.set(0.2)
+    assert calls == ["material", "absorption", "stack"]
+    calls.clear()
+    data = {"FF_absorption": 0.1, "savgol_filter_nm": 2.0, "zero_bandwidth": 5}
+    with app.settings_transaction():
+        app.apply_settings(data)
+        with app.settings_transaction():   # nested transactions recompute with the outermost one
+            app.apply_settings(data)
+    assert calls == ["material", "refresh"]
+    assert not app.suspend_updates
+    assert {name: getattr(app, name).value for name in data} == data
+
+
+def test_render_reuses_template_with_pipeline_data(tmp_path):
+    # the second material reuses the figure of the first one: its lines show the run_pipeline results, unused lines are hidden
+    written, errors = css.render_material(material_name, kinds=("cross_sections",), formats=("png",), output_dir=str(tmp_path))
+    assert errors == [] and written == [str(tmp_path / f"{material_name}_cross_sections.png")]
+    template = css.figure_templates["cross_sections"]
+    figure = template.fig
+
+    other, settings = "251022_TmGlassYAST", {**css.default_settings, "use_Fuchtbauer": 0}
+    written, errors = css.render_material(other, kinds=("cross_sections",), formats=("png",), output_dir=str(tmp_path), settings=settings)
+    assert errors == [] and os.path.isfile(written[0])
+    assert css.figure_templates["cross_sections"].fig is figure
+    results = css.run_pipeline(css.read_material(other), settings)
+    assert [line.get_label() for line in template.ax.get_legend().get_lines()] == [css.cross_section_labels[key].format(name=css.read_material(other)["name"]) for key in results]
+    assert "sigma_e" in template.lines and "sigma_e" not in results
+    for name, line in template.lines.items():
+        assert line.get_visible() == (name in results)
+        if name in results:
+            np.testing.assert_array_equal(line.get_xydata(), results[name])
+
+
+def test_spectrum_reader_equals_genfromtxt(tmp_path):
+    measurements = os.path.join(css.Standard_path, "measurements")
+    files = [os.path.join(measurements, folder, f) for folder in sorted(os.listdir(measurements)) for f in sorted(os.listdir(os.path.join(measurements, folder))) if f.endswith(".txt")]
+    assert files
+    for file in files:
+        with open(file) as f:
+            header = 2 if f.readline().startswith("IstTemp") else 0
+        np.testing.assert_array_equal(css.read_spectrum_file(file), np.genfromtxt(file, skip_header=header, delimiter=",", comments="#"))
+
+    bad = tmp_path / "bad.txt"
+    bad.write_text("# wavelength in nm, signal in a.u.\n800.0,1.0\n800.2,nan\n")
+    with pytest.raises(ValueError, match="missing value in data row 2"):
+        css.read_spectrum_file(str(bad))
+    bad.write_text("800.0,1.0\n800.2,2.0\n800.2,3.0\n")
+    with pytest.raises(ValueError, match="not increasing at data row 3"):
+        css.read_spectrum_file(str(bad))
+
+    # other instruments are read after registering their dialect
+    other = tmp_path / "other.txt"
+    other.write_text("Instrument X\nwavelength\tsignal\n800.0\t1.5\n800.5\t2.5\n")
+    dialect = css.SpectrumDialect("instrument X", lambda line: line.startswith("Instrument X"), header_lines=2, delimiter="\t")
+    css.register_spectrum_dialect(dialect)
+    try:
+        np.testing.assert_array_equal(css.read_spectrum_file(str(other)), [[800.0, 1.5], [800.5, 2.5]])
+    finally:
+        css.spectrum_dialects.remove(dialect)
+
+
+def test_memory_profiler_records_stages_and_leaks(monkeypatch):
+    profiler = css.MemoryProfiler()
+    monkeypatch.setattr(css, "memory_profiler", profiler)
+    try:
+        kept = []
+        for _ in range(4):
+            with profiler.track("leaking"):
+                kept.append(np.ones(2**18))
+            with profiler.track("pipeline"):
+                manifest = css.RunManifest(css.read_material(material_name), css.default_settings)
+                css.run_pipeline(css.read_material(material_name), manifest=manifest)
+    finally:
+        css.tracemalloc.stop()
+
+    leaking = [record for record in profiler.records if record["name"] == "leaking"]
+    assert all(record["allocated"] >= kept[0].nbytes for record in leaking)
+    # the stages of run_pipeline are recorded nested in the action, its peak includes theirs
+    stages = profiler.records[profiler.records.index(leaking[-1]) + 1:-1]
+    assert all(record["nested"] for record in stages) and not profiler.records[-1]["nested"]
+    assert [record["name"] for record in stages] == list(manifest.data["timings"])
+    assert profiler.records[-1]["name"] == "pipeline" and profiler.records[-1]["peak"] >= max(record["peak"] for record in stages)
+    assert profiler.leaks() == ["leaking"]
+    assert profiler.summary()["leaking"]["calls"] == 4
+
+
+def test_figure_of_merit_table_matches_pipeline():
+    backend = css.ComputeBackend()
+    rows = {row["folder_path"]: row for row in css.figure_of_merit_table(backend=backend)}
+    assert sorted(rows) == sorted(os.listdir(os.path.join(css.Standard_path, "measurements")))
+    for folder, row in rows.items():
+        material = css.read_material(folder)
+        settings = dict(css.default_settings)
+        if not css.measurement_files(material, "fluorescence"):
+            settings.update(use_Fuchtbauer=0, average_sigma=0)
+        results = css.run_pipeline(material, settings)
+        sigma_e = css.emission_cross_section(results)
+        sigma_a = np.interp(sigma_e[:,0], results["sigma_a"][:,0], results["sigma_a"][:,1])
+        laser = np.nanargmax(sigma_e[:,1])
+        assert row["sigma_e_peak"] == sigma_e[laser,1] and row["lambda_e_peak"] == sigma_e[laser,0]
+        assert row["sigma_a_peak"] == np.max(results["sigma_a"][:,1])
+        photon_energy = css.planck*css.c / (sigma_e[laser,0]*1e-7)
+        assert row["F_sat"] == pytest.approx(photon_energy / (sigma_a[laser] + sigma_e[laser,1]), rel=1e-12)
+        assert row["beta_min"] == pytest.approx(sigma_a[laser] / (sigma_a[laser] + sigma_e[laser,1]), rel=1e-12)
+        assert row["sigma_e_tau"] == pytest.approx(sigma_e[laser,1] * material["tau_f"], rel=1e-12)
+        assert 0 < row["gain_bandwidth"] <= sigma_e[-1,0] - sigma_e[0,0]
+
+    selected = css.select_rows(list(rows.values()), "Yb sigma_e_peak>1e-21", sort_by="sigma_e_peak", descending=True)
+    assert [row["sigma_e_peak"] for row in selected] == sorted((row["sigma_e_peak"] for row in rows.values() if "Yb" in row["folder_path"] + row["name"] and row["sigma_e_peak"] > 1e-21), reverse=True)
+
+
+def test_gain_simulation_matches_rate_equations():
+    # the closed form pump propagation against a numerical integration, the gain against a loop over wavelengths
+    material = css.read_material(material_name)
+    results = css.run_pipeline(material)
+    simulation = css.simulate_gain(material, results, pump_intensities=[2, 20], nz=400)
+    N, tau, z = material["N_dop"]*1e-6, material["tau_f"], simulation["z"]
+    sigma_a_p = np.interp(simulation["pump_wavelength"], simulation["lambdas"], css.resample(results["sigma_a"][:,1], results["sigma_a"][:,0], simulation["lambdas"]))
+    sigma_e_p = np.interp(simulation["pump_wavelength"], simulation["lambdas"], np.nan_to_num(css.emission_cross_section(results)[:,1]))
+    I_sat = css.planck*css.c / (simulation["pump_wavelength"]*1e-7) / ((sigma_a_p + sigma_e_p) * tau)
+    for row, I0 in enumerate((2e3, 20e3)):
+        solution = solve_ivp(lambda _, I: -N*sigma_a_p*I / (1 + I/I_sat), (z[0], z[-1]), [I0], t_eval=z, rtol=1e-10, atol=1e-6)
+        np.testing.assert_allclose(simulation["pump"][row], solution.y[0], rtol=1e-6)
+
+    sigma_a = css.resample(results["sigma_a"][:,1], results["sigma_a"][:,0], simulation["lambdas"])
+    sigma_e = np.nan_to_num(css.emission_cross_section(results)[:,1])
+    for row in range(2):
+        mean_inversion = css.integrate.simpson(simulation["inversion"][row], x=z) / (z[-1] - z[0])
+        for i in range(0, len(sigma_a), 97):
+            expected = np.exp(N * z[-1] * (mean_inversion*sigma_e[i] - (1 - mean_inversion)*sigma_a[i]))
+            assert simulation["gain"][row, i] == pytest.approx(expected, rel=1e-12)
+
+    # the process pool for large intensity grids gives the same result
+    blocked = css.simulate_gain(material, results, pump_intensities=[2, 20], nz=400, block_size=1, max_workers=2)
+    np.testing.assert_array_equal(blocked["gain"], simulation["gain"])
+
+
+def test_snapshot_history_undo_redo_and_sharing():
+    # undo/redo return the stored results of earlier runs, unchanged stages share one array
+    material = css.read_material(material_name)
+    history = css.SnapshotHistory(max_snapshots=3)
+    runs = []
+    for width in (10, 12, 14):
+        settings = {**css.default_settings, "average_sigma": 1, "MC_width": width}
+        runs.append(css.run_pipeline(material, settings))
+        assert history.commit(settings, material, runs[-1]) is not None
+    assert history.commit(settings, material, runs[-1]) is None   # same state as the current snapshot
+    first, second, third = history.snapshots
+    assert first.results["sigma_a"] is second.results["sigma_a"] is third.results["sigma_a"]
+    assert first.results["sigma_e_average"] is not third.results["sigma_e_average"]
+    assert second.label.endswith("MC_width=12")
+
+    assert history.undo() is second and history.undo() is first and history.undo() is None
+    for name, data in history.current.results.items():
+        np.testing.assert_array_equal(data, runs[0][name])
+    assert history.redo() is second
+    # committing after an undo discards the redo branch, at most max_snapshots are kept
+    history.commit({**css.default_settings, "MC_width": 20}, material, css.run_pipeline(material))
+    history.commit({**css.default_settings, "MC_width": 22}, material, css.run_pipeline(material))
+    assert [snapshot.number for snapshot in history.snapshots] == [2, 4, 5]
+    assert history.undo().number == 4 and history.redo().number == 5 and history.redo() is None
+    used = {id(data) for snapshot in history.snapshots for data in snapshot.results.values()}
+    assert {id(data) for data in history.arrays.values()} == used